@@ -1,9 +1,21 @@
+import argparse
+import copy
 import logging
 import asyncio
+import multiprocessing
 import os
+import signal
+import socket
+import tempfile
 from hbmqtt.broker import Broker
 
 import monkeypatch
+import plugins
+from bus import BusHub
+from limits import LimitsPlugin
+from metrics import MetricsPlugin
+from retained import RetainedStore
+from totals import OccupancyTotals
 
 logger = logging.getLogger(__name__)
 
@@ -12,9 +24,29 @@ config = {
         'default': {
             'type': 'tcp',
             'bind': ':::1883',
+            # Token buckets: new connections per second on this listener,
+            # and publishes per second per client.  Only QoS 0 publishes
+            # that aren't retained are dropped over the limit, the rest wait.
+            'connect_rate': 100,
+            'connect_burst': 200,
+            'publish_rate': 20,
+            'publish_burst': 40,
         },
     },
     'sys_interval': 10,
+    'occupancy-totals': {
+        'interval': 1.0,
+        # As the sensors publish their counts (sensor.py --qos).
+        'qos': 2,
+    },
+    'metrics': {
+        # Prometheus text on http://<host>:9883/metrics; unset to turn off.
+        'http': '127.0.0.1:9883',
+    },
+    'retained-store': {
+        'path': 'retained.log',
+        'sync_interval': 1.0,
+    },
     'topic-check': {
         'enabled': False,
         'acl' : {
@@ -24,17 +56,138 @@ config = {
     }
 }
 
-broker = Broker(config)
+def create_broker(config, totals=True):
+    broker = Broker(config)
+    if totals:
+        plugins.register(broker, 'occupancy_totals', OccupancyTotals)
+    plugins.register(broker, 'limits', LimitsPlugin)
+    plugins.register(broker, 'metrics', MetricsPlugin)
+    return broker
+
+def worker_config(index, workers, path):
+    """
+    The config of one of several worker processes: its listeners share
+    their ports with the other workers', the listener-wide connection
+    rate is split between them and each serves metrics a port further
+    up.  The bus hub persists the retained messages instead, and the
+    first worker, which keeps the occupancy totals, follows every
+    sensor through the bus.
+    """
+    worker = copy.deepcopy(config)
+    for listener in worker['listeners'].values():
+        listener['reuse_port'] = True
+        for key in ('connect_rate', 'connect_burst'):
+            if key in listener:
+                listener[key] = max(1, listener[key] // workers)
+
+    metrics = worker.get('metrics', {})
+    if metrics.get('http'):
+        host, _, port = str(metrics['http']).rpartition(':')
+        metrics['http'] = '%s:%d'%(host, int(port) + index)
+
+    worker.pop('retained-store', None)
+    worker['bus'] = {'path': path}
+    if index == 0:
+        worker['bus']['subscribe'] = ['%s/+/+/occupancy/+'%(OccupancyTotals.PREFIX,)]
+    return worker
+
+def use_uvloop():
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("uvloop isn't installed, using asyncio's event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+def run(broker):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(broker.start())
+    # Stop cleanly on docker stop, so the retained store's last batch is written.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.run_forever()
+
+def run_worker(index, workers, path, uvloop):
+    logging.basicConfig(level=logging.INFO, format=formatter)
+    if uvloop:
+        use_uvloop()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run(create_broker(worker_config(index, workers, path), totals=(index == 0)))
+
+def run_workers(workers, uvloop):
+    """
+    Runs workers broker processes on the listeners' ports, joined by a
+    bus hub in this process, and restarts any that exit.
 
-@asyncio.coroutine
-def test_coro():
-    yield from broker.start()
-    #yield from asyncio.sleep(5)
-    #yield from broker.shutdown()
+    The kernel hands each new connection to an arbitrary worker, so
+    sessions are not shared: a client reconnecting with
+    clean_session=False, as the sensors and the dashboard do, lands on
+    a worker that may not hold its session, and gets a new one there.
+    Its subscriptions and the QoS 1 and 2 messages queued for it while
+    it was away stay behind in the old worker.  The sensors and the
+    dashboard subscribe again on every connect, but what was published
+    for them while they were offline can be lost.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='broker-'), 'bus.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(workers)
 
+    store = RetainedStore(**config['retained-store']) if config.get('retained-store') else None
+    hub = BusHub(sock, store)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(hub.start())
+
+    # Spawned rather than forked: this process already runs the
+    # store's sync thread and an event loop.
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+
+    def start(index):
+        process = context.Process(target=run_worker, args=(index, workers, path, uvloop),
+                                  name='broker-%d'%(index,), daemon=True)
+        process.start()
+        processes[index] = process
+
+    def supervise():
+        for index, process in list(processes.items()):
+            if not process.is_alive():
+                logger.warning("Broker worker %d exited with %s, restarting" % (index, process.exitcode))
+                start(index)
+        loop.call_later(1, supervise)
+
+    for index in range(workers):
+        start(index)
+    loop.call_later(1, supervise)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    loop.run_forever()
+
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+    hub.close()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+formatter = "[%(asctime)s] :: %(levelname)s :: %(name)s :: %(message)s"
 
 if __name__ == '__main__':
-    formatter = "[%(asctime)s] :: %(levelname)s :: %(name)s :: %(message)s"
+    parser = argparse.ArgumentParser(description="Occupancy MQTT broker")
+    parser.add_argument("-w", "--workers", help="Number of broker processes sharing the listeners' ports; "
+                        "persistent sessions and their queued messages are not shared between them, "
+                        "so a client reconnecting to another worker starts a new session", type=int, default=1)
+    parser.add_argument("--uvloop", help="Run on uvloop's event loop, if installed", action="store_true")
+
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO, format=formatter)
-    asyncio.get_event_loop().run_until_complete(test_coro())
-    asyncio.get_event_loop().run_forever()
+    if args.uvloop:
+        use_uvloop()
+
+    if args.workers > 1:
+        run_workers(args.workers, args.uvloop)
+    else:
+        run(create_broker(config))
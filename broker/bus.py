@@ -0,0 +1,236 @@
+"""
+Message bus between broker worker processes.
+
+With several workers sharing a listening port, a client's publish lands
+on one worker while subscribers may be connected to any of them.  Each
+worker connects to a hub in the parent process over a unix socket and
+sends it every broadcast and retained message; the hub passes a
+broadcast on only to the workers with a matching subscription, and a
+retained message to all of them, so every worker keeps the same
+retained set.  The hub also holds the retained messages for workers
+that (re)start and, with a RetainedStore, is the one process that
+persists them.
+
+Frames are a 4-byte length, a kind byte and the kind's body: for
+BROADCAST and RETAIN a qos byte (255 for none), the topic's 2-byte
+length, the topic and the data; for SUBSCRIBE and UNSUBSCRIBE the
+filter.  $ topics stay local to their worker.
+"""
+
+import asyncio
+import struct
+
+from hbmqtt.broker import RetainedApplicationMessage, EVENT_BROKER_MESSAGE_RECEIVED
+
+from topics import TopicTrie
+
+BROADCAST = 1
+RETAIN = 2
+SUBSCRIBE = 3
+UNSUBSCRIBE = 4
+SYNCED = 5
+
+HEADER = struct.Struct('>IB')
+MESSAGE = struct.Struct('>BH')
+
+NO_QOS = 255
+
+def frame(kind, body=b''):
+    return HEADER.pack(len(body), kind) + body
+
+def message_frame(kind, topic, data, qos):
+    topic = topic.encode()
+    return frame(kind, MESSAGE.pack(NO_QOS if qos is None else qos, len(topic)) + topic + (data or b''))
+
+def parse_message(body):
+    qos, length = MESSAGE.unpack_from(body)
+    start = MESSAGE.size
+    topic = body[start:start + length].decode()
+    return topic, body[start + length:], None if qos == NO_QOS else qos
+
+@asyncio.coroutine
+def drain(writer, lock):
+    """
+    Waits for the writer's buffer to empty.  Before Python 3.10 only one
+    coroutine at a time may wait on a writer's drain().
+    """
+    yield from lock.acquire()
+    try:
+        yield from writer.drain()
+    finally:
+        lock.release()
+
+@asyncio.coroutine
+def read_frame(reader):
+    """
+    Returns (kind, body), or (None, None) once the other end is gone.
+    """
+    try:
+        length, kind = HEADER.unpack((yield from reader.readexactly(HEADER.size)))
+        body = yield from reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None, None
+    return kind, body
+
+class BusHub(object):
+    """
+    The parent process's end of the bus: relays frames between the
+    workers connected to its unix socket.
+    """
+
+    class Peer(object):
+        def __init__(self, writer):
+            self.writer = writer
+            self.subscriptions = TopicTrie()
+            self.drain_lock = asyncio.Lock()
+
+    def __init__(self, sock, store=None):
+        self._sock = sock
+        self._store = store
+        self._server = None
+        self._peers = set()
+        # topic -> (data, qos)
+        self._retained = dict(store.items()) if store is not None else {}
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from asyncio.start_unix_server(self.serve, sock=self._sock)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        if self._store is not None:
+            self._store.close()
+
+    @asyncio.coroutine
+    def serve(self, reader, writer):
+        peer = BusHub.Peer(writer)
+
+        # Bring the worker's retained messages up to date before it
+        # starts accepting clients.
+        for topic, (data, qos) in self._retained.items():
+            writer.write(message_frame(RETAIN, topic, data, qos))
+        writer.write(frame(SYNCED))
+        self._peers.add(peer)
+
+        try:
+            while True:
+                kind, body = yield from read_frame(reader)
+                if kind is None:
+                    break
+                elif kind == SUBSCRIBE:
+                    peer.subscriptions.add(body.decode())
+                elif kind == UNSUBSCRIBE:
+                    peer.subscriptions.remove(body.decode())
+                elif kind == BROADCAST:
+                    topic = parse_message(body)[0]
+                    yield from self.relay(peer, kind, body,
+                                          [p for p in self._peers if p.subscriptions.match(topic)])
+                elif kind == RETAIN:
+                    self.retain(*parse_message(body))
+                    yield from self.relay(peer, kind, body, self._peers)
+        finally:
+            self._peers.discard(peer)
+            writer.close()
+
+    def retain(self, topic, data, qos):
+        if data:
+            self._retained[topic] = (data, qos)
+            if self._store is not None:
+                self._store.put(topic, data, qos)
+        else:
+            self._retained.pop(topic, None)
+            if self._store is not None:
+                self._store.remove(topic)
+
+    @asyncio.coroutine
+    def relay(self, source, kind, body, peers):
+        data = frame(kind, body)
+        for peer in peers:
+            if peer is not source:
+                peer.writer.write(data)
+                yield from drain(peer.writer, peer.drain_lock)
+
+class BusClient(object):
+    """
+    A worker's end of the bus, feeding what other workers publish into
+    its broker as if a local client had.
+    """
+
+    def __init__(self, broker, path, subscribe=()):
+        self._broker = broker
+        self._path = path
+        self._subscribe = tuple(subscribe)
+        self._writer = None
+        self._drain_lock = asyncio.Lock()
+        self._task = None
+
+    @asyncio.coroutine
+    def connect(self):
+        """
+        Connects and waits for the hub's retained messages.
+        """
+        reader, self._writer = yield from asyncio.open_unix_connection(self._path)
+        for a_filter in self._subscribe:
+            self.subscribe(a_filter)
+
+        while True:
+            kind, body = yield from read_frame(reader)
+            if kind is None:
+                raise ConnectionError("bus hub at %s closed the connection" % self._path)
+            if kind == SYNCED:
+                break
+            yield from self.receive(kind, body)
+
+        self._task = asyncio.ensure_future(self.run(reader))
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    def broadcast(self, topic, data, qos=None):
+        self._writer.write(message_frame(BROADCAST, topic, data, qos))
+
+    def retain(self, topic, data, qos=None):
+        self._writer.write(message_frame(RETAIN, topic, data, qos))
+
+    def subscribe(self, a_filter):
+        self._writer.write(frame(SUBSCRIBE, a_filter.encode()))
+
+    def unsubscribe(self, a_filter):
+        # The hub keeps one entry per filter, so the configured ones stay
+        # subscribed whichever local clients come and go.
+        if a_filter in self._subscribe:
+            return
+        self._writer.write(frame(UNSUBSCRIBE, a_filter.encode()))
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from drain(self._writer, self._drain_lock)
+
+    @asyncio.coroutine
+    def run(self, reader):
+        while True:
+            kind, body = yield from read_frame(reader)
+            if kind is None:
+                break
+            yield from self.receive(kind, body)
+
+        # Without the hub this worker's clients would only see each other.
+        self._broker.logger.error("Lost the bus hub at %s, stopping" % self._path)
+        self._broker._loop.stop()
+
+    @asyncio.coroutine
+    def receive(self, kind, body):
+        if kind == RETAIN:
+            topic, data, qos = parse_message(body)
+            self._broker.retain_message(None, topic, data, qos, forward=False)
+        elif kind == BROADCAST:
+            topic, data, qos = parse_message(body)
+            yield from self._broker._broadcast_message(None, topic, data, qos, forward=False)
+            # Plugins like the occupancy totals see it as if received here.
+            message = RetainedApplicationMessage(None, topic, data, qos)
+            yield from self._broker.plugins_manager.fire_event(EVENT_BROKER_MESSAGE_RECEIVED,
+                                                               client_id=None, message=message)
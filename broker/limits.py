@@ -0,0 +1,152 @@
+import asyncio
+import contextvars
+import time
+
+# The limits of the listener the current client connected through, set
+# for the client's tasks when it connects.
+current_limits = contextvars.ContextVar('current_limits', default=None)
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average and bursts of up to burst
+    events.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def reserve(self, max_delay):
+        """
+        Takes a token, possibly one that only becomes available in the
+        future.  Returns the delay until it does, or None, without taking
+        it, if that is longer than max_delay.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        delay = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+        if delay > max_delay:
+            return None
+        self._tokens -= 1
+        return delay
+
+class ListenerLimits(object):
+    """
+    Token-bucket limits on one listener: new connections per second, and
+    publishes per second for each client id.  Connections and publishes
+    over the limit wait for a token, or are shed (the connection closed,
+    the message dropped) when that would take longer than their
+    max_delay.  Publishes are delivered one at a time, so a client's
+    wait shows as its backlog of received messages; past max_delay's
+    worth, the oldest are dropped.  Only QoS 0 publishes that are not
+    retained are ever dropped: the others have already been acknowledged
+    to the client, or set the retained value, so they wait for their
+    token however long it takes.  A client's bucket is kept while it is
+    connected.
+
+    Listener config keys, each limit off unless its rate is set:
+        connect_rate, connect_burst, connect_max_delay
+        publish_rate, publish_burst, publish_max_delay
+    """
+
+    COUNTERS = ('connections/delayed', 'connections/shed', 'publish/delayed', 'publish/dropped')
+
+    def __init__(self, config):
+        self._connect = None
+        if config.get('connect_rate'):
+            self._connect = TokenBucket(config['connect_rate'], config.get('connect_burst', config['connect_rate']))
+        self._connect_max_delay = config.get('connect_max_delay', 10.0)
+
+        self._publish_rate = config.get('publish_rate')
+        self._publish_burst = config.get('publish_burst', self._publish_rate)
+        self._publish_max_delay = config.get('publish_max_delay', 1.0)
+        self._clients = {}
+
+        self.counters = {counter : 0 for counter in ListenerLimits.COUNTERS}
+
+    @property
+    def enabled(self):
+        return self._connect is not None or bool(self._publish_rate)
+
+    @asyncio.coroutine
+    def admit(self, bucket, max_delay, delayed, shed):
+        delay = bucket.reserve(max_delay)
+        if delay is None:
+            self.counters[shed] += 1
+            return False
+        if delay:
+            self.counters[delayed] += 1
+            yield from asyncio.sleep(delay)
+        return True
+
+    @asyncio.coroutine
+    def admit_connection(self):
+        if self._connect is None:
+            return True
+        return (yield from self.admit(self._connect, self._connect_max_delay,
+                                      'connections/delayed', 'connections/shed'))
+
+    @asyncio.coroutine
+    def admit_publish(self, client_id, backlog=0, droppable=True):
+        if not self._publish_rate:
+            return True
+        max_delay = self._publish_max_delay if droppable else float('inf')
+        if droppable and backlog > self._publish_rate * max_delay:
+            self.counters['publish/dropped'] += 1
+            return False
+        bucket = self._clients.get(client_id)
+        if bucket is None:
+            bucket = self._clients[client_id] = TokenBucket(self._publish_rate, self._publish_burst)
+        return (yield from self.admit(bucket, max_delay, 'publish/delayed', 'publish/dropped'))
+
+    def forget(self, client_id):
+        self._clients.pop(client_id, None)
+
+class LimitsPlugin:
+    """
+    Broker plugin holding the ListenerLimits of every listener and
+    publishing their counters every sys_interval seconds on
+    $SYS/broker/limits/<listener>/<counter>.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self._sys_handle = None
+
+        listeners = context.config.get('listeners', {})
+        defaults = listeners.get('default', {})
+        self.listeners = {}
+        for name, config in listeners.items():
+            limits = ListenerLimits(dict(defaults, **config))
+            if limits.enabled:
+                self.listeners[name] = limits
+
+    @asyncio.coroutine
+    def on_broker_post_start(self, *args, **kwargs):
+        sys_interval = int(self.context.config.get('sys_interval', 0))
+        if sys_interval > 0 and self.listeners:
+            self._sys_handle = self.context.loop.call_later(sys_interval, self.broadcast_counters)
+
+    @asyncio.coroutine
+    def on_broker_pre_shutdown(self, *args, **kwargs):
+        if self._sys_handle:
+            self._sys_handle.cancel()
+
+    @asyncio.coroutine
+    def on_broker_client_disconnected(self, client_id=None, *args, **kwargs):
+        for limits in self.listeners.values():
+            limits.forget(client_id)
+
+    def broadcast_counters(self):
+        for name, limits in self.listeners.items():
+            for counter, value in limits.counters.items():
+                topic = '$SYS/broker/limits/%s/%s'%(name, counter)
+                asyncio.ensure_future(self.context.broadcast_message(topic, str(value).encode()),
+                                      loop=self.context.loop)
+
+        sys_interval = int(self.context.config['sys_interval'])
+        self._sys_handle = self.context.loop.call_later(sys_interval, self.broadcast_counters)
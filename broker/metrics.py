@@ -0,0 +1,274 @@
+import asyncio
+import bisect
+
+# Upper bounds, in seconds, of the latency and loop lag histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, Prometheus style: a value
+    lands in the first bucket whose bound it doesn't exceed, or in the
+    last, unbounded one.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def quantile(self, q, since=None):
+        """
+        Returns the bound of the bucket holding the q quantile of the
+        observations made after the since snapshot of counts, None when
+        there are none.  Past the last bound it is infinite.
+        """
+        counts = self.counts
+        if since is not None:
+            counts = [n - s for n, s in zip(counts, since)]
+        total = sum(counts)
+        if not total:
+            return None
+
+        seen = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            seen += n
+            if seen >= q * total:
+                return bound
+
+    def exposition(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{%sle="%s"} %d'%(name, labels, le, cumulative))
+        lines.append('%s_sum %f'%(name, self.sum))
+        lines.append('%s_count %d'%(name, cumulative))
+        return lines
+
+def label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsPlugin:
+    """
+    Broker plugin measuring the broker's hot path:
+
+      - messages broadcast per topic prefix (the first prefix_levels
+        levels, e.g. sensors/<floor>),
+      - publish-to-deliver latency: from a message entering the
+        broadcast queue to its publish to a subscriber completing,
+        which for QoS 1 and 2 includes the subscriber's acknowledgment,
+      - the broadcast queue's depth and its peak,
+      - each session's outgoing queue: messages in flight to it plus
+        those queued while it is offline,
+      - event loop lag: how late a timer set every lag_interval fires.
+
+    Everything runs on the event loop, so the counters are plain ints
+    and dicts without locks, and only every sample_every-th message is
+    timed.  Every sys_interval the figures for the last interval are
+    retained on $SYS/broker/metrics/..., and with 'http' set to
+    [host:]port the running totals are served as Prometheus text on
+    /metrics.
+
+    Configured by the broker config's 'metrics' section: prefix_levels
+    (default 2), max_prefixes (default 256; more are counted as
+    '_other'), sample_every (default 16), lag_interval (seconds, default
+    0.5) and http (default off).
+    """
+
+    ROOT = '$SYS/broker/metrics/'
+
+    def __init__(self, context):
+        self.context = context
+        config = context.config.get('metrics', {})
+        self._prefix_levels = config.get('prefix_levels', 2)
+        self._max_prefixes = config.get('max_prefixes', 256)
+        self._sample_every = config.get('sample_every', 16)
+        self._lag_interval = config.get('lag_interval', 0.5)
+        self._http = config.get('http')
+
+        self.messages = {}
+        self.latency = Histogram()
+        self.lag = Histogram()
+        self.queue_peak = 0
+        self._broadcast_queue = None
+        self._sampled = 0
+
+        # Last report's message counts and histogram counts, and the
+        # sessions reported with a non-empty outgoing queue.
+        self._last_messages = {}
+        self._last_latency = None
+        self._last_report = None
+        self._max_lag = 0.0
+        self._backlogged = set()
+
+        self._lag_handle = None
+        self._sys_handle = None
+        self._server = None
+
+    def count(self, topic, depth):
+        """
+        Called as a message enters the broadcast queue of the given
+        depth.  Returns whether to time its delivery.
+        """
+        if depth > self.queue_peak:
+            self.queue_peak = depth
+        if topic.startswith('$'):
+            return False
+
+        prefix = '/'.join(topic.split('/', self._prefix_levels)[:self._prefix_levels])
+        if prefix not in self.messages and len(self.messages) >= self._max_prefixes:
+            prefix = '_other'
+        self.messages[prefix] = self.messages.get(prefix, 0) + 1
+
+        self._sampled += 1
+        if self._sampled < self._sample_every:
+            return False
+        self._sampled = 0
+        return True
+
+    def delivered(self, received, task):
+        if not task.cancelled() and task.exception() is None:
+            self.latency.observe(self.context.loop.time() - received)
+
+    def outgoing(self):
+        """
+        Returns {client_id: queued messages} for every session.
+        """
+        return {session.client_id : len(session.inflight_out) + session.retained_messages.qsize()
+                for session in self.context.sessions}
+
+    def queue_depth(self):
+        return self._broadcast_queue.qsize() if self._broadcast_queue is not None else 0
+
+    @asyncio.coroutine
+    def on_broker_post_start(self, *args, **kwargs):
+        loop = self.context.loop
+        self._broadcast_queue = self.context._broker_instance._broadcast_queue
+        self._last_report = loop.time()
+        self._last_latency = list(self.latency.counts)
+
+        self._lag_handle = loop.call_later(self._lag_interval, self.probe_lag, loop.time() + self._lag_interval)
+
+        sys_interval = int(self.context.config.get('sys_interval', 0))
+        if sys_interval > 0:
+            self._sys_handle = loop.call_later(sys_interval, self.report)
+
+        if self._http:
+            host, _, port = str(self._http).rpartition(':')
+            try:
+                self._server = yield from asyncio.start_server(self.serve_http, host or None, int(port))
+                self.context.logger.info("Serving metrics on %s" % self._http)
+            except (OSError, ValueError) as e:
+                self.context.logger.warning("Can't serve metrics on %s: %s" % (self._http, e))
+
+    @asyncio.coroutine
+    def on_broker_pre_shutdown(self, *args, **kwargs):
+        for handle in (self._lag_handle, self._sys_handle):
+            if handle is not None:
+                handle.cancel()
+        if self._server is not None:
+            self._server.close()
+
+    def probe_lag(self, expected):
+        loop = self.context.loop
+        lag = max(0.0, loop.time() - expected)
+        self.lag.observe(lag)
+        self._max_lag = max(self._max_lag, lag)
+        self._lag_handle = loop.call_later(self._lag_interval, self.probe_lag, loop.time() + self._lag_interval)
+
+    def publish(self, topic, value):
+        topic = MetricsPlugin.ROOT + topic
+        data = str(value).encode() if value is not None else b''
+        self.context.retain_message(topic, data)
+        asyncio.ensure_future(self.context.broadcast_message(topic, data), loop=self.context.loop)
+
+    def report(self):
+        loop = self.context.loop
+        now = loop.time()
+        elapsed = max(now - self._last_report, 1e-9)
+
+        for prefix, n in self.messages.items():
+            rate = (n - self._last_messages.get(prefix, 0)) / elapsed
+            self.publish('messages/%s/rate'%(prefix,), '%.2f'%(rate,))
+        self._last_messages = dict(self.messages)
+
+        for q in (0.5, 0.9, 0.99):
+            bound = self.latency.quantile(q, self._last_latency)
+            self.publish('latency/p%d'%(q * 100,), '%g'%(bound * 1000,) if bound is not None else '')
+        self.publish('latency/samples', self.latency.count - sum(self._last_latency))
+        self._last_latency = list(self.latency.counts)
+
+        self.publish('broadcast_queue/depth', self.queue_depth())
+        self.publish('broadcast_queue/peak', self.queue_peak)
+        self.queue_peak = self.queue_depth()
+
+        self.publish('loop_lag/max', '%.1f'%(self._max_lag * 1000,))
+        self._max_lag = 0.0
+
+        outgoing = self.outgoing()
+        self.publish('sessions/outgoing/total', sum(outgoing.values()))
+        self.publish('sessions/outgoing/max', max(outgoing.values(), default=0))
+        # Only sessions with something queued get a topic; it is cleared
+        # once their queue empties.
+        backlogged = {client_id for client_id, n in outgoing.items()
+                      if n and not set(client_id) & set('+#/')}
+        for client_id in backlogged:
+            self.publish('sessions/%s/outgoing'%(client_id,), outgoing[client_id])
+        for client_id in self._backlogged - backlogged:
+            self.publish('sessions/%s/outgoing'%(client_id,), None)
+        self._backlogged = backlogged
+
+        self._last_report = now
+        sys_interval = int(self.context.config['sys_interval'])
+        self._sys_handle = loop.call_later(sys_interval, self.report)
+
+    def exposition(self):
+        lines = ['# TYPE broker_messages_total counter']
+        for prefix, n in sorted(self.messages.items()):
+            lines.append('broker_messages_total{prefix="%s"} %d'%(label(prefix), n))
+
+        lines.append('# HELP broker_deliver_latency_seconds Sampled publish-to-deliver latency')
+        lines.append('# TYPE broker_deliver_latency_seconds histogram')
+        lines.extend(self.latency.exposition('broker_deliver_latency_seconds'))
+        lines.append('# TYPE broker_loop_lag_seconds histogram')
+        lines.extend(self.lag.exposition('broker_loop_lag_seconds'))
+
+        lines.append('# TYPE broker_broadcast_queue_depth gauge')
+        lines.append('broker_broadcast_queue_depth %d'%(self.queue_depth(),))
+        lines.append('# TYPE broker_session_outgoing gauge')
+        for client_id, n in sorted(self.outgoing().items()):
+            lines.append('broker_session_outgoing{client_id="%s"} %d'%(label(client_id), n))
+        return '\n'.join(lines) + '\n'
+
+    @asyncio.coroutine
+    def serve_http(self, reader, writer):
+        try:
+            request = yield from reader.readline()
+            # Skip the headers.
+            while (yield from reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.exposition().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(('HTTP/1.0 %s\r\n'
+                          'Content-Type: text/plain; version=0.0.4\r\n'
+                          'Content-Length: %d\r\n'
+                          '\r\n'%(status, len(body))).encode() + body)
+            yield from writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            # A scraper going away mid-request is nothing to warn about.
+            self.context.logger.debug("Metrics request failed: %s" % e)
+        finally:
+            writer.close()
@@ -25,6 +25,12 @@ from hbmqtt.adapters import (
     WebSocketsWriter)
 from hbmqtt.plugins.manager import PluginManager, BaseContext
 
+import topics
+from bus import BusClient
+from limits import current_limits
+from retained import RetainedStore
+from topics import TopicTrie
+
 
 # Monkeypatch the "start" method to correctly parse IPv6 addresses and ports
 @asyncio.coroutine
@@ -37,7 +43,10 @@ def broker_start_ipv6(self):
     try:
         self._sessions = dict()
         self._subscriptions = dict()
+        self._subscription_trie = TopicTrie()
         self._retained_messages = dict()
+        load_retained_messages(self)
+        self._metrics = broker_metrics(self)
         self.transitions.start()
         self.logger.debug("Broker starting")
     except (MachineError, ValueError) as exc:
@@ -45,6 +54,12 @@ def broker_start_ipv6(self):
         self.logger.warning("[WARN-0001] Invalid method call at this moment: %s" % exc)
         raise BrokerException("Broker instance can't be started: %s" % exc)
 
+    try:
+        yield from connect_bus(self)
+    except OSError as e:
+        self.transitions.starting_fail()
+        raise BrokerException("Broker instance can't join the bus: %s" % e)
+
     yield from self.plugins_manager.fire_event(EVENT_BROKER_PRE_START)
     try:
         # Start network listeners
@@ -97,13 +112,15 @@ def broker_start_ipv6(self):
                                                                address,
                                                                port,
                                                                reuse_address=True,
+                                                               reuse_port=listener.get('reuse_port', False),
                                                                ssl=sc,
                                                                loop=self._loop)
                     self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop)
                 elif listener['type'] == 'ws':
                     cb_partial = partial(self.ws_connected, listener_name=listener_name)
                     instance = yield from websockets.serve(cb_partial, address, port, ssl=sc, loop=self._loop,
-                                                           subprotocols=['mqtt'])
+                                                           subprotocols=['mqtt'],
+                                                           reuse_port=listener.get('reuse_port', False))
                     self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop)
 
                 self.logger.info("Listener '%s' bind to %s (max_connections=%d)" %
@@ -122,3 +139,202 @@ def broker_start_ipv6(self):
         raise BrokerException("Broker instance can't be started: %s" % e)
 
 hbmqtt.broker.Broker.start = broker_start_ipv6
+
+
+# Keep retained messages in an on-disk RetainedStore when the config has
+# a 'retained-store' section ({'path': ..., 'sync_interval': seconds}),
+# so they survive a broker restart.  $SYS topics are left out; the
+# broker publishes them afresh.
+def load_retained_messages(self):
+    config = self.config.get('retained-store')
+    if not config:
+        self._retained_store = None
+        return
+
+    if getattr(self, '_retained_store', None) is None:
+        self._retained_store = RetainedStore(**config)
+    for topic, (data, qos) in self._retained_store.items():
+        self._retained_messages[topic] = RetainedApplicationMessage(None, topic, data, qos)
+    self.logger.info("Loaded %d retained messages from %s" % (len(self._retained_messages), config.get('path')))
+
+_retain_message = hbmqtt.broker.Broker.retain_message
+
+def broker_retain_message(self, source_session, topic_name, data, qos=None, forward=True):
+    _retain_message(self, source_session, topic_name, data, qos)
+    if topic_name.startswith('$'):
+        return
+    if forward and self._bus is not None:
+        self._bus.retain(topic_name, data, qos)
+    if self._retained_store is None:
+        return
+    if data is not None and data != b'':
+        self._retained_store.put(topic_name, data, qos)
+    else:
+        self._retained_store.remove(topic_name)
+
+hbmqtt.broker.Broker.retain_message = broker_retain_message
+
+
+# With a 'bus' section in the config ({'path': unix socket, 'subscribe':
+# [filters]}) the broker is one of several worker processes and shares
+# its broadcasts, retained messages and subscriptions with the others
+# through the parent's bus hub (see bus.py).
+@asyncio.coroutine
+def connect_bus(self):
+    config = self.config.get('bus')
+    self._bus = None
+    if not config:
+        return
+
+    self._bus = BusClient(self, config['path'], config.get('subscribe', ()))
+    yield from self._bus.connect()
+    self.logger.info("Joined the bus at %s with %d retained messages" %
+                     (config['path'], len(self._retained_messages)))
+
+
+# Index the subscription filters in a topic trie, so a broadcast only
+# visits the filters that match its topic instead of testing every
+# filter's regex.  _subscriptions stays the map of filter to sessions.
+_add_subscription = hbmqtt.broker.Broker.add_subscription
+
+@asyncio.coroutine
+def broker_add_subscription(self, subscription, session):
+    qos = yield from _add_subscription(self, subscription, session)
+    if subscription[0] in self._subscriptions:
+        count = len(self._subscription_trie)
+        self._subscription_trie.add(subscription[0])
+        if self._bus is not None and len(self._subscription_trie) > count:
+            self._bus.subscribe(subscription[0])
+    return qos
+
+_del_subscription = hbmqtt.broker.Broker._del_subscription
+
+def broker_del_subscription(self, a_filter, session):
+    deleted = _del_subscription(self, a_filter, session)
+    if a_filter in self._subscriptions and not self._subscriptions[a_filter]:
+        del self._subscriptions[a_filter]
+        self._subscription_trie.remove(a_filter)
+        if self._bus is not None:
+            self._bus.unsubscribe(a_filter)
+    return deleted
+
+def broker_del_all_subscriptions(self, session):
+    for a_filter in list(self._subscriptions):
+        self._del_subscription(a_filter, session)
+
+@asyncio.coroutine
+def broker_broadcast_loop(self):
+    running_tasks = deque()
+    try:
+        while True:
+            while running_tasks and running_tasks[0].done():
+                running_tasks.popleft()
+            broadcast = yield from self._broadcast_queue.get()
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("broadcasting %r" % broadcast)
+            # The trie already keeps $ topics from + and # filters [MQTT-4.7.2-1].
+            for k_filter in self._subscription_trie.match(broadcast['topic']):
+                subscriptions = self._subscriptions[k_filter]
+                for (target_session, qos) in subscriptions:
+                    if 'qos' in broadcast:
+                        qos = broadcast['qos']
+                    if target_session.transitions.state == 'connected':
+                        self.logger.debug("broadcasting application message from %s on topic '%s' to %s" %
+                                          (format_client_message(session=broadcast['session']),
+                                           broadcast['topic'], format_client_message(session=target_session)))
+                        handler = self._get_handler(target_session)
+                        task = asyncio.ensure_future(
+                            handler.mqtt_publish(broadcast['topic'], broadcast['data'], qos, retain=False),
+                            loop=self._loop)
+                        running_tasks.append(task)
+                        if 'received' in broadcast:
+                            task.add_done_callback(partial(self._metrics.delivered, broadcast['received']))
+                    else:
+                        self.logger.debug("retaining application message from %s on topic '%s' to client '%s'" %
+                                          (format_client_message(session=broadcast['session']),
+                                           broadcast['topic'], format_client_message(session=target_session)))
+                        retained_message = RetainedApplicationMessage(
+                            broadcast['session'], broadcast['topic'], broadcast['data'], qos)
+                        yield from target_session.retained_messages.put(retained_message)
+    except CancelledError:
+        # Wait until current broadcasting tasks end
+        if running_tasks:
+            yield from asyncio.wait(running_tasks, loop=self._loop)
+
+# Count each broadcast for the metrics plugin (see metrics.MetricsPlugin),
+# stamping the ones it samples so the broadcast loop can time their
+# delivery.
+def broker_metrics(self):
+    plugin = self.plugins_manager.get_plugin('metrics')
+    return plugin.object if plugin else None
+
+@asyncio.coroutine
+def broker_broadcast_message(self, session, topic, data, force_qos=None, forward=True):
+    broadcast = {
+        'session': session,
+        'topic': topic,
+        'data': data
+    }
+    if force_qos:
+        broadcast['qos'] = force_qos
+    if self._metrics is not None and self._metrics.count(topic, self._broadcast_queue.qsize() + 1):
+        broadcast['received'] = self._loop.time()
+    if forward and self._bus is not None and not topic.startswith('$'):
+        self._bus.broadcast(topic, data, force_qos)
+        # A slow hub holds up the publisher instead of filling the buffer.
+        yield from self._bus.drain()
+    yield from self._broadcast_queue.put(broadcast)
+
+def broker_matches(self, topic, a_filter):
+    return topics.matches(topic, a_filter)
+
+hbmqtt.broker.Broker.add_subscription = broker_add_subscription
+hbmqtt.broker.Broker._del_subscription = broker_del_subscription
+hbmqtt.broker.Broker._del_all_subscriptions = broker_del_all_subscriptions
+hbmqtt.broker.Broker._broadcast_loop = broker_broadcast_loop
+hbmqtt.broker.Broker._broadcast_message = broker_broadcast_message
+hbmqtt.broker.Broker.matches = broker_matches
+
+
+# Admission control: a client connecting through a listener with limits
+# (see limits.LimitsPlugin) first waits for a connection token, and its
+# publishes for publish tokens.
+def listener_limits(self, listener_name):
+    plugin = self.plugins_manager.get_plugin('limits')
+    return plugin.object.listeners.get(listener_name) if plugin else None
+
+_client_connected = hbmqtt.broker.Broker.client_connected
+
+@asyncio.coroutine
+def broker_client_connected(self, listener_name, reader, writer):
+    limits = listener_limits(self, listener_name)
+    if limits is not None:
+        admitted = yield from limits.admit_connection()
+        if not admitted:
+            self.logger.debug("Connection on listener '%s' shed by the connect rate limit" % listener_name)
+            yield from writer.close()
+            return
+        # Seen by the client's tasks, which copy this task's context.
+        current_limits.set(limits)
+    yield from _client_connected(self, listener_name, reader, writer)
+
+_deliver_next_message = BrokerProtocolHandler.mqtt_deliver_next_message
+
+@asyncio.coroutine
+def handler_deliver_next_message(self):
+    limits = current_limits.get()
+    while True:
+        message = yield from _deliver_next_message(self)
+        if message is None or limits is None:
+            return message
+        # QoS 1 and 2 publishes have been acknowledged by now, and
+        # retained ones set the topic's retained value: those wait.
+        droppable = message.qos == 0 and not message.publish_packet.retain_flag
+        admitted = yield from limits.admit_publish(self.session.client_id,
+                                                   self.session.delivered_message_queue.qsize(),
+                                                   droppable)
+        if admitted:
+            return message
+
+hbmqtt.broker.Broker.client_connected = broker_client_connected
+BrokerProtocolHandler.mqtt_deliver_next_message = handler_deliver_next_message
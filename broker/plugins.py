@@ -0,0 +1,19 @@
+import copy
+
+from hbmqtt.plugins.manager import Plugin
+
+def register(broker, name, plugin_class):
+    """
+    Adds a plugin to a broker's plugin manager.
+
+    hbmqtt only finds plugins through setuptools entry points, which
+    this script-based broker doesn't have.  Call before broker.start()
+    so the plugin sees the start events.
+    """
+    manager = broker.plugins_manager
+    context = copy.copy(manager.app_context)
+    context.logger = manager.logger.getChild(name)
+
+    plugin = Plugin(name, None, plugin_class(context))
+    manager.plugins.append(plugin)
+    return plugin.object
@@ -0,0 +1,104 @@
+import atexit
+import base64
+import logging
+import threading
+
+from jsonlog import JsonLog
+
+logger = logging.getLogger(__name__)
+
+class RetainedStore(object):
+    """
+    Append-only log of the broker's retained messages, so they survive
+    a restart.
+
+    Retains and clears are applied in memory right away and written out
+    by a background thread every sync_interval seconds, keeping only the
+    latest per topic, so a burst of retained publishes costs one write
+    and one fsync.  The log (see jsonlog, shared with the dashboard's
+    LogStore) holds {"topic": ..., "data": base64, "qos": n} records, or
+    just {"topic": ...} for a cleared topic.
+    """
+
+    def __init__(self, path='retained.log', sync_interval=1.0, compact_ratio=4, compact_min=1000):
+        self._path = path
+        self._sync_interval = sync_interval
+        self._log = JsonLog(path, compact_ratio, compact_min)
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.RLock()
+        self._data = {}
+        self._dirty = {}
+
+        self.load()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="retained-sync", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        """
+        Returns (topic, (data, qos)) for every retained topic.
+        """
+        with self._lock:
+            return list(self._data.items())
+
+    def put(self, topic, data, qos):
+        with self._lock:
+            self._data[topic] = self._dirty[topic] = (data, qos)
+
+    def remove(self, topic):
+        with self._lock:
+            if self._data.pop(topic, None) is not None:
+                self._dirty[topic] = None
+
+    def load(self):
+        for record in self._log.load():
+            try:
+                if 'data' in record:
+                    self._data[record['topic']] = (base64.b64decode(record['data']), record['qos'])
+                else:
+                    self._data.pop(record['topic'], None)
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    @staticmethod
+    def record(topic, message):
+        if message is None:
+            return {'topic' : topic}
+        data, qos = message
+        return {'topic' : topic, 'data' : base64.b64encode(data).decode(), 'qos' : qos}
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+
+            self._log.append([self.record(topic, message) for topic, message in dirty.items()])
+            if self._log.needs_compaction(len(self._data)):
+                self.compact()
+
+    def compact(self):
+        with self._io_lock:
+            self._log.compact([self.record(topic, message) for topic, message in self.items()])
+
+    def run(self):
+        while not self._stopped.wait(self._sync_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Can't write retained messages to %s: %s" % (self._path, e))
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        self._log.close()
@@ -0,0 +1,163 @@
+class TopicTrie(object):
+    """
+    Subscription filters indexed level by level, so finding the filters
+    that match a topic only follows the branches for the topic's own
+    levels, '+' and '#', however many filters there are.
+
+    Matching follows MQTT 3.1.1: '+' matches exactly one level, '#'
+    matches the rest including the parent level, and neither matches a
+    first level starting with '$'.
+    """
+
+    class Node(object):
+        __slots__ = ('children', 'filter')
+
+        def __init__(self):
+            self.children = {}
+            self.filter = None
+
+    def __init__(self):
+        self._root = TopicTrie.Node()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, a_filter):
+        node = self._root
+        for level in a_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicTrie.Node()
+            node = child
+
+        if node.filter is None:
+            node.filter = a_filter
+            self._count += 1
+
+    def remove(self, a_filter):
+        path = [self._root]
+        for level in a_filter.split('/'):
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+
+        if path[-1].filter is None:
+            return
+        path[-1].filter = None
+        self._count -= 1
+
+        # Prune the branch back to the last node still in use.
+        levels = a_filter.split('/')
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.filter is not None or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def match(self, topic):
+        """
+        Returns the filters matching topic.
+        """
+        matches = []
+        nodes = [self._root]
+        levels = topic.split('/')
+        system = topic.startswith('$')
+
+        for i, level in enumerate(levels):
+            wildcards = not (i == 0 and system)
+            next = []
+            for node in nodes:
+                children = node.children
+                child = children.get(level)
+                if child is not None:
+                    next.append(child)
+                if wildcards:
+                    child = children.get('+')
+                    if child is not None:
+                        next.append(child)
+                    child = children.get('#')
+                    if child is not None:
+                        matches.append(child.filter)
+            nodes = next
+            if not nodes:
+                return matches
+
+        for node in nodes:
+            if node.filter is not None:
+                matches.append(node.filter)
+            # 'a/#' also matches 'a' itself.
+            child = node.children.get('#')
+            if child is not None:
+                matches.append(child.filter)
+        return matches
+
+def matches(topic, a_filter):
+    """
+    Whether a single filter matches topic, with the TopicTrie's rules.
+    """
+    if '#' not in a_filter and '+' not in a_filter:
+        return a_filter == topic
+
+    levels = topic.split('/')
+    for i, part in enumerate(a_filter.split('/')):
+        if part == '#':
+            return not (i == 0 and topic.startswith('$'))
+        if i >= len(levels):
+            return False
+        if part == '+':
+            if i == 0 and topic.startswith('$'):
+                return False
+        elif part != levels[i]:
+            return False
+    return len(levels) == len(a_filter.split('/'))
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import time
+
+    from hbmqtt.broker import Broker
+
+    parser = argparse.ArgumentParser(description="Compare subscription matching by regex scan and by topic trie")
+    parser.add_argument("-t", "--topics", help="Number of distinct sensor topics", type=int, default=10000)
+    parser.add_argument("-s", "--subscribers", help="Number of wildcard subscribers", type=int, default=300)
+    parser.add_argument("--floors", help="Number of floors the sensors are spread over", type=int, default=50)
+    parser.add_argument("-n", "--messages", help="Messages to route per measurement", type=int, default=2000)
+
+    args = parser.parse_args()
+
+    sensors = [(i % args.floors, i) for i in range(args.topics)]
+    topics = ['sensors/%d/%d/occupancy/cur'%(floor, room) for floor, room in sensors]
+
+    # Every sensor subscribes to its own max; the rest watch whole
+    # floors, everything, or the totals.
+    filters = ['sensors/%d/%d/occupancy/max'%(floor, room) for floor, room in sensors]
+    for i in range(args.subscribers):
+        filters.append(random.choice(['sensors/+/+/occupancy/cur',
+                                      'sensors/%d/+/occupancy/cur'%(random.randrange(args.floors),),
+                                      'sensors/%d/#'%(random.randrange(args.floors),),
+                                      'sensors/+/occupancy/total',
+                                      '$SYS/#']))
+    filters = sorted(set(filters))
+
+    trie = TopicTrie()
+    for a_filter in filters:
+        trie.add(a_filter)
+
+    def scan(topic):
+        return [f for f in filters
+                if not (topic.startswith('$') and f[0] in '+#') and Broker.matches(None, topic, f)]
+
+    sample = [random.choice(topics) for _ in range(args.messages)]
+    for topic in sample[:100]:
+        assert sorted(scan(topic)) == sorted(trie.match(topic)), topic
+
+    print("%d filters, %d topics"%(len(filters), len(topics)))
+    for name, match in (('scan', scan), ('trie', trie.match)):
+        start = time.perf_counter()
+        for topic in sample:
+            match(topic)
+        elapsed = time.perf_counter() - start
+        print("%-5s %10.1f us/message"%(name, elapsed / len(sample) * 1e6))
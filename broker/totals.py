@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+import codec
+
+class OccupancyTotals:
+    """
+    Broker plugin that keeps running occupancy sums per floor and for
+    the whole building as sensors publish, and republishes them on
+    retained topics:
+
+        sensors/<floor>/occupancy/total
+        sensors/occupancy/total
+
+    as {"value": occupancy, "max": capacity, "rooms": n}.  Each update
+    only adjusts the sums by the room's change, and totals go out at most
+    once per interval, so a display subscribes to one topic instead of
+    every sensor's.
+
+    Configured by the broker config's 'occupancy-totals' section:
+    'interval' (seconds, default 1) and 'qos', the QoS the totals are
+    retained at, so persistent sessions that were offline get them at
+    that QoS.  It defaults to, and is capped by, the broker's 'max-qos'
+    (2 if unset); live deliveries go at each subscription's QoS.
+    """
+
+    PREFIX = 'sensors'
+
+    def __init__(self, context):
+        self.context = context
+        config = context.config.get('occupancy-totals', {})
+        self._interval = config.get('interval', 1.0)
+        max_qos = context.config.get('max-qos', 2)
+        self._qos = min(config.get('qos', max_qos), max_qos)
+
+        # (floor, room) -> {'value': n, 'max': n}
+        self._rooms = {}
+        # floor -> {'value': n, 'max': n, 'rooms': n}; None is the building.
+        self._totals = {}
+        self._dirty = set()
+
+        self._last = 0.0
+        self._handle = None
+
+    @asyncio.coroutine
+    def on_broker_post_start(self, *args, **kwargs):
+        # Start from the retained messages restored from disk, if any.
+        for topic, message in list(self.context.retained_messages.items()):
+            self.observe(topic, message.data)
+
+    @asyncio.coroutine
+    def on_broker_message_received(self, *args, **kwargs):
+        message = kwargs['message']
+        self.observe(message.topic, message.data)
+
+    def observe(self, topic, data):
+        parts = topic.split('/')
+        if len(parts) != 5 or parts[0] != OccupancyTotals.PREFIX or parts[3] != 'occupancy':
+            return
+        if parts[4] not in ('cur', 'max'):
+            return
+
+        key = 'value' if parts[4] == 'cur' else 'max'
+        if data:
+            try:
+                value = codec.decode(data)['value'] or 0
+            except (ValueError, KeyError, TypeError) as e:
+                self.context.logger.warning("bad occupancy payload on %s: %s"%(topic, e))
+                return
+        else:
+            # An empty retained message clears the room.
+            value = 0
+
+        self.update(parts[1], parts[2], key, value)
+
+    def update(self, floor, room, key, value):
+        state = self._rooms.get((floor, room))
+        if state is None:
+            state = self._rooms[(floor, room)] = {'value' : 0, 'max' : 0}
+            for total in (self.total(floor), self.total(None)):
+                total['rooms'] += 1
+
+        delta = value - state[key]
+        if not delta:
+            return
+        state[key] = value
+
+        for total in (self.total(floor), self.total(None)):
+            total[key] += delta
+        self._dirty.update((floor, None))
+        self.schedule()
+
+    def total(self, floor):
+        total = self._totals.get(floor)
+        if total is None:
+            total = self._totals[floor] = {'value' : 0, 'max' : 0, 'rooms' : 0}
+        return total
+
+    def topic(self, floor):
+        if floor is None:
+            return '%s/occupancy/total'%(OccupancyTotals.PREFIX,)
+        return '%s/%s/occupancy/total'%(OccupancyTotals.PREFIX, floor)
+
+    def schedule(self):
+        if self._handle is not None:
+            return
+        loop = self.context.loop
+        delay = max(0.0, self._last + self._interval - loop.time())
+        self._handle = loop.call_later(delay, self.flush)
+
+    def flush(self):
+        self._handle = None
+        self._last = self.context.loop.time()
+
+        dirty, self._dirty = self._dirty, set()
+        for floor in dirty:
+            topic = self.topic(floor)
+            data = json.dumps(self._totals[floor]).encode()
+            self.context.retain_message(topic, data, self._qos)
+            asyncio.ensure_future(self.context.broadcast_message(topic, data, self._qos),
+                                  loop=self.context.loop)
+
+    @asyncio.coroutine
+    def on_broker_pre_shutdown(self, *args, **kwargs):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
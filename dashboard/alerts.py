@@ -0,0 +1,247 @@
+import abc
+import heapq
+import itertools
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+class Rule(abc.ABC):
+    """
+    A condition on the occupancy of a room, or the total of a floor,
+    that raises an alert once it has held for duration seconds and
+    clears it when it stops holding.
+    """
+
+    ROOM = 'room'
+    FLOOR = 'floor'
+
+    def __init__(self, name, scope=ROOM, duration=0.0):
+        self.name = name
+        self.scope = scope
+        self.duration = duration
+
+    @abc.abstractmethod
+    def test(self, key, value, max):
+        pass
+
+class OverCapacity(Rule):
+
+    def __init__(self):
+        super().__init__('over-capacity')
+
+    def test(self, key, value, max):
+        return value > max
+
+class Sustained(Rule):
+    """
+    A room at or above fraction of its max for duration seconds.
+    """
+
+    def __init__(self, fraction=0.9, duration=600.0):
+        super().__init__('sustained', Rule.ROOM, duration)
+        self.fraction = fraction
+
+    def test(self, key, value, max):
+        return max > 0 and value >= self.fraction * max
+
+class FloorLimit(Rule):
+    """
+    A floor's total occupancy over its limit, from limits by floor or
+    else default.
+    """
+
+    def __init__(self, limits=None, default=None):
+        super().__init__('floor-limit', Rule.FLOOR)
+        self.limits = limits or {}
+        self.default = default
+
+    def test(self, key, value, max):
+        limit = self.limits.get(key, self.default)
+        return limit is not None and value > limit
+
+def floor_limit(text):
+    """
+    Parses a [floor=]limit option into (floor, limit), floor None for
+    the default.
+    """
+    floor, _, limit = text.rpartition('=')
+    return floor or None, int(limit)
+
+def default_rules(fraction=0.9, minutes=10.0, floor_limits=None):
+    rules = [OverCapacity()]
+    if minutes > 0:
+        rules.append(Sustained(fraction, minutes * 60))
+    if floor_limits:
+        limits = dict(floor_limits)
+        rules.append(FloorLimit(limits, limits.pop(None, None)))
+    return rules
+
+class AlertEngine(object):
+    """
+    Evaluates alert rules as room occupancies change.
+
+    Each update only tests the rules against the changed room and its
+    floor, whose total is kept up to date by the room's change.  Every
+    (rule, room or floor) remembers since when its condition has held;
+    rules with a duration put a deadline on a heap, which a background
+    thread checks every interval seconds, so a room that stays busy
+    without further updates still raises its alert.
+
+    Alerts go to publish(topic, payload) as JSON on
+    <topic>/<floor>/<room>/<rule>, or <topic>/<floor>/<rule> for floor
+    rules, at most rate per second on average.  Over that, the pending
+    alert of each (rule, room) is replaced by its latest, and one that
+    ends in the state last published isn't sent at all, so a flapping
+    room costs a single alert.
+    """
+
+    def __init__(self, publish, rules, rate=20.0, burst=None, topic='alerts', interval=1.0):
+        self._publish = publish
+        self._room_rules = [rule for rule in rules if rule.scope == Rule.ROOM]
+        self._floor_rules = [rule for rule in rules if rule.scope == Rule.FLOOR]
+        self._rate = rate
+        self._burst = burst or max(rate, 1.0)
+        self._topic = topic
+
+        self._lock = threading.Lock()
+        # room id -> (value, max); floor -> [total value, total max]
+        self._rooms = {}
+        self._floors = {}
+        # (rule, key) -> time its condition started holding
+        self._since = {}
+        self._active = set()
+        self._deadlines = []
+        self._order = itertools.count()
+
+        self._pending = OrderedDict()
+        self._published = {}
+        self._tokens = self._burst
+        self._last = time.monotonic()
+
+        self.updates = 0
+        self.raised = 0
+        self.cleared = 0
+        self.sent = 0
+        self.coalesced = 0
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, args=(interval,), name="alerts", daemon=True)
+        self._thread.start()
+
+    def update(self, id, value, max):
+        now = time.time()
+        with self._lock:
+            self.updates += 1
+            old_value, old_max = self._rooms.get(id, (0, 0))
+            self._rooms[id] = (value, max)
+
+            for rule in self._room_rules:
+                self.evaluate(rule, id, value, max, now)
+
+            if self._floor_rules and (value != old_value or max != old_max):
+                total = self._floors.setdefault(id.floor, [0, 0])
+                total[0] += value - old_value
+                total[1] += max - old_max
+                for rule in self._floor_rules:
+                    self.evaluate(rule, id.floor, total[0], total[1], now)
+
+        self.flush()
+
+    def evaluate(self, rule, key, value, max, now):
+        k = (rule, key)
+        if rule.test(key, value, max):
+            if k in self._since:
+                return
+            self._since[k] = now
+            if rule.duration:
+                heapq.heappush(self._deadlines, (now + rule.duration, next(self._order), k, now))
+            else:
+                self.emit(k, 'raised', value, max, now)
+        elif self._since.pop(k, None) is not None and k in self._active:
+            self.emit(k, 'cleared', value, max, now)
+
+    def expire(self, now):
+        """
+        Raises the alerts whose condition has held for their duration.
+        """
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, k, since = heapq.heappop(self._deadlines)
+            if self._since.get(k) != since or k in self._active:
+                continue
+            rule, key = k
+            if rule.scope == Rule.ROOM:
+                value, max = self._rooms[key]
+            else:
+                value, max = self._floors[key]
+            self.emit(k, 'raised', value, max, now)
+
+    def emit(self, k, state, value, max, now):
+        rule, key = k
+        if state == 'raised':
+            self._active.add(k)
+            self.raised += 1
+        else:
+            self._active.discard(k)
+            self.cleared += 1
+
+        if rule.scope == Rule.ROOM:
+            topic = '%s/%s/%s/%s'%(self._topic, key.floor, key.room, rule.name)
+            alert = {'rule' : rule.name, 'floor' : key.floor, 'room' : key.room}
+        else:
+            topic = '%s/%s/%s'%(self._topic, key, rule.name)
+            alert = {'rule' : rule.name, 'floor' : key}
+        alert.update({'state' : state, 'value' : value, 'max' : max, 'ts' : now})
+
+        if k in self._pending:
+            self.coalesced += 1
+        self._pending[k] = (topic, alert)
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        sends = []
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+
+            while self._pending and self._tokens >= 1:
+                k, (topic, alert) = self._pending.popitem(last=False)
+                if self._published.get(k, 'cleared') == alert['state']:
+                    continue
+                self._published[k] = alert['state']
+                self._tokens -= 1
+                sends.append((topic, alert))
+            self.sent += len(sends)
+
+        for topic, alert in sends:
+            try:
+                self._publish(topic, json.dumps(alert))
+            except Exception as e:
+                print(e)
+
+    def run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                with self._lock:
+                    self.expire(time.time())
+                self.flush()
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {'updates'   : self.updates,
+                    'active'    : len(self._active),
+                    'raised'    : self.raised,
+                    'cleared'   : self.cleared,
+                    'sent'      : self.sent,
+                    'coalesced' : self.coalesced,
+                    'pending'   : len(self._pending)}
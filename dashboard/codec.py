@@ -0,0 +1,85 @@
+"""
+Occupancy payload encodings.
+
+Updates are a {"value": n} dict, optionally with the sensor's "seq"
+and publish time "ts".  They travel either as JSON or as a fixed
+little-endian struct whose first byte says which struct follows.  A
+JSON payload always starts with '{', so decode() tells the two apart
+by the first byte and both can share a topic.  A payload neither
+encoding can read raises ValueError.
+
+The broker, dashboard and sensor each ship a copy of this module; the
+copies must stay identical, which tests/test_codec.py checks.
+"""
+
+import json
+import struct
+
+JSON = 'json'
+BINARY = 'binary'
+
+FORMATS = (JSON, BINARY)
+
+# Header byte, then seq, value and, with a timestamp, ts.
+COUNT = struct.Struct('<BQi')
+STAMPED = struct.Struct('<BQid')
+
+COUNT_TAG = 1
+STAMPED_TAG = 2
+
+def encode(state, format=JSON):
+    if format == JSON:
+        return json.dumps(state)
+    if format != BINARY:
+        raise ValueError("unknown payload format '%s'"%(format,))
+
+    if 'ts' in state:
+        return STAMPED.pack(STAMPED_TAG, state.get('seq', 0), state['value'], state['ts'])
+    return COUNT.pack(COUNT_TAG, state.get('seq', 0), state['value'])
+
+def decode(payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+
+    tag = payload[0] if payload else None
+    try:
+        if tag == COUNT_TAG:
+            _, seq, value = COUNT.unpack(payload)
+            state = {'value' : value}
+        elif tag == STAMPED_TAG:
+            _, seq, value, ts = STAMPED.unpack(payload)
+            state = {'value' : value, 'ts' : ts}
+        else:
+            return json.loads(payload)
+    except struct.error as e:
+        raise ValueError("bad binary occupancy payload: %s"%(e,))
+
+    # Unnumbered updates, like the dashboard's max, go out with seq 0.
+    if seq:
+        state['seq'] = seq
+    return state
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import timeit
+
+    parser = argparse.ArgumentParser(description="Compare the occupancy payload encodings")
+    parser.add_argument("-n", "--number", help="Encodes/decodes per measurement", type=int, default=200000)
+
+    args = parser.parse_args()
+
+    samples = {'count'   : {'value' : 17, 'seq' : int(time.time() * 1000)},
+               'stamped' : {'value' : 17, 'seq' : int(time.time() * 1000), 'ts' : time.time()}}
+
+    print("%-8s %-7s %6s %12s %12s"%("payload", "format", "bytes", "encode us", "decode us"))
+    for name, state in samples.items():
+        for format in FORMATS:
+            payload = encode(state, format)
+            size = len(payload.encode() if isinstance(payload, str) else payload)
+            assert decode(payload) == state
+
+            enc = min(timeit.repeat(lambda: encode(state, format), number=args.number, repeat=3))
+            dec = min(timeit.repeat(lambda: decode(payload), number=args.number, repeat=3))
+            print("%-8s %-7s %6d %12.2f %12.2f"%(name, format, size,
+                                               enc / args.number * 1e6, dec / args.number * 1e6))
@@ -1,30 +1,48 @@
 import json
-import re
+import threading
+import time
 
-from collections import namedtuple
+from collections import deque, namedtuple
 
 import dash_devices
-from dash_devices.dependencies import Input, Output, State
+from dash_devices.dependencies import ALL, MATCH, Input, Output, State
+from dash_devices.exceptions import PreventUpdate
 
 import dash_daq as daq
 import dash_bootstrap_components as dbc
+import dash_core_components as dcc
 import dash_html_components as html
 
 import paho.mqtt.client as paho
 
-import pickledb
+import quart
+
+import codec
+from alerts import AlertEngine, default_rules, floor_limit
+from history import History
+from ingest import Ingest, IngestQueue, Latency
+from render import FragmentCache, Rendered, to_json
+from shared import Follower, RoomTable, TableStore
+from store import BACKENDS, open_store
+from topics import TopicRouter
 
 class RoomView(dbc.Card):
 
     @staticmethod
-    def make(monitor, room):
-        view = RoomView(monitor, room)
+    def register(monitor):
+        """
+        Registers the callbacks shared by every RoomView.  Components are
+        keyed by {'type': ..., 'room': str(Room.Id)}, so adding a room
+        does not add callbacks.
+        """
 
         @monitor.view.callback(
-            Output(view.tank.id, 'max'),
-            [Input(view.input.id, 'value')])
-        def update_max(value):
+            Output(RoomView.component_id('tank', MATCH), 'max'),
+            [Input(RoomView.component_id('input', MATCH), 'value')],
+            [State(RoomView.component_id('input', MATCH), 'id')])
+        def update_max(value, id):
             try:
+                room = monitor.get_room(Room.Id.from_str(id['room']))
                 room.occupancy_max = value
                 return room.occupancy_max
             except Exception as e:
@@ -43,9 +61,9 @@ class RoomView(dbc.Card):
                 }
             }
             """,
-            Output(view.tank.id, 'color'),
-            [Input(view.tank.id, 'value'),
-             Input(view.tank.id, 'max')]
+            Output(RoomView.component_id('tank', MATCH), 'color'),
+            [Input(RoomView.component_id('tank', MATCH), 'value'),
+             Input(RoomView.component_id('tank', MATCH), 'max')]
         )
 
         monitor.view.clientside_callback(
@@ -54,12 +72,42 @@ class RoomView(dbc.Card):
                 return value + "/" + max + " people"
             }
             """,
-            Output(view.label.id, 'children'),
-            [Input(view.tank.id, 'value'),
-             Input(view.tank.id, 'max')]
+            Output(RoomView.component_id('label', MATCH), 'children'),
+            [Input(RoomView.component_id('tank', MATCH), 'value'),
+             Input(RoomView.component_id('tank', MATCH), 'max')]
         )
 
-        return view
+        # The browser side of dash_devices can only push to string ids,
+        # so updates arrive as {room: {'value': .., 'max': ..}} in the
+        # 'occupancy' store and are fanned out to the cards shown.  A new
+        # max goes to the input, which updates the tank through
+        # update_max.
+        monitor.view.clientside_callback(
+            """
+            function(data, tanks, inputs) {
+                data = data || {};
+                function pick(ids, prop) {
+                    return ids.map(function(id) {
+                        var room = data[id.room];
+                        if (room && prop in room) {
+                            return room[prop];
+                        }
+                        return window.dash_clientside.no_update;
+                    });
+                }
+                return [pick(tanks, 'value'), pick(inputs, 'max')];
+            }
+            """,
+            [Output(RoomView.component_id('tank', ALL), 'value'),
+             Output(RoomView.component_id('input', ALL), 'value')],
+            [Input(Monitor.STORE_ID, 'data')],
+            [State(RoomView.component_id('tank', ALL), 'id'),
+             State(RoomView.component_id('input', ALL), 'id')]
+        )
+
+    @staticmethod
+    def component_id(type, room):
+        return {'type' : type, 'room' : room}
 
     TANK_STYLE = {'marginLeft': '1em',
                   'marginTop' : '1.5em',
@@ -72,12 +120,12 @@ class RoomView(dbc.Card):
         self.room= room
 
         self.title = html.H5(room.name, className='card-title')
-        self.tank  = daq.Tank(id='tank-%s'%(room.id,),
+        self.tank  = daq.Tank(id=RoomView.component_id('tank', str(room.id)),
                               style=RoomView.TANK_STYLE, scale={'interval': 1},
                               min=0, value=room.occupancy_cur, max=self.room.occupancy_max)
-        self.label = html.P(id='label-%s'%(room.id,),
+        self.label = html.P(id=RoomView.component_id('label', str(room.id)),
                             children="0/0 people")
-        self.input = daq.NumericInput(id='input-%s'%(room.id,),
+        self.input = daq.NumericInput(id=RoomView.component_id('input', str(room.id)),
                                       min=1, value=room.occupancy_max,
                                       label='Max', labelPosition='top')
 
@@ -113,8 +161,12 @@ class Room(object):
         self._id = id
         self._occupancy_max = monitor.db.get(str(id)) or 1
         self._occupancy_cur = 0
+        self._version = 0
+
+        # Sequence number of the sensor's last applied update.
+        self.seq = None
 
-        self._view = RoomView.make(monitor, self)
+        self._view = RoomView(monitor, self)
 
     @property
     def id(self):
@@ -128,6 +180,14 @@ class Room(object):
     def view(self):
         return self._view
 
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def state(self):
+        return {'value' : self._occupancy_cur, 'max' : self._occupancy_max}
+
     @property
     def occupancy_max(self):
         return self._occupancy_max
@@ -139,16 +199,16 @@ class Room(object):
 
         self._occupancy_max = value
         self._monitor.db.set(str(self.id), value)
-        self._monitor.db.dump()
 
         self.view.input.value = value
         self.view.tank.max = value
         self.view.update_color()
+        self._monitor.cards.invalidate(self.id)
+
+        if self._monitor.alerts is not None:
+            self._monitor.alerts.update(self.id, self._occupancy_cur, value)
 
-        self._monitor.view.push_mods({
-            self.view.input.id : {'value' : value},
-            self.view.tank.id : {'max' : value}
-        })
+        self._version = self._monitor.push_state(self.id, {'max' : value})
 
         self._monitor.proto.publish_max(self.id, value)
 
@@ -162,30 +222,40 @@ class Room(object):
 
         self.view.tank.value = value
         self.view.update_color()
+        self._monitor.cards.invalidate(self.id)
 
-        self._monitor.view.push_mods({
-            self.view.tank.id : {'value' : value}
-        })
+        if self._monitor.alerts is not None:
+            self._monitor.alerts.update(self.id, value, self._occupancy_max)
 
-class Protocol(object):
+        self._version = self._monitor.push_state(self.id, {'value' : value})
 
-    @staticmethod
-    def roomid_from_topic(topic):
-        pattern = r"sensors/(\w+)/(\w+)/occupancy/cur"
-        floor, room = re.match(pattern, topic).groups()
-        return Room.Id(floor, room)
+class Protocol(object):
 
-    def __init__(self, broker, monitor):
+    def __init__(self, broker, monitor, workers=1, queue_size=10000, policy=IngestQueue.COLLAPSE,
+                 routes=TopicRouter.ROUTES, max_format=codec.JSON, connect=True):
         self._broker = broker
         self._monitor = monitor
+        self._max_format = max_format
 
         self._name = "backend"
 
-        self._client = paho.Client(self._name, False)
-        self._client.on_connect = self.on_connect
-        self._client.on_message = self.on_message
+        self.router = TopicRouter(Room.Id, routes)
+
+        self.ingest = Ingest(self.handle_message, workers, queue_size, policy)
+        self.e2e = Latency()
+        self.stale = 0
 
-        self.start()
+        # Per-stage timings of handle_message, when profiling.
+        self.stages = None
+
+        # Without connecting, as when replaying a recording, there is no
+        # client and what would be published is dropped.
+        self._client = None
+        if connect:
+            self._client = paho.Client(self._name, False)
+            self._client.on_connect = self.on_connect
+            self._client.on_message = self.on_message
+            self.start()
 
     def start(self):
         host, port = self._broker.rsplit(':', 1)
@@ -194,60 +264,601 @@ class Protocol(object):
         self._client.loop_start()
 
     def on_connect(self, client, userdata, flags, rc):
-        topic = self._topic = "sensors/+/+/occupancy/cur"
-        self._client.subscribe(topic)
+        self._client.subscribe([(topic, 0) for topic in self.router.filters])
 
     def on_message(self, client, userdata, msg):
-        try:
-            room = self._monitor.ensure_room(Protocol.roomid_from_topic(msg.topic))
-            room.occupancy_cur = json.loads(msg.payload)['value']
-        except Exception as e:
-            print(e)
-            raise(e)
+        self.ingest.submit(msg.topic, msg.payload)
+
+    def handle_message(self, topic, payload):
+        # An empty retained message clears the topic; it isn't an update.
+        if not payload:
+            return
+
+        stages = self.stages
+        if stages is not None:
+            start = time.perf_counter()
+
+        # Decoded first, so a bad payload on a new topic creates no room.
+        payload = codec.decode(payload)
+        if not isinstance(payload, dict) or 'value' not in payload:
+            raise ValueError("%s: not an occupancy update: %r"%(topic, payload))
+        if stages is not None:
+            decoded = time.perf_counter()
+            stages['decode'].record(decoded - start)
+
+        room = self._monitor.ensure_room(self.router.route(topic))
+        if stages is not None:
+            routed = time.perf_counter()
+            stages['route'].record(routed - decoded)
+
+        # Sensors number their updates; drop any that arrive after a newer one.
+        seq = payload.get('seq')
+        if seq is not None:
+            if room.seq is not None and seq <= room.seq:
+                self.stale += 1
+                return
+            room.seq = seq
+
+        room.occupancy_cur = value = payload['value']
+        self._monitor.history.add(room.id, value)
+        if stages is not None:
+            stages['update'].record(time.perf_counter() - routed)
+
+        # Sensors run by the load generator stamp their publish time.
+        if 'ts' in payload:
+            self.e2e.record(time.time() - payload['ts'])
+
+    def stats(self):
+        return {'ingest' : self.ingest.stats(),
+                'stale'  : self.stale,
+                'e2e'    : self.e2e.stats()}
 
     def publish_max(self, id, max):
-        topic = "sensors/%s/%s/occupancy/max"%(id.floor, id.room)
+        if self._client is None:
+            return
+        topic = self.router.topic(id, "max")
         payload = {"value" : max}
-        self._client.publish(topic, json.dumps(payload), qos=1, retain=True)
+        self._client.publish(topic, codec.encode(payload, self._max_format), qos=1, retain=True)
+
+    def publish_alert(self, topic, payload):
+        if self._client is None:
+            return
+        self._client.publish(topic, payload, qos=1)
+
+
+class PushBatcher(object):
+    """
+    Coalesces room state updates and sends them to the browsers as one
+    push_mods() per window.  Only the latest value of each property is
+    kept, so a room that changes several times within a window costs a
+    single update.
+
+    A browser receives only the rooms it subscribed to, as
+    {str(room): state} in the data of the store component, along with
+    the journal version the update brings it to.
+    """
+
+    def __init__(self, view, store, version_store, interval=0.1):
+        self._view = view
+        self._store = store
+        self._version_store = version_store
+        self._interval = interval
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._version = 0
+        self._subscriptions = {}
+
+        self.received = 0
+        self.pushed = 0
+        self.frames = 0
+
+        # Timing of each push_mods(), when profiling.
+        self.latency = None
+
+        self._stopped = threading.Event()
+        self._thread = None
+        if self._interval > 0:
+            self._thread = threading.Thread(target=self.run, name="push-batcher", daemon=True)
+            self._thread.start()
+
+    def subscribe(self, client, rooms):
+        with self._lock:
+            self._subscriptions[client] = frozenset(rooms)
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._subscriptions.pop(client, None)
+
+    def is_subscribed(self, client):
+        return client in self._subscriptions
+
+    def push(self, room, state, version):
+        with self._lock:
+            self.received += 1
+            self._pending.setdefault(room, {}).update(state)
+            self._version = max(self._version, version)
+
+        if self._thread is None:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            version = self._version
+            subscriptions = list(self._subscriptions.items())
+        if not pending:
+            return
+
+        # Nothing to push to until the first browser connects; the
+        # component state is already in the layout it will be served.
+        if self._view.pusher.loop is None:
+            return
+
+        for client, rooms in subscriptions:
+            data = {str(room) : pending[room] for room in rooms.intersection(pending)}
+            if data:
+                self.send(data, version, client)
 
+    def send(self, data, version, client):
+        start = time.perf_counter()
+        try:
+            self._view.push_mods({self._store         : {'data' : data},
+                                  self._version_store : {'data' : version}}, client)
+        except Exception as e:
+            print(e)
+            return
+        if self.latency is not None:
+            self.latency.record(time.perf_counter() - start)
+
+        with self._lock:
+            self.pushed += len(data)
+            self.frames += 1
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'received' : self.received,
+                    'pushed'   : self.pushed,
+                    'frames'   : self.frames,
+                    'pending'  : len(self._pending),
+                    'clients'  : len(self._subscriptions)}
+
+class Journal(object):
+    """
+    Bounded log of which room changed at which version.  Versions
+    increase monotonically across all rooms, so a browser that knows the
+    last version it saw can be sent only the rooms changed since.
+    """
+
+    def __init__(self, size=10000):
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=size)
+        self.version = 0
+
+    def record(self, room):
+        with self._lock:
+            self.version += 1
+            self._entries.append((self.version, room))
+            return self.version
+
+    def since(self, version):
+        """
+        Returns the set of rooms changed after version, or None if the
+        journal no longer reaches back that far (or the version is from
+        before a restart).
+        """
+        with self._lock:
+            if version is None or version > self.version:
+                return None
+            if self._entries and self._entries[0][0] > version + 1:
+                return None
+
+            rooms = set()
+            for v, room in reversed(self._entries):
+                if v <= version:
+                    break
+                rooms.add(room)
+            return rooms
 
 class Monitor(object):
 
-    def __init__(self, broker):
+    STORE_ID = 'occupancy'
+    VERSION_ID = 'version'
+
+    def __init__(self, broker, push_interval=0.1,
+                 ingest_workers=1, ingest_queue=10000, ingest_policy=IngestQueue.COLLAPSE,
+                 routes=TopicRouter.ROUTES, db=None, page_size=24,
+                 journal_size=10000, heartbeat=5.0, table=None, commands=None,
+                 max_format=codec.JSON, alert_rules=None, alert_rate=20.0, alert_topic='alerts',
+                 connect=True):
         super().__init__()
+        # Rooms are only added under the lock, and readers that iterate
+        # over them copy them under it.  Looking one up needs no lock.
+        self._rooms_lock = threading.Lock()
         self._rooms = {}
+        self._floors = {}
+        self._page_size = page_size
+        self._heartbeat = heartbeat
+
+        # The layout and its serialized form until a floor is added, and
+        # each room's card until the room changes.
+        self._layout = None
+        self._layout_registered = None
+        self.cards = FragmentCache()
 
         self.view = dash_devices.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
         self.view.config.suppress_callback_exceptions = True
         self.view.layout = self.layout
+        self.view.server.view_functions[self.view.config.routes_pathname_prefix + '_dash-layout'] = self.serve_layout
+        self.view.pusher.add_url('_dash-layout', self.serve_layout)
+        self.view.server.route('/stats')(self.serve_stats)
+        self.view.server.route('/history/<roomid>')(self.serve_history)
+
+        self.view.callback([Output('page', 'options'), Output('page', 'value')],
+                           [Input('floor', 'value')])(self.update_pages)
+        self.view.callback(Output('rooms', 'children'),
+                           [Input('floor', 'value'), Input('page', 'value')])(self.update_rooms)
+        self.view.callback(Output('stores', 'children'),
+                           [Input('heartbeat', 'n_intervals')],
+                           [State(Monitor.VERSION_ID, 'data'),
+                            State(RoomView.component_id('tank', ALL), 'id')])(self.resync)
+        self.view.callback_connect(self.on_client)
+        RoomView.register(self)
+
+        self.batcher = PushBatcher(self.view, Monitor.STORE_ID, Monitor.VERSION_ID, push_interval)
+        self.history = History()
+
+        # Without a broker this is a web worker, following the room table
+        # written by the ingestion process.
+        self.table = table
+        self._publish_table = table is not None and broker is not None
+        if broker is None:
+            # The ingestion process evaluates the alerts.
+            self.alerts = None
+            self.journal = table
+            self.db = TableStore(table)
+            self.preload()
+            self.proto = Follower(table, commands, self, push_interval or 0.1)
+        else:
+            self.alerts = AlertEngine(self.publish_alert,
+                                      alert_rules if alert_rules is not None else default_rules(),
+                                      alert_rate, topic=alert_topic)
+            # With a table the table is the journal, which assigns the
+            # versions under the same lock it publishes them with.
+            self.journal = Journal(journal_size) if table is None else table
+            self.db = db if db is not None else open_store()
+            self.preload()
+            self.proto = Protocol(broker, self, ingest_workers, ingest_queue, ingest_policy, routes, max_format,
+                                  connect)
+
+    def push_state(self, room, state):
+        if self._publish_table:
+            version = self.table.write(room, self._rooms[room].state)
+        else:
+            version = self.journal.record(room)
+        self.batcher.push(room, state, version)
+        return version
+
+    def publish_alert(self, topic, payload):
+        self.proto.publish_alert(topic, payload)
+
+    def profile(self):
+        """
+        Starts timing the stages of handling a message, and returns
+        their Latency by stage.
+        """
+        stages = {stage : Latency() for stage in ('decode', 'route', 'update')}
+        self.proto.stages = stages
+        self.batcher.latency = Latency()
+        return dict(stages, push=self.batcher.latency)
+
+    def apply_commands(self, commands):
+        """
+        Applies the max edits forwarded by the web workers.
+        """
+        while True:
+            command, floor, room, value = commands.get()
+            try:
+                if command == 'max':
+                    self.ensure_room(Room.Id(floor, room)).occupancy_max = value
+            except Exception as e:
+                print(e)
 
-        self.db = pickledb.load('rooms.db', 1)
-        self.proto = Protocol(broker, self)
+    def stats(self):
+        stats = {'rooms'  : len(self._rooms),
+                 'push'   : self.batcher.stats(),
+                 'render' : self.cards.stats()}
+        if self.alerts is not None:
+            stats['alerts'] = self.alerts.stats()
+        stats.update(self.proto.stats())
+        return stats
+
+    async def serve_stats(self):
+        return quart.jsonify(self.stats())
+
+    async def serve_history(self, roomid):
+        tier = quart.request.args.get('tier', '1m')
+        window = quart.request.args.get('window', 3600, type=float)
+        try:
+            return quart.jsonify(self.history.query(Room.Id.from_str(roomid), tier, window))
+        except (TypeError, ValueError) as e:
+            return quart.jsonify({'error' : str(e)}), 400
 
     def layout(self):
+        return self.rendered_layout()[0]
+
+    def rendered_layout(self):
+        """
+        Returns the layout and its Rendered JSON.
+        """
+        layout = self._layout
+        if layout is None:
+            component = self.render_layout()
+            layout = self._layout = (component, Rendered(to_json(component)))
+        return layout
+
+    async def serve_layout(self, body=None, client=None, request_id=None):
+        """
+        Serves the cached layout JSON: over the push socket in
+        dash_devices' framing, or over HTTP with an ETag and, when the
+        browser takes it, gzipped once rather than by quart_compress on
+        every request.
+        """
+        component, rendered = self.rendered_layout()
+        if self._layout_registered is not component:
+            await self.view.handle_layout(None, None, component)
+            self._layout_registered = component
+
+        if request_id is not None:
+            await quart.websocket.send('{"id": %s, "data": %s}'%(json.dumps(request_id), rendered.body.decode()))
+            return
+
+        headers = {'ETag' : rendered.etag, 'Cache-Control' : 'no-cache', 'Vary' : 'Accept-Encoding'}
+        if rendered.etag in quart.request.headers.get('If-None-Match', ''):
+            return quart.Response('', status=304, headers=headers)
+
+        body = rendered.body
+        if 'gzip' in quart.request.headers.get('Accept-Encoding', '').lower():
+            body = rendered.gzipped
+            headers['Content-Encoding'] = 'gzip'
+        return quart.Response(body, mimetype='application/json', headers=headers)
+
+    def render_layout(self):
+        # The version is the one the layout was built at, so a browser
+        # served it from the cache resyncs a little more than it needs to.
+        floors = self.floors()
         return dbc.Container([
             html.H1(children='ACME Room Occupancy Monitor'),
             html.Hr(),
-            dbc.Row([r.view for r in self.rooms()],
+            html.Div(self.render_stores(0, {}, self.journal.version), id='stores'),
+            dcc.Interval(id='heartbeat', interval=self._heartbeat * 1000),
+            dbc.Row([
+                dbc.Col(dcc.Dropdown(id='floor', clearable=False,
+                                     options=[{'label' : 'Floor %s'%(f,), 'value' : f} for f in floors],
+                                     value=floors[0] if floors else None)),
+                dbc.Col(dcc.Dropdown(id='page', clearable=False, options=[], value=0))
+            ], className='mb-2'),
+            dbc.Row([],
                     id="rooms",
                     className=['row-cols-1', 'row-cols-sm-2', 'row-cols-md-3', 'row-cols-lg-4', 'row-cols-xl-6'])
         ], fluid=False)
 
+    @staticmethod
+    def render_stores(mount, data, version):
+        # The stores are keyed by a wrapper whose id changes with every
+        # mount, so React mounts them anew and they register with the
+        # push socket that is open at the time.
+        return html.Div([dcc.Store(id=Monitor.STORE_ID, data=data),
+                         dcc.Store(id=Monitor.VERSION_ID, data=version)],
+                        id='stores-%d'%(mount,))
+
+    def update_pages(self, floor):
+        count = len(self._floors.get(floor, ()))
+        pages = range(0, count, self._page_size)
+        return ([{'label' : 'Rooms %d-%d'%(i + 1, min(i + self._page_size, count)), 'value' : i // self._page_size}
+                 for i in pages], 0)
+
+    def update_rooms(self, floor, page):
+        rooms = self.floor_rooms(floor)
+        start = (page or 0) * self._page_size
+        rooms = rooms[start:start + self._page_size]
+
+        # Only the rooms on screen are pushed to this browser.
+        client = dash_devices.callback_context.client
+        if client is not None:
+            self.batcher.subscribe(client, [r.id for r in rooms])
+
+        return [self.cards.get(r.id, lambda r=r: r.view) for r in rooms]
+
+    def resync(self, n_intervals, version, ids):
+        """
+        The heartbeat reopens the push socket of a browser whose
+        connection dropped.  The new connection has no subscription yet,
+        so it is subscribed to the rooms on its page and sent only those
+        changed since the version it last saw.
+
+        The browser forgets which components take pushes when its socket
+        closes, so the stores are sent as new components rather than as
+        new data; pushes to them would otherwise be held back forever.
+        """
+        client = dash_devices.callback_context.client
+        if client is None or not ids or self.batcher.is_subscribed(client):
+            raise PreventUpdate
+
+        rooms = [Room.Id.from_str(id['room']) for id in ids]
+        self.batcher.subscribe(client, rooms)
+
+        current = self.journal.version
+        changed = self.journal.since(version)
+        if changed is not None:
+            rooms = [room for room in rooms if room in changed]
+
+        data = {str(room) : self.get_room(room).state for room in rooms if room in self._rooms}
+        return Monitor.render_stores(n_intervals, data, current)
+
+    def on_client(self, client, connect):
+        if not connect:
+            self.batcher.unsubscribe(client)
+
     def get_room(self, roomid):
         return self._rooms[roomid]
 
     def create_room(self, roomid):
-        room = Room(self, roomid)
+        if self._publish_table:
+            # Raises ValueError for an id the table can't hold, before
+            # there is a room for it to fall out of step with.
+            self.table.reserve(roomid)
+        # Not stored: only rooms whose max was set have settings to keep.
+        return Room(self, roomid)
+
+    def add_room(self, room):
+        if room.id.floor not in self._floors:
+            self._layout = None
         self._rooms[room.id] = room
-        return room
+        self._floors.setdefault(room.id.floor, {})[room.id] = room
 
     def ensure_room(self, roomid):
-        if not roomid in self._rooms:
-            room = self.create_room(roomid)
-        return self.get_room(roomid)
+        room = self._rooms.get(roomid)
+        if room is None:
+            with self._rooms_lock:
+                # Another thread may have created it while this one waited.
+                room = self._rooms.get(roomid)
+                if room is None:
+                    room = self.create_room(roomid)
+                    self.add_room(room)
+        return room
+
+    def preload(self):
+        """
+        Creates every room with settings in the store in one batch,
+        before any update arrives, so the burst of retained messages at
+        startup mostly updates rooms.
+        """
+        start = time.time()
+        rooms = []
+        for key in self.db.keys():
+            try:
+                roomid = Room.Id.from_str(key)
+                if self._publish_table:
+                    self.table.reserve(roomid)
+            except TypeError:
+                continue
+            except ValueError as e:
+                print(e)
+                continue
+            rooms.append(Room(self, roomid))
+        with self._rooms_lock:
+            for room in rooms:
+                self.add_room(room)
+        print("preloaded %d rooms in %.2fs"%(len(rooms), time.time() - start))
 
     def rooms(self):
-        return list(self._rooms.values())
+        with self._rooms_lock:
+            return list(self._rooms.values())
+
+    def floors(self):
+        with self._rooms_lock:
+            return sorted(self._floors)
+
+    def floor_rooms(self, floor):
+        with self._rooms_lock:
+            rooms = list(self._floors.get(floor, {}).values())
+        return sorted(rooms, key=lambda r: r.id.room)
+
+def run_worker(table, commands, fd, **options):
+    """
+    Web worker process: serves the dashboard on the shared listening
+    socket fd from the room table written by the ingestion process.
+    """
+    import asyncio
+    import hypercorn.asyncio
+    import hypercorn.config
+
+    monitor = Monitor(None, table=RoomTable(table, make_id=Room.Id), commands=commands, **options)
+    monitor.view.enable_dev_tools(debug=False)
+
+    config = hypercorn.config.Config()
+    config.bind = ['fd://%d'%(fd,)]
+    asyncio.run(hypercorn.asyncio.serve(monitor.view.server, config))
+
+def preload_table(table, db):
+    """
+    Writes the max of every room in the settings store into the room
+    table.
+    """
+    count = 0
+    for key in db.keys():
+        try:
+            table.write(Room.Id.from_str(key), {'max' : db.get(key)})
+        except TypeError:
+            continue
+        except ValueError as e:
+            print(e)
+            continue
+        count += 1
+    print("preloaded %d rooms into the room table"%(count,))
+
+def run_workers(args, options):
+    """
+    Scale-out mode: this process subscribes to MQTT and publishes room
+    state into a shared-memory table; args.workers forked processes
+    accept browser connections from one listening socket and serve them
+    from that table.
+    """
+    import multiprocessing
+    import socket
+
+    table = RoomTable(capacity=args.table_size, make_id=Room.Id)
+
+    sock = socket.socket(socket.AF_INET6 if ':' in args.listen else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.listen, int(args.port)))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    # The workers serve from the table as soon as they start, so the
+    # stored rooms go into it first.  The store runs a sync thread, so it
+    # is closed again for the fork and reopened for the Monitor.
+    db = open_store(args.store, args.db, args.legacy_db, args.sync_interval)
+    preload_table(table, db)
+    db.close()
+
+    # Fork the workers before this process starts any threads.
+    context = multiprocessing.get_context('fork')
+    commands = context.Queue()
+    workers = [context.Process(target=run_worker, args=(table.name, commands, sock.fileno()),
+                               kwargs=options, daemon=True)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    db = open_store(args.store, args.db, args.legacy_db, args.sync_interval)
+    monitor = Monitor(args.broker, db=db, table=table,
+                      ingest_workers=args.ingest_workers,
+                      ingest_queue=args.ingest_queue,
+                      ingest_policy=args.ingest_policy,
+                      routes=args.routes or TopicRouter.ROUTES,
+                      max_format=args.max_format,
+                      alert_rules=default_rules(args.alert_fraction, args.alert_minutes, args.floor_limits),
+                      alert_rate=args.alert_rate,
+                      alert_topic=args.alert_topic,
+                      **options)
+    try:
+        threading.Thread(target=monitor.apply_commands, args=(commands,), daemon=True).start()
+        for worker in workers:
+            worker.join()
+    finally:
+        table.close()
 
 if __name__ == '__main__':
     import argparse
@@ -256,8 +867,66 @@ if __name__ == '__main__':
     parser.add_argument("-b", "--broker", help="MQTT broker address", required=True)
     parser.add_argument("-l", "--listen", help="Dashboard listen address", default="::")
     parser.add_argument("-p", "--port", help="Dashboard listen port", default=8050)
+    parser.add_argument("--push-interval", help="Window in ms for coalescing browser updates (0 pushes immediately)",
+                        type=int, default=100)
+    parser.add_argument("--ingest-workers", help="Number of MQTT message handling threads",
+                        type=int, default=1)
+    parser.add_argument("--ingest-queue", help="Maximum number of queued MQTT messages",
+                        type=int, default=10000)
+    parser.add_argument("--ingest-policy", help="What to do when the MQTT message queue is full",
+                        choices=IngestQueue.POLICIES, default=IngestQueue.COLLAPSE)
+    parser.add_argument("--route", help="Occupancy topic shape, e.g. 'sensors/{building}/{floor}/{room}/occupancy/cur' (repeatable)",
+                        action="append", dest="routes")
+    parser.add_argument("--max-format", help="Encoding of the max published to sensors; only sensors with codec.py read binary",
+                        choices=codec.FORMATS, default=codec.JSON)
+    parser.add_argument("--alert-fraction", help="Share of a room's max that raises a sustained occupancy alert",
+                        type=float, default=0.9)
+    parser.add_argument("--alert-minutes", help="Minutes a room must stay at --alert-fraction to alert (0 disables)",
+                        type=float, default=10.0)
+    parser.add_argument("--floor-limit", help="Alert when a floor's total occupancy exceeds [floor=]N (repeatable)",
+                        type=floor_limit, action="append", dest="floor_limits")
+    parser.add_argument("--alert-rate", help="Maximum alerts published per second",
+                        type=float, default=20.0)
+    parser.add_argument("--alert-topic", help="MQTT topic prefix of the alerts",
+                        default='alerts')
+    parser.add_argument("--page-size", help="Number of rooms shown per page",
+                        type=int, default=24)
+    parser.add_argument("--journal-size", help="Number of room changes remembered for resyncing browsers",
+                        type=int, default=10000)
+    parser.add_argument("--heartbeat", help="Seconds between browser heartbeats, used to detect reconnects",
+                        type=float, default=5.0)
+    parser.add_argument("--store", help="Persistence backend for room settings",
+                        choices=sorted(BACKENDS), default='log')
+    parser.add_argument("--db", help="Path of the room settings store (default depends on --store)")
+    parser.add_argument("--legacy-db", help="pickledb file to import room settings from on first start",
+                        default='rooms.db')
+    parser.add_argument("--sync-interval", help="Seconds between room settings writes to disk",
+                        type=float, default=1.0)
+    parser.add_argument("-w", "--workers", help="Number of web worker processes (0 serves from this process)",
+                        type=int, default=0)
+    parser.add_argument("--table-size", help="Maximum number of rooms in the shared room table",
+                        type=int, default=4096)
 
     args = parser.parse_args()
 
-    monitor = Monitor(args.broker)
-    monitor.view.run_server(host=args.listen, port=args.port, debug=True)
+    if args.workers:
+        run_workers(args, {'push_interval' : args.push_interval / 1000.0,
+                           'page_size'     : args.page_size,
+                           'journal_size'  : args.journal_size,
+                           'heartbeat'     : args.heartbeat})
+    else:
+        db = open_store(args.store, args.db, args.legacy_db, args.sync_interval)
+        monitor = Monitor(args.broker, push_interval=args.push_interval / 1000.0,
+                          ingest_workers=args.ingest_workers,
+                          ingest_queue=args.ingest_queue,
+                          ingest_policy=args.ingest_policy,
+                          routes=args.routes or TopicRouter.ROUTES,
+                          max_format=args.max_format,
+                          alert_rules=default_rules(args.alert_fraction, args.alert_minutes, args.floor_limits),
+                          alert_rate=args.alert_rate,
+                          alert_topic=args.alert_topic,
+                          db=db,
+                          page_size=args.page_size,
+                          journal_size=args.journal_size,
+                          heartbeat=args.heartbeat)
+        monitor.view.run_server(host=args.listen, port=args.port, debug=True)
@@ -0,0 +1,157 @@
+import threading
+import time
+
+from array import array
+
+class Tier(object):
+    """
+    Ring of fixed-width time buckets holding min/max/sum/count and the
+    last value of the samples that fell into each bucket.
+
+    Bucket number b (time // width) lives in slot b % capacity, so the
+    oldest bucket is overwritten as time moves on and a window is read
+    by visiting only the slots it covers.
+    """
+
+    def __init__(self, width, capacity):
+        self.width = width
+        self.capacity = capacity
+
+        self._stamp = array('q', [-1]) * capacity
+        self._min = array('f', [0]) * capacity
+        self._max = array('f', [0]) * capacity
+        self._last = array('f', [0]) * capacity
+        self._sum = array('d', [0]) * capacity
+        self._count = array('l', [0]) * capacity
+
+    def add(self, t, value):
+        bucket = int(t // self.width)
+        slot = bucket % self.capacity
+
+        if self._stamp[slot] != bucket:
+            self._stamp[slot] = bucket
+            self._min[slot] = self._max[slot] = value
+            self._sum[slot] = value
+            self._count[slot] = 1
+        else:
+            if value < self._min[slot]:
+                self._min[slot] = value
+            if value > self._max[slot]:
+                self._max[slot] = value
+            self._sum[slot] += value
+            self._count[slot] += 1
+        self._last[slot] = value
+
+    def query(self, since, until):
+        """
+        Returns (start, min, max, avg) per bucket between since and until.
+        Buckets without samples repeat the last value seen before them,
+        since occupancy holds until the next change.
+        """
+        first = max(0, int(since // self.width), int(until // self.width) - self.capacity + 1)
+        last = int(until // self.width)
+
+        rows = []
+        value = None
+        for bucket in range(first, last + 1):
+            slot = bucket % self.capacity
+            if self._stamp[slot] == bucket:
+                rows.append((bucket * self.width, self._min[slot], self._max[slot],
+                             self._sum[slot] / self._count[slot]))
+                value = self._last[slot]
+            elif value is not None:
+                rows.append((bucket * self.width, value, value, value))
+        return rows
+
+class Series(object):
+    """
+    History of one room: a ring of raw (time, value) samples plus the
+    rollup tiers.
+    """
+
+    def __init__(self, raw, tiers):
+        self._lock = threading.Lock()
+
+        self._capacity = raw
+        self._head = 0
+        self._size = 0
+        self._times = array('d', [0]) * raw
+        self._values = array('f', [0]) * raw
+
+        self.tiers = {name : Tier(width, capacity) for name, (width, capacity) in tiers.items()}
+
+    def add(self, t, value):
+        with self._lock:
+            self._times[self._head] = t
+            self._values[self._head] = value
+            self._head = (self._head + 1) % self._capacity
+            self._size = min(self._size + 1, self._capacity)
+
+            for tier in self.tiers.values():
+                tier.add(t, value)
+
+    def raw(self, since, until):
+        with self._lock:
+            rows = []
+            for i in range(self._size):
+                slot = (self._head - 1 - i) % self._capacity
+                t = self._times[slot]
+                if t < since:
+                    break
+                if t <= until:
+                    rows.append((t, self._values[slot]))
+            rows.reverse()
+            return rows
+
+    def rollup(self, tier, since, until):
+        with self._lock:
+            return self.tiers[tier].query(since, until)
+
+class History(object):
+    """
+    In-process occupancy time series for every room, in bounded memory.
+    """
+
+    TIERS = {'1m' : (60, 720),
+             '1h' : (3600, 24 * 14)}
+
+    def __init__(self, raw=256, tiers=TIERS):
+        self._raw = raw
+        self._tiers = tiers
+
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def series(self, id):
+        series = self._series.get(id)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(id, Series(self._raw, self._tiers))
+        return series
+
+    def add(self, id, value, t=None):
+        self.series(id).add(time.time() if t is None else t, value)
+
+    def query(self, id, tier='1m', window=3600, until=None):
+        """
+        Returns a room's history over the last window seconds as
+        columns: {'t': [...], 'min': [...], 'max': [...], 'avg': [...]}
+        for a rollup tier, or {'t': [...], 'value': [...]} for 'raw'.
+        """
+        until = time.time() if until is None else until
+        series = self._series.get(id)
+
+        if tier == 'raw':
+            keys = ('t', 'value')
+            rows = series.raw(until - window, until) if series else []
+        elif tier in self._tiers:
+            keys = ('t', 'min', 'max', 'avg')
+            rows = series.rollup(tier, until - window, until) if series else []
+        else:
+            raise ValueError("unknown history tier '%s'"%(tier,))
+
+        columns = {key : [] for key in keys}
+        for row in rows:
+            for key, value in zip(keys, row):
+                columns[key].append(value)
+        return columns
@@ -0,0 +1,174 @@
+import bisect
+import collections
+import threading
+import time
+
+class IngestQueue(object):
+    """
+    Bounded queue of (key, item) pairs that never blocks the producer.
+
+    When the queue is full the oldest entry is dropped.  With the
+    'collapse' policy an entry whose key is already queued replaces the
+    queued item in place, so a backlog holds at most one item per key.
+    """
+
+    DROP_OLDEST = 'drop-oldest'
+    COLLAPSE = 'collapse'
+
+    POLICIES = (DROP_OLDEST, COLLAPSE)
+
+    def __init__(self, maxsize=10000, policy=COLLAPSE):
+        if policy not in IngestQueue.POLICIES:
+            raise ValueError("unknown backpressure policy '%s'"%(policy,))
+
+        self._maxsize = maxsize
+        self._policy = policy
+
+        self._cond = threading.Condition(threading.Lock())
+        if policy == IngestQueue.COLLAPSE:
+            self._queue = collections.OrderedDict()
+        else:
+            self._queue = collections.deque()
+
+        self.received = 0
+        self.dropped = 0
+        self.collapsed = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, key, item):
+        with self._cond:
+            self.received += 1
+            if self._policy == IngestQueue.COLLAPSE:
+                if key in self._queue:
+                    self._queue[key] = item
+                    self.collapsed += 1
+                    return
+                if len(self._queue) >= self._maxsize:
+                    self._queue.popitem(last=False)
+                    self.dropped += 1
+                self._queue[key] = item
+            else:
+                if len(self._queue) >= self._maxsize:
+                    self._queue.popleft()
+                    self.dropped += 1
+                self._queue.append((key, item))
+
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._queue and not self._cond.wait_for(lambda: self._queue, timeout):
+                return None
+
+            if self._policy == IngestQueue.COLLAPSE:
+                return self._queue.popitem(last=False)
+            return self._queue.popleft()
+
+class Latency(object):
+    """
+    Fixed-bucket latency histogram, in milliseconds, plus the most recent
+    samples for percentiles.
+    """
+
+    BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, recent=4096):
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(Latency.BUCKETS) + 1)
+        self._recent = collections.deque(maxlen=recent)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        with self._lock:
+            self._counts[bisect.bisect_left(Latency.BUCKETS, ms)] += 1
+            self._recent.append(ms)
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def stats(self):
+        with self._lock:
+            buckets = ['<=%s'%(b,) for b in Latency.BUCKETS] + ['>%s'%(Latency.BUCKETS[-1],)]
+            recent = sorted(self._recent)
+
+            stats = {'count'   : self.count,
+                     'avg_ms'  : self.total / self.count if self.count else 0.0,
+                     'max_ms'  : self.max,
+                     'buckets' : dict(zip(buckets, self._counts))}
+            for p in Latency.PERCENTILES:
+                stats['p%d_ms'%(p,)] = recent[min(len(recent) - 1, len(recent) * p // 100)] if recent else 0.0
+            return stats
+
+class Ingest(object):
+    """
+    Hands messages from the MQTT network thread to worker threads.
+
+    Messages are sharded over the workers by key (the topic), so updates
+    for one room are always handled in order by the same worker.  Each
+    worker keeps its own counts, so none is lost to another thread's
+    update, and stats() adds them up.
+    """
+
+    def __init__(self, handler, workers=1, maxsize=10000, policy=IngestQueue.COLLAPSE):
+        self._handler = handler
+        self._queues = [IngestQueue(maxsize, policy) for _ in range(max(1, workers))]
+
+        self._handled = [0] * len(self._queues)
+        self._errors = [0] * len(self._queues)
+
+        self.wait = Latency()
+        self.latency = Latency()
+
+        self._stopped = threading.Event()
+        self._threads = []
+        for i, queue in enumerate(self._queues):
+            thread = threading.Thread(target=self.run, args=(i, queue), name="ingest-%d"%(i,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, item):
+        queue = self._queues[hash(key) % len(self._queues)]
+        queue.put(key, (time.monotonic(), item))
+
+    def run(self, worker, queue):
+        while not self._stopped.is_set():
+            entry = queue.get(timeout=0.5)
+            if entry is None:
+                continue
+
+            key, (queued, item) = entry
+            started = time.monotonic()
+            try:
+                self._handler(key, item)
+            except Exception as e:
+                self._errors[worker] += 1
+                print(e)
+
+            done = time.monotonic()
+            self._handled[worker] += 1
+            self.wait.record(started - queued)
+            self.latency.record(done - queued)
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        return {'received'  : sum(q.received for q in self._queues),
+                'handled'   : sum(self._handled),
+                'errors'    : sum(self._errors),
+                'depth'     : sum(len(q) for q in self._queues),
+                'max_depth' : max(q.max_depth for q in self._queues),
+                'dropped'   : sum(q.dropped for q in self._queues),
+                'collapsed' : sum(q.collapsed for q in self._queues),
+                'wait'      : self.wait.stats(),
+                'latency'   : self.latency.stats()}
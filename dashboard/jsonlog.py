@@ -0,0 +1,74 @@
+"""
+Append-only log of JSON records, one per line, behind the dashboard's
+LogStore and the broker's RetainedStore.
+
+Appends are fsynced.  A torn last line from a crash is dropped on load,
+so new records start on a fresh line.  The log is compacted into a
+fresh file, atomically renamed into place, once it holds compact_ratio
+times more records than live entries.
+
+The broker and dashboard each ship a copy of this module; the copies
+must stay identical, which tests/test_jsonlog.py checks.
+"""
+
+import json
+import os
+
+class JsonLog(object):
+
+    def __init__(self, path, compact_ratio=4, compact_min=1000):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.records = 0
+        self._file = None
+
+    def load(self):
+        """
+        Returns the records in the log, skipping lines that aren't JSON,
+        and opens it for appending.
+        """
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r+b') as f:
+                end = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    end += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+                # Drop a torn last record so new ones start on a fresh line.
+                f.truncate(end)
+        self.records = len(records)
+        self._file = open(self.path, 'a')
+        return records
+
+    def append(self, records):
+        self._file.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += len(records)
+
+    def needs_compaction(self, live):
+        return self.records > max(self.compact_min, self.compact_ratio * live)
+
+    def compact(self, records):
+        """
+        Replaces the log with records, the live entries.
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'a')
+        self.records = len(records)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import json
+import threading
+
+import plotly.utils
+
+def to_json(component):
+    return json.dumps(component, cls=plotly.utils.PlotlyJSONEncoder)
+
+class Rendered(object):
+    """
+    A serialized response body, with its ETag and gzip encoding
+    computed once.
+    """
+
+    def __init__(self, body, level=6):
+        self.body = body.encode()
+        self.etag = '"%s"'%(hashlib.sha1(self.body).hexdigest()[:20],)
+        self._level = level
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, self._level)
+        return self._gzipped
+
+class FragmentCache(object):
+    """
+    The JSON form of components, kept by key until invalidated.  Dash
+    encodes a callback's plain dicts as they are, so returning cached
+    fragments skips walking the component trees again.
+
+    Invalidating bumps the key's generation, and a fragment rendered
+    from a generation that has since been invalidated isn't kept, so a
+    change racing a render can't leave a stale fragment behind.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fragments = {}
+        self._generations = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        """
+        Returns the fragment for key, rendering the component returned
+        by render() if there is none.
+        """
+        with self._lock:
+            fragment = self._fragments.get(key)
+            generation = self._generations.get(key, 0)
+            if fragment is not None:
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = json.loads(to_json(render()))
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._fragments[key] = fragment
+        return fragment
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._fragments.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'fragments' : len(self._fragments),
+                    'hits'      : self.hits,
+                    'misses'    : self.misses}
@@ -0,0 +1,429 @@
+"""
+Records MQTT occupancy traffic and replays it into the dashboard.
+
+A recording is a MAGIC header with the epoch it started at, then one
+record per message: its time in seconds since the start, the index of
+its topic and the length of its payload, followed by the payload.  A
+record with the topic index DEFINE instead carries the name of the next
+topic, so each topic is written once.  Records are only ever appended,
+so a recording can be replayed while it is still being written; a
+partly written record at the end is ignored.
+
+A sidecar <file>.idx holds the topic table, each topic as it is
+defined, and the time and offset of a record every index_interval
+seconds, so replaying part-way through starts reading at that offset
+with the topics defined before it.  Without the sidecar the recording
+is read from the start.
+
+Replaying feeds the messages straight into a Monitor, without a broker,
+as fast as possible or at a multiple of the recorded pace, and reports
+how long each stage of handling a message took: routing its topic,
+decoding its payload, updating the room and pushing the changes to the
+browsers, played by stand-in displays.
+"""
+
+import asyncio
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+
+import paho.mqtt.client as paho
+
+from dashboard import Monitor
+from ingest import IngestQueue
+from render import to_json
+from store import open_store
+from topics import TopicRouter
+
+MAGIC = b'OCCREC1\n'
+START = struct.Struct('<d')
+RECORD = struct.Struct('<dHI')
+
+# Sidecar entries: a kind byte, then for TOPIC the name's length and the
+# name, for INDEX the time and offset of a record.
+TOPIC = struct.Struct('<BH')
+INDEX = struct.Struct('<BdQ')
+TOPIC_ENTRY = 1
+INDEX_ENTRY = 2
+
+HEADER_SIZE = len(MAGIC) + START.size
+DEFINE = 0xFFFF
+
+class Recording(object):
+    """
+    Writes a recording, one message at a time.
+    """
+
+    def __init__(self, path, index_interval=1.0):
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._index = open(path + '.idx', 'wb')
+        self._index_interval = index_interval
+        self._next_index = 0.0
+        self._topics = {}
+
+        self.start = time.time()
+        self.messages = 0
+        self._file.write(MAGIC + START.pack(self.start))
+        self.flush()
+
+    @property
+    def size(self):
+        return self._file.tell()
+
+    def write(self, topic, payload, ts=None):
+        t = (ts or time.time()) - self.start
+        with self._lock:
+            index = self._topics.get(topic)
+            if index is None:
+                if len(self._topics) >= DEFINE:
+                    raise ValueError("too many topics to record '%s'"%(topic,))
+                index = self._topics[topic] = len(self._topics)
+                name = topic.encode()
+                self._file.write(RECORD.pack(t, DEFINE, len(name)) + name)
+                self._index.write(TOPIC.pack(TOPIC_ENTRY, len(name)) + name)
+
+            if t >= self._next_index:
+                self._index.write(INDEX.pack(INDEX_ENTRY, t, self._file.tell()))
+                self._next_index = t + self._index_interval
+
+            self._file.write(RECORD.pack(t, index, len(payload)) + payload)
+            self.messages += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._index.close()
+
+class Playback(object):
+    """
+    Reads a recording, memory-mapped, as it was when opened.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a recording"%(path,))
+        self.start, = START.unpack_from(self._map, len(MAGIC))
+
+        # The topics in the sidecar, and for each indexed record its time,
+        # offset and the number of topics defined before it.
+        self._topics = None
+        self._times = []
+        self._offsets = []
+        self._counts = []
+        if os.path.exists(path + '.idx'):
+            self.load_index(path + '.idx')
+
+    def load_index(self, path):
+        with open(path, 'rb') as f:
+            index = f.read()
+
+        self._topics = []
+        position = 0
+        while position < len(index):
+            kind = index[position]
+            if kind == TOPIC_ENTRY and position + TOPIC.size <= len(index):
+                _, length = TOPIC.unpack_from(index, position)
+                start = position + TOPIC.size
+                if start + length > len(index):
+                    break
+                self._topics.append(index[start:start + length].decode())
+                position = start + length
+            elif kind == INDEX_ENTRY and position + INDEX.size <= len(index):
+                _, t, offset = INDEX.unpack_from(index, position)
+                # Entries past the recording as mapped are of no use.
+                if offset > len(self._map):
+                    break
+                self._times.append(t)
+                self._offsets.append(offset)
+                self._counts.append(len(self._topics))
+                position += INDEX.size
+            else:
+                # A partly written last entry.
+                break
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def records(self, position=HEADER_SIZE):
+        """
+        Yields (time, topic index, payload offset, payload length) for
+        every complete record from position on.
+        """
+        m = self._map
+        end = len(m)
+        while position + RECORD.size <= end:
+            t, index, length = RECORD.unpack_from(m, position)
+            body = position + RECORD.size
+            if body + length > end:
+                break
+            yield t, index, body, length
+            position = body + length
+
+    def topics(self):
+        if self._topics is not None:
+            return list(self._topics)
+        return [self._map[body:body + length].decode()
+                for _, index, body, length in self.records() if index == DEFINE]
+
+    def duration(self):
+        t = 0.0
+        for t, _, _, _ in self.records(self._offsets[-1] if self._offsets else HEADER_SIZE):
+            pass
+        return t
+
+    def messages(self, start=0.0):
+        """
+        Yields (time, topic, payload) for the messages from start
+        seconds into the recording.
+        """
+        i = bisect.bisect_right(self._times, start) - 1
+        if i >= 0:
+            offset, topics = self._offsets[i], self._topics[:self._counts[i]]
+        else:
+            offset, topics = HEADER_SIZE, []
+
+        for t, index, body, length in self.records(offset):
+            if index == DEFINE:
+                topics.append(self._map[body:body + length].decode())
+            elif t >= start:
+                yield t, topics[index], self._map[body:body + length]
+
+Message = namedtuple('Message', ['topic', 'payload'])
+
+class Display(object):
+    """
+    Stands in for a browser: takes the messages dash_devices queues for
+    its websocket and serializes them as it would before sending.
+    """
+
+    def __init__(self):
+        self.send_queue = asyncio.Queue()
+        self.messages = 0
+        self.bytes = 0
+
+    async def run(self):
+        while True:
+            message = await self.send_queue.get()
+            self.bytes += len(to_json(message))
+            self.messages += 1
+            self.send_queue.task_done()
+
+async def start_displays(count):
+    displays = [Display() for _ in range(count)]
+    for display in displays:
+        asyncio.ensure_future(display.run())
+    return displays
+
+async def drain_displays(displays):
+    for display in displays:
+        await display.send_queue.join()
+
+def record(args):
+    recording = Recording(args.output)
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe([(topic, 0) for topic in args.topics or ['sensors/#']])
+
+    def on_message(client, userdata, msg):
+        if msg.retain and not args.retained:
+            return
+        recording.write(msg.topic, msg.payload)
+
+    client = paho.Client("recorder-%d"%(os.getpid(),))
+    client.on_connect = on_connect
+    client.on_message = on_message
+    host, port = args.broker.rsplit(':', 1)
+    client.connect_async(host, port=int(port))
+    client.loop_start()
+
+    started = time.time()
+    try:
+        while args.duration is None or time.time() - started < args.duration:
+            time.sleep(1.0)
+            recording.flush()
+            print("recorded %d messages, %d bytes"%(recording.messages, recording.size))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        recording.close()
+
+def replay(args):
+    playback = Playback(args.recording)
+
+    # Settings go to a throwaway store, never the dashboard's own.
+    tmp = tempfile.mkdtemp(prefix='replay-')
+    db = open_store('log', os.path.join(tmp, 'rooms.log'), legacy=None)
+    monitor = Monitor('replay:0', connect=False,
+                      push_interval=args.push_interval / 1000.0,
+                      ingest_workers=args.ingest_workers,
+                      ingest_queue=args.ingest_queue,
+                      ingest_policy=args.ingest_policy,
+                      routes=args.routes or TopicRouter.ROUTES,
+                      page_size=args.page_size,
+                      db=db)
+    proto = monitor.proto
+
+    # Only the topics the dashboard routes, like its MQTT subscriptions.
+    rooms = []
+    topics = set()
+    for topic in playback.topics():
+        try:
+            room = proto.router.route(topic)
+        except ValueError:
+            continue
+        topics.add(topic)
+        if room not in rooms:
+            rooms.append(room)
+
+    # The loop push_mods() runs on, serving a page of rooms to each
+    # display as if browsers had them open.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="displays", daemon=True).start()
+    monitor.view.pusher.loop = loop
+    displays = asyncio.run_coroutine_threadsafe(start_displays(args.displays), loop).result()
+    pages = [rooms[i:i + args.page_size] for i in range(0, len(rooms), args.page_size)] or [[]]
+    for i, display in enumerate(displays):
+        monitor.batcher.subscribe(display, pages[i % len(pages)])
+
+    stages = monitor.profile()
+    if args.direct:
+        feed = lambda topic, payload: proto.handle_message(topic, payload)
+    else:
+        feed = lambda topic, payload: proto.on_message(None, None, Message(topic, payload))
+
+    fed = 0
+    skipped = 0
+    began = time.perf_counter()
+    for t, topic, payload in playback.messages(args.start):
+        if topic not in topics:
+            skipped += 1
+            continue
+        if args.speed:
+            delay = (t - args.start) / args.speed - (time.perf_counter() - began)
+            if delay > 0:
+                time.sleep(delay)
+        feed(topic, payload)
+        fed += 1
+
+    # Wait for the ingest workers, then push what is still pending.
+    ingest = proto.ingest
+    while True:
+        stats = ingest.stats()
+        if stats['handled'] + stats['dropped'] + stats['collapsed'] >= stats['received']:
+            break
+        time.sleep(0.01)
+    monitor.batcher.flush()
+    asyncio.run_coroutine_threadsafe(drain_displays(displays), loop).result()
+    elapsed = time.perf_counter() - began
+
+    report = {'messages'   : fed,
+              'skipped'    : skipped,
+              'rooms'      : len(rooms),
+              'seconds'    : elapsed,
+              'rate'       : fed / elapsed if elapsed else 0.0,
+              'stages'     : {stage : latency.stats() for stage, latency in stages.items()},
+              'ingest'     : ingest.stats(),
+              'stale'      : proto.stale,
+              'push'       : monitor.batcher.stats(),
+              'render'     : monitor.cards.stats(),
+              'displays'   : {'count'    : len(displays),
+                              'messages' : sum(d.messages for d in displays),
+                              'bytes'    : sum(d.bytes for d in displays)}}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("replayed %d messages for %d rooms in %.2fs (%.0f/s), %d skipped, %d stale"
+              %(fed, len(rooms), elapsed, report['rate'], skipped, proto.stale))
+        for stage, stats in report['stages'].items():
+            print("  %-7s count %-8d avg %.3fms p50 %.3fms p99 %.3fms max %.3fms"
+                  %(stage, stats['count'], stats['avg_ms'], stats['p50_ms'], stats['p99_ms'], stats['max_ms']))
+        print("  ingest  dropped %d collapsed %d errors %d"
+              %(report['ingest']['dropped'], report['ingest']['collapsed'], report['ingest']['errors']))
+        print("  push    %d frames, %d room updates to %d displays, %d bytes"
+              %(report['push']['frames'], report['push']['pushed'], len(displays), report['displays']['bytes']))
+
+    monitor.batcher.stop()
+    ingest.stop()
+    loop.call_soon_threadsafe(loop.stop)
+    playback.close()
+    db.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+def info(args):
+    playback = Playback(args.recording)
+    topics = playback.topics()
+    messages = sum(1 for _, index, _, _ in playback.records() if index != DEFINE)
+    print("started %s, %.1fs, %d messages on %d topics"
+          %(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(playback.start)),
+            playback.duration(), messages, len(topics)))
+    playback.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ACME Room Occupancy traffic recorder and replayer")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_record = commands.add_parser("record", help="Record MQTT traffic to a file")
+    parser_record.add_argument("-b", "--broker", help="MQTT broker address", required=True)
+    parser_record.add_argument("-o", "--output", help="Recording file", required=True)
+    parser_record.add_argument("-t", "--topic", help="Topic filter to record (repeatable, default sensors/#)",
+                               action="append", dest="topics")
+    parser_record.add_argument("--retained", help="Also record the retained messages sent on subscribing",
+                               action="store_true")
+    parser_record.add_argument("--duration", help="Seconds to record (default until interrupted)",
+                               type=float)
+    parser_record.set_defaults(func=record)
+
+    parser_replay = commands.add_parser("replay", help="Replay a recording into the dashboard")
+    parser_replay.add_argument("recording", help="Recording file")
+    parser_replay.add_argument("--speed", help="Multiple of the recorded pace (0 replays as fast as possible)",
+                               type=float, default=0.0)
+    parser_replay.add_argument("--start", help="Seconds into the recording to start from",
+                               type=float, default=0.0)
+    parser_replay.add_argument("--direct", help="Handle messages on this thread instead of the ingest workers",
+                               action="store_true")
+    parser_replay.add_argument("--displays", help="Number of simulated browsers, each showing a page of rooms",
+                               type=int, default=1)
+    parser_replay.add_argument("--push-interval", help="Window in ms for coalescing browser updates (0 pushes immediately)",
+                               type=int, default=100)
+    parser_replay.add_argument("--ingest-workers", help="Number of MQTT message handling threads",
+                               type=int, default=1)
+    parser_replay.add_argument("--ingest-queue", help="Maximum number of queued MQTT messages",
+                               type=int, default=10000)
+    parser_replay.add_argument("--ingest-policy", help="What to do when the MQTT message queue is full",
+                               choices=IngestQueue.POLICIES, default=IngestQueue.COLLAPSE)
+    parser_replay.add_argument("--route", help="Occupancy topic shape (repeatable)",
+                               action="append", dest="routes")
+    parser_replay.add_argument("--page-size", help="Number of rooms shown per display",
+                               type=int, default=24)
+    parser_replay.add_argument("--json", help="Print the report as JSON",
+                               action="store_true")
+    parser_replay.set_defaults(func=replay)
+
+    parser_info = commands.add_parser("info", help="Summarize a recording")
+    parser_info.add_argument("recording", help="Recording file")
+    parser_info.set_defaults(func=info)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,261 @@
+import struct
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+def room_id(floor, room):
+    return floor, room
+
+class RoomTable(object):
+    """
+    Room state in shared memory, written by the ingestion process and
+    read by the web workers.
+
+    The segment holds a header, one fixed-size record per room and a
+    ring of (version, slot) change entries.  There is a single writer
+    process, which numbers each change with the next version under its
+    lock, so the versions it publishes only ever increase; each record
+    carries a sequence counter that is odd while the record is being
+    written, so readers retry instead of seeing a torn record.  The
+    header version is stored last, after the record and its change
+    entry.
+    """
+
+    HEADER = struct.Struct('<QIII')        # version, rooms, capacity, ring
+    RECORD = struct.Struct('<I32s32sqqQ')  # seq, floor, room, value, max, version
+    CHANGE = struct.Struct('<QI')          # version, slot
+    SPINS = 100                            # reads retried before sleeping
+
+    def __init__(self, name=None, capacity=4096, ring=16384, make_id=room_id):
+        self._make_id = make_id
+        self._lock = threading.Lock()
+        self._slots = {}
+
+        if name is None:
+            size = RoomTable.HEADER.size + capacity * RoomTable.RECORD.size + ring * RoomTable.CHANGE.size
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            RoomTable.HEADER.pack_into(self._shm.buf, 0, 0, 0, capacity, ring)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+
+        _, _, self._capacity, self._ring = RoomTable.HEADER.unpack_from(self._shm.buf, 0)
+        self._records = RoomTable.HEADER.size
+        self._changes = self._records + self._capacity * RoomTable.RECORD.size
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def version(self):
+        return RoomTable.HEADER.unpack_from(self._shm.buf, 0)[0]
+
+    @property
+    def count(self):
+        return RoomTable.HEADER.unpack_from(self._shm.buf, 0)[1]
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    # Writer
+
+    def reserve(self, id):
+        """
+        Returns the slot of a room's record, adding an empty one for a
+        new room.  Raises ValueError if the table is full or the id too
+        long for a record, so rooms can be checked before they are used.
+        """
+        with self._lock:
+            return self._reserve(id)
+
+    def _reserve(self, id):
+        slot = self._slots.get(id)
+        if slot is None:
+            count = self.count
+            if count >= self._capacity:
+                raise ValueError("room table is full (%d rooms)"%(self._capacity,))
+            floor, room = (part.encode() for part in id)
+            if len(floor) > 32 or len(room) > 32:
+                raise ValueError("room id '%s' is too long for the room table"%(id,))
+            slot = self._slots[id] = count
+            offset = self._records + slot * RoomTable.RECORD.size
+            RoomTable.RECORD.pack_into(self._shm.buf, offset, 0, floor, room, 0, 0, 0)
+            struct.pack_into('<I', self._shm.buf, 8, count + 1)
+        return slot
+
+    def write(self, id, state):
+        """
+        Updates a room's record with the 'value' and/or 'max' in state
+        and returns the version the change was recorded at.
+        """
+        buf = self._shm.buf
+        with self._lock:
+            version = self.version + 1
+            slot = self._reserve(id)
+
+            offset = self._records + slot * RoomTable.RECORD.size
+            seq, floor, room, value, max, _ = RoomTable.RECORD.unpack_from(buf, offset)
+            value = state.get('value', value)
+            max = state.get('max', max)
+
+            struct.pack_into('<I', buf, offset, seq + 1)
+            RoomTable.RECORD.pack_into(buf, offset, seq + 1, floor, room, value, max, version)
+            struct.pack_into('<I', buf, offset, seq + 2)
+
+            RoomTable.CHANGE.pack_into(buf, self._changes + (version % self._ring) * RoomTable.CHANGE.size,
+                                       version, slot)
+            struct.pack_into('<Q', buf, 0, version)
+            return version
+
+    # Readers
+
+    def read(self, slot, timeout=0.1):
+        """
+        Returns (id, value, max, version) of the record in slot.  A
+        record being written is retried, first at once and then after
+        growing sleeps; one still being written after timeout seconds
+        was left half-written by a writer that died, and raises
+        RuntimeError.
+        """
+        buf = self._shm.buf
+        offset = self._records + slot * RoomTable.RECORD.size
+        retries = 0
+        deadline = None
+        while True:
+            seq, floor, room, value, max, version = RoomTable.RECORD.unpack_from(buf, offset)
+            if not seq & 1 and struct.unpack_from('<I', buf, offset)[0] == seq:
+                id = self._make_id(floor.rstrip(b'\0').decode(), room.rstrip(b'\0').decode())
+                self._slots.setdefault(id, slot)
+                return id, value, max, version
+
+            retries += 1
+            if retries <= RoomTable.SPINS:
+                continue
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + timeout
+            elif now > deadline:
+                raise RuntimeError("room table record %d is stuck mid-write"%(slot,))
+            time.sleep(min(0.001, 0.00001 * 2**(retries - RoomTable.SPINS)))
+
+    def lookup(self, id):
+        slot = self._slots.get(id)
+        if slot is None:
+            for slot in range(self.count):
+                if self.read(slot)[0] == id:
+                    break
+            else:
+                return None
+        return self.read(slot)
+
+    def changes(self, version):
+        """
+        Returns (slots changed after version, current version).  The
+        slots are None if the ring no longer reaches back that far, in
+        which case every record has to be read.
+        """
+        buf = self._shm.buf
+        current = self.version
+        if version > current or current - version > self._ring:
+            return None, current
+
+        slots = set()
+        for v in range(version + 1, current + 1):
+            entry, slot = RoomTable.CHANGE.unpack_from(buf, self._changes + (v % self._ring) * RoomTable.CHANGE.size)
+            if entry != v:
+                return None, current
+            slots.add(slot)
+        return slots, current
+
+    # Journal interface, so the Monitors of the ingestion process and the
+    # web workers version rooms with the versions of the table.
+
+    def record(self, id):
+        record = self.lookup(id)
+        return record[3] if record else self.version
+
+    def since(self, version):
+        if version is None:
+            return None
+        slots, _ = self.changes(version)
+        if slots is None:
+            return None
+        return {self.read(slot)[0] for slot in slots}
+
+class TableStore(object):
+    """
+    Read-only Monitor.db for web workers.  The ingestion process owns the
+    real store; edits reach it through the command queue.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    def get(self, key):
+        record = self._table.lookup(tuple(key.split('-')))
+        return record[2] if record else None
+
+    def set(self, key, value):
+        pass
+
+    def keys(self):
+        return ['%s-%s'%self._table.read(slot)[0] for slot in range(self._table.count)]
+
+class Follower(object):
+    """
+    Stands in for the MQTT Protocol in a web worker: applies the changes
+    in the room table to the worker's Monitor and forwards max edits made
+    in this worker's browsers to the ingestion process.
+    """
+
+    def __init__(self, table, commands, monitor, interval=0.1):
+        self._table = table
+        self._commands = commands
+        self._monitor = monitor
+        self._interval = interval
+        self._version = 0
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="table-follower", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(e)
+
+    def poll(self):
+        slots, version = self._table.changes(self._version)
+        if slots is None:
+            slots = range(self._table.count)
+
+        for slot in slots:
+            id, value, max, _ = self._table.read(slot)
+            room = self._monitor.ensure_room(id)
+            if room.occupancy_max != max:
+                room.occupancy_max = max
+            if room.occupancy_cur != value:
+                room.occupancy_cur = value
+                self._monitor.history.add(id, value)
+
+        self._version = version
+
+    def stats(self):
+        return {'table' : {'version' : self._version,
+                           'rooms'   : self._table.count}}
+
+    def publish_max(self, id, max):
+        record = self._table.lookup(id)
+        if record is None or record[2] != max:
+            self._commands.put(('max', id.floor, id.room, max))
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
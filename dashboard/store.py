@@ -0,0 +1,176 @@
+import abc
+import atexit
+import json
+import os
+import sqlite3
+import threading
+
+from jsonlog import JsonLog
+
+class Store(abc.ABC):
+    """
+    Key/value store for the dashboard's persistent room settings.
+
+    Reads are served from memory.  Writes are applied in memory right
+    away and written out by a background thread every sync_interval
+    seconds, so a burst of edits costs one write and one fsync.
+    """
+
+    def __init__(self, path, sync_interval=1.0):
+        self._path = path
+        self._sync_interval = sync_interval
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.RLock()
+        self._data = {}
+        self._dirty = {}
+
+        self.load()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="store-sync", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._dirty[key] = value
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def update(self, values):
+        with self._lock:
+            self._data.update(values)
+            self._dirty.update(values)
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if dirty:
+                self.write(dirty)
+
+    def run(self):
+        while not self._stopped.wait(self._sync_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(e)
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    @abc.abstractmethod
+    def load(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, values):
+        pass
+
+class LogStore(Store):
+    """
+    Append-only log (see jsonlog) of {"key": ..., "value": ...} records,
+    one per write.
+    """
+
+    def __init__(self, path, sync_interval=1.0, compact_ratio=4, compact_min=1000):
+        self._log = JsonLog(path, compact_ratio, compact_min)
+        super().__init__(path, sync_interval)
+
+    def load(self):
+        for record in self._log.load():
+            try:
+                self._data[record['key']] = record['value']
+            except (KeyError, TypeError):
+                continue
+
+    def write(self, values):
+        self._log.append([{'key' : key, 'value' : value} for key, value in values.items()])
+        if self._log.needs_compaction(len(self._data)):
+            self.compact()
+
+    def compact(self):
+        with self._io_lock:
+            self._log.compact([{'key' : key, 'value' : value} for key, value in self.items()])
+
+    def close(self):
+        super().close()
+        self._log.close()
+
+class SqliteStore(Store):
+    """
+    SQLite database in WAL mode.  Each sync commits the pending writes
+    in one transaction.  Once compact_min rows have been written since
+    the last checkpoint, the WAL is checkpointed into the database and
+    truncated.
+    """
+
+    def __init__(self, path, sync_interval=1.0, compact_min=1000):
+        self._compact_min = compact_min
+        self._records = 0
+        super().__init__(path, sync_interval)
+
+    def load(self):
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+        for key, value in self._db.execute("SELECT key, value FROM kv"):
+            self._data[key] = json.loads(value)
+
+    def write(self, values):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                                 [(k, json.dumps(v)) for k, v in values.items()])
+
+        self._records += len(values)
+        if self._records > self._compact_min:
+            self.compact()
+
+    def compact(self):
+        with self._io_lock:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._records = 0
+
+    def close(self):
+        super().close()
+        self._db.close()
+
+BACKENDS = {
+    'log'    : (LogStore, 'rooms.log'),
+    'sqlite' : (SqliteStore, 'rooms.sqlite'),
+}
+
+def open_store(backend='log', path=None, legacy='rooms.db', sync_interval=1.0):
+    """
+    Opens a store, importing the settings from a legacy pickledb file
+    (a single JSON object) the first time the store is created.
+    """
+    cls, default = BACKENDS[backend]
+    store = cls(path or default, sync_interval)
+
+    if not len(store) and legacy and os.path.exists(legacy):
+        with open(legacy, 'r') as f:
+            store.update(json.load(f))
+        store.flush()
+        print("imported %d entries from %s"%(len(store), legacy))
+
+    return store
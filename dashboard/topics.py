@@ -0,0 +1,112 @@
+import functools
+import re
+import threading
+
+class Route(object):
+    """
+    A topic shape such as 'sensors/{floor}/{room}/occupancy/cur'.
+
+    Segments in braces are captured; everything else must match
+    literally.  The 'room' capture names the room, and any other
+    captures (e.g. '{building}/{floor}') are joined with '_' to name the
+    floor.  The last segment is the leaf, which is swapped out to build
+    the sibling topics of a room (e.g. '.../occupancy/max').
+    """
+
+    SEGMENT = re.compile(r'\w+$')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+        parts = pattern.split('/')
+        self.length = len(parts)
+        self.leaf = parts[-1]
+        self.literals = []
+        self.captures = []
+        for i, part in enumerate(parts):
+            if part.startswith('{') and part.endswith('}'):
+                self.captures.append((i, part[1:-1]))
+            else:
+                self.literals.append((i, part))
+
+        names = [name for _, name in self.captures]
+        if 'room' not in names or len(names) < 2:
+            raise ValueError("route '%s' needs a {room} and at least one floor capture"%(pattern,))
+        if self.leaf.startswith('{'):
+            raise ValueError("route '%s' must end in a literal leaf"%(pattern,))
+
+        self.room = names.index('room')
+
+    @property
+    def filter(self):
+        parts = self.pattern.split('/')
+        for i, _ in self.captures:
+            parts[i] = '+'
+        return '/'.join(parts)
+
+    def match(self, parts):
+        for i, literal in self.literals:
+            if parts[i] != literal:
+                return None
+
+        values = [parts[i] for i, _ in self.captures]
+        for value in values:
+            if not Route.SEGMENT.match(value):
+                return None
+
+        room = values.pop(self.room)
+        return '_'.join(values), room
+
+class TopicRouter(object):
+    """
+    Maps MQTT topics to interned room ids.
+
+    Topics are split on '/' and checked against the routes with the same
+    depth and leaf, so no regex runs on the hot path.  Results are kept
+    in a bounded LRU since the set of topics is small and stable.
+    """
+
+    ROUTES = ('sensors/{floor}/{room}/occupancy/cur',)
+
+    def __init__(self, make_id, routes=ROUTES, cache_size=4096):
+        self._make_id = make_id
+        self._routes = [Route(r) for r in routes]
+
+        self._index = {}
+        for route in self._routes:
+            self._index.setdefault((route.length, route.leaf), []).append(route)
+
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._prefixes = {}
+
+        self.route = functools.lru_cache(maxsize=cache_size)(self._route)
+
+    @property
+    def filters(self):
+        return [route.filter for route in self._routes]
+
+    def _route(self, topic):
+        parts = topic.split('/')
+        for route in self._index.get((len(parts), parts[-1]), ()):
+            match = route.match(parts)
+            if match is not None:
+                break
+        else:
+            raise ValueError("no route for topic '%s'"%(topic,))
+
+        id = self._make_id(*match)
+        with self._lock:
+            id = self._ids.setdefault(id, id)
+            self._prefixes.setdefault(id, topic[:-len(route.leaf)])
+        return id
+
+    def topic(self, id, leaf):
+        """
+        Returns the topic for a room's leaf, following the shape its
+        '/cur' topic arrived on.
+        """
+        prefix = self._prefixes.get(id)
+        if prefix is None:
+            prefix = "sensors/%s/%s/occupancy/"%(id.floor, id.room)
+        return prefix + leaf
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+"""
+Headless load generator: simulates many occupancy sensors against a
+broker, then reports publish rates, broker message rates and, with
+--dashboard, the dashboard's push rate and end-to-end latency from
+sensor publish to Room.occupancy_cur update.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib.request
+
+import paho.mqtt.client as paho
+
+import codec
+import sensor
+
+class SimProtocol(sensor.Protocol):
+
+    def __init__(self, sim, broker, floor, room, window, qos, format):
+        self.ready = asyncio.Event()
+        self.published = 0
+        super().__init__(sim, broker, floor, room, asyncio.get_event_loop(), window, qos, format=format)
+        self.timestamps = True
+
+    def flush(self):
+        super().flush()
+        self.published += 1
+
+    def on_connect(self, client, userdata, flags, rc):
+        super().on_connect(client, userdata, flags, rc)
+        self.ready.set()
+
+class SimSensor(sensor.Sensor):
+    """
+    A headless Sensor, connected but not yet publishing.
+    """
+
+    def __init__(self, broker, floor, room, window, qos, format):
+        super().__init__(broker, floor, room, window, qos, format=format)
+
+        self.protocol = SimProtocol(self, self.broker, self.floor, self.room, window, qos, format)
+
+class Pattern(object):
+    """
+    Arrival patterns.  next() returns the delay until a sensor's next
+    event and whether it is an enter, given the fraction of the run that
+    has elapsed.
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+
+    def next(self, sim, elapsed):
+        if self.name == 'constant':
+            return 1.0 / self.rate, random.random() < 0.5
+
+        if self.name == 'shift':
+            # People arrive in a rush, stay a while, then leave in a rush.
+            if elapsed < 0.3:
+                return random.expovariate(self.rate * 5), random.random() < 0.9
+            if elapsed > 0.7:
+                return random.expovariate(self.rate * 5), random.random() < 0.1
+
+        # Poisson arrivals, biased towards leaving once the room is full.
+        return random.expovariate(self.rate), random.random() < (0.3 if sim.is_full() else 0.6)
+
+PATTERNS = ('poisson', 'constant', 'shift')
+
+async def drive(sim, pattern, start, duration):
+    while True:
+        elapsed = (time.monotonic() - start) / duration
+        delay, enter = pattern.next(sim, elapsed)
+        if elapsed + delay / duration >= 1.0:
+            return
+        await asyncio.sleep(delay)
+        if enter:
+            sim.on_enter()
+        else:
+            sim.on_leave()
+
+async def run_sensors(broker, names, pattern, duration, ramp, window, qos, format, clear):
+    sims = []
+    for floor, room in names:
+        sims.append(SimSensor(broker, floor, room, window, qos, format))
+        await asyncio.sleep(1.0 / ramp)
+
+    await asyncio.wait_for(asyncio.gather(*(sim.protocol.ready.wait() for sim in sims)), 60)
+    for sim in sims:
+        sim.publish()
+
+    start = time.monotonic()
+    await asyncio.gather(*(drive(sim, pattern, start, duration) for sim in sims))
+    # Give the last coalesced updates and QoS 2 handshakes time to finish.
+    await asyncio.sleep(2 + window)
+    elapsed = time.monotonic() - start
+
+    if clear:
+        # Leave no retained counts behind for the simulated rooms.  Each
+        # sensor clears its own topic, keeping within per-client limits.
+        infos = [sim.protocol._client.publish(sim.protocol._topic + "/cur", b'', qos=1, retain=True)
+                 for sim in sims]
+        deadline = time.monotonic() + 10
+        while not all(info.is_published() for info in infos) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    for sim in sims:
+        sim.protocol._client.disconnect()
+    return sum(sim.protocol.published for sim in sims), elapsed
+
+def run_shard(args):
+    broker, names, pattern, rate, duration, ramp, window, qos, format, clear = args
+    return asyncio.run(run_sensors(broker, names, Pattern(pattern, rate), duration, ramp, window, qos, format, clear))
+
+class BrokerStats(object):
+    """
+    Samples the broker's message counters from its $SYS topics.
+    """
+
+    TOPICS = ('$SYS/broker/messages/received', '$SYS/broker/messages/sent')
+
+    def __init__(self, broker):
+        self._lock = threading.Lock()
+        self.samples = {topic : [] for topic in BrokerStats.TOPICS}
+
+        self._client = paho.Client("loadgen-sys", True)
+        self._client.on_connect = self.on_connect
+        self._client.on_message = self.on_message
+        self._client.connect_async(broker)
+        self._client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        self._client.subscribe([(topic, 0) for topic in BrokerStats.TOPICS])
+
+    def on_message(self, client, userdata, msg):
+        with self._lock:
+            self.samples[msg.topic].append((time.monotonic(), int(msg.payload)))
+
+    def rate(self, topic):
+        with self._lock:
+            samples = self.samples[topic]
+            if len(samples) < 2:
+                return None
+            (t0, v0), (t1, v1) = samples[0], samples[-1]
+            return (v1 - v0) / (t1 - t0)
+
+    def stop(self):
+        self._client.loop_stop()
+        self._client.disconnect()
+
+def dashboard_stats(url):
+    with urllib.request.urlopen(url.rstrip('/') + '/stats', timeout=10) as response:
+        return json.loads(response.read())
+
+def latency_diff(before, after):
+    """
+    Returns (count, avg ms, {percentile: ms}, slowest bucket) of the
+    samples a dashboard Latency recorded between its before and after
+    stats, or None if there are none.  Only its histogram's bucket
+    counts can be told apart by run, so the percentiles are estimates,
+    interpolated linearly within the bucket they fall in; one in the
+    open-ended last bucket is that bucket's label, e.g. '>5000'.  The
+    slowest sample is only known by the label of its bucket, e.g. '<=50'.
+    """
+    count = after['count'] - before['count']
+    if count <= 0:
+        return None
+    total = after['avg_ms'] * after['count'] - before['avg_ms'] * before['count']
+
+    # Sorted by bound, since JSON may have reordered the labels.
+    buckets = sorted((float(label.lstrip('<=>')), label.startswith('>'), label,
+                      n - before['buckets'].get(label, 0))
+                     for label, n in after['buckets'].items())
+
+    percentiles = {}
+    for p in (50, 90, 99):
+        rank = p * count / 100.0
+        seen = 0
+        lower = 0.0
+        for bound, open_ended, label, n in buckets:
+            if n > 0 and seen + n >= rank:
+                percentiles[p] = label if open_ended else lower + (bound - lower) * (rank - seen) / n
+                break
+            seen += n
+            lower = bound
+    slowest = [label for _, _, label, n in buckets if n > 0][-1]
+    return count, total / count, percentiles, slowest
+
+def estimate(ms):
+    return '~%.1fms'%(ms,) if isinstance(ms, float) else '%sms'%(ms,)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ACME Room Occupancy load generator")
+    parser.add_argument("-b", "--broker", help="MQTT broker address", required=True)
+    parser.add_argument("-d", "--dashboard", help="Dashboard URL, e.g. http://localhost:8050, to report its push rate and latency")
+    parser.add_argument("-n", "--sensors", help="Number of simulated sensors", type=int, default=1000)
+    parser.add_argument("--rooms-per-floor", help="Simulated rooms per floor", type=int, default=50)
+    parser.add_argument("--prefix", help="Floor name prefix of the simulated sensors", default="load")
+    parser.add_argument("--pattern", help="Enter/leave arrival pattern", choices=PATTERNS, default='poisson')
+    parser.add_argument("--rate", help="Events per second per sensor", type=float, default=0.5)
+    parser.add_argument("-t", "--duration", help="Seconds to generate load for", type=float, default=60)
+    parser.add_argument("--ramp", help="New connections per second per process", type=float, default=200)
+    parser.add_argument("--coalesce", help="Milliseconds each sensor coalesces count changes for after a publish", type=float, default=250)
+    parser.add_argument("--qos", help="MQTT QoS level of count updates", type=int, choices=(0, 1, 2), default=2)
+    parser.add_argument("--format", help="Encoding of count updates", choices=codec.FORMATS, default=codec.JSON)
+    parser.add_argument("-P", "--processes", help="Number of processes to spread the sensors over", type=int, default=1)
+    parser.add_argument("--keep-retained", help="Leave the simulated sensors' retained counts on the broker",
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    names = [("%s%d"%(args.prefix, i // args.rooms_per_floor), str(i % args.rooms_per_floor))
+             for i in range(args.sensors)]
+    shards = [(args.broker, names[i::args.processes], args.pattern, args.rate, args.duration, args.ramp,
+               args.coalesce / 1000.0, args.qos, args.format, not args.keep_retained)
+              for i in range(args.processes)]
+
+    broker = BrokerStats(args.broker)
+    before = dashboard_stats(args.dashboard) if args.dashboard else None
+
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.map(run_shard, shards)
+
+    published = sum(r[0] for r in results)
+    elapsed = max(r[1] for r in results)
+    broker.stop()
+
+    print("sensors:            %d over %d process(es), pattern %s"%(args.sensors, args.processes, args.pattern))
+    print("published:          %d messages in %.1fs (%.1f msg/s)"%(published, elapsed, published / elapsed))
+    for topic in BrokerStats.TOPICS:
+        rate = broker.rate(topic)
+        print("%-19s %s"%(topic.rsplit('/', 1)[1] + ':', "%.1f msg/s"%(rate,) if rate is not None else "n/a (no $SYS samples)"))
+
+    if args.dashboard:
+        after = dashboard_stats(args.dashboard)
+        push = {k : after['push'][k] - before['push'][k] for k in ('received', 'pushed', 'frames')}
+        print("dashboard updates:  %.1f/s received, %.1f/s pushed in %.1f frames/s"%(
+            push['received'] / elapsed, push['pushed'] / elapsed, push['frames'] / elapsed))
+        e2e = latency_diff(before['e2e'], after['e2e']) if 'e2e' in after else None
+        if e2e:
+            count, avg, percentiles, slowest = e2e
+            print("end-to-end latency: avg %.1fms over %d updates"%(avg, count))
+            print("  from the dashboard's histogram buckets: p50 %s  p90 %s  p99 %s  slowest %sms"%(
+                estimate(percentiles[50]), estimate(percentiles[90]), estimate(percentiles[99]), slowest))
@@ -0,0 +1,87 @@
+import collections
+import json
+import os
+
+class Outbox(object):
+    """
+    Latest state per topic, so a sensor that was offline sends one
+    message per topic when it reconnects instead of replaying every
+    change.
+
+    With a path the states are also appended to a file, one JSON line
+    per change and synced to disk before put() returns, so they survive
+    a restart or a power loss.  Changes are already coalesced per
+    publish window, so that is at most a few syncs a second.  Once the
+    file passes limit lines it is rewritten with one line per topic, and
+    at most max_topics topics are kept, so memory and disk stay bounded.
+    """
+
+    def __init__(self, path=None, max_topics=64, limit=1000):
+        self._path = path
+        self._max_topics = max_topics
+        self._limit = limit
+
+        self._topics = collections.OrderedDict()
+        self._lines = 0
+        self._file = None
+
+        if path:
+            self.load()
+            self.compact()
+
+    def load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write.
+                        break
+                    self._store(entry['topic'], entry['state'])
+        except FileNotFoundError:
+            pass
+
+    def _store(self, topic, state):
+        self._topics[topic] = state
+        self._topics.move_to_end(topic)
+        while len(self._topics) > self._max_topics:
+            self._topics.popitem(last=False)
+
+    def put(self, topic, state):
+        self._store(topic, state)
+        if self._file is None:
+            return
+
+        self._file.write(json.dumps({'topic' : topic, 'state' : state}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lines += 1
+        if self._lines > self._limit:
+            self.compact()
+
+    def get(self, topic):
+        return self._topics.get(topic)
+
+    def items(self):
+        return list(self._topics.items())
+
+    def compact(self):
+        if self._file is not None:
+            self._file.close()
+
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            for topic, state in self._topics.items():
+                f.write(json.dumps({'topic' : topic, 'state' : state}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+
+        self._file = open(self._path, 'a')
+        self._lines = len(self._topics)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
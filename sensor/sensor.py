@@ -2,167 +2,402 @@
 
 import sys,os
 
-import npyscreen
-import json
+import asyncio
+import select
+import threading
+import time
 
 import paho.mqtt.client as paho
 
-class MyTheme(npyscreen.ThemeManager):
-    default_colors = {
-        'DEFAULT'     : 'BLACK_WHITE',
-        'FORMDEFAULT' : 'BLACK_WHITE',
-        'NO_EDIT'     : 'BLUE_BLACK',
-        'STANDOUT'    : 'CYAN_BLACK',
-        'CURSOR'      : 'WHITE_BLACK',
-        'CURSOR_INVERSE': 'BLACK_WHITE',
-        'LABEL'       : 'GREEN_BLACK',
-        'LABELBOLD'   : 'WHITE_BLACK',
-        'CONTROL'     : 'YELLOW_BLACK',
-        'WARNING'     : 'RED_BLACK',
-        'CRITICAL'    : 'BLACK_RED',
-        'GOOD'        : 'GREEN_BLACK',
-        'GOODHL'      : 'GREEN_BLACK',
-        'VERYGOOD'    : 'BLACK_GREEN',
-        'CAUTION'     : 'YELLOW_BLACK',
-        'CAUTIONHL'   : 'BLACK_YELLOW',
-    }
-
-class ColorBox(npyscreen.wgwidget.Widget):
+import codec
+from outbox import Outbox
+
+class AsyncioHelper(object):
     """
-    Draws a box on the screen, filled with the specified background
-    color.
+    Drives a paho client from an asyncio loop instead of a loop_start()
+    thread per client.
     """
-    def __init__(self, screen, footer=None, *args, **keywords):
-        super(ColorBox, self).__init__(screen, editable=False, *args, **keywords)
-        self.footer = footer
-        if 'color' in keywords:
-            self.color = keywords['color'] or 'LABEL'
-        else:
-            self.color = 'LABEL'
-
-    def update(self, clear=True):
-        if clear: self.clear()
-        if self.hidden:
-            self.clear()
-            return False
-
-        HEIGHT = self.height - 1
-        WIDTH = self.width - 1
 
-        # draw box.
-        for y in range(self.rely, self.rely + HEIGHT):
-            self.parent.curses_pad.hline(y, self.relx, ' ', WIDTH, self.parent.theme_manager.findPair(self, self.color))
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.misc = None
 
-    def when_value_edited(self):
-        self.editing = False
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
 
-class UX(npyscreen.FormBaseNew):
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
 
-    def __init__(self, sensor, *args, **kwargs):
-        npyscreen.setTheme(MyTheme)
-
-        super().__init__(lines=20, columns=40, *args, **kwargs)
-        self.keypress_timeout = 1
-        self._sensor = sensor
-
-        self.name = "Occupancy Sensor (%s %s)"%(self._sensor.floor, self._sensor.room)
-
-    def create(self):
-        self._box = self.add(ColorBox, width=20, height=10, relx=9, rely=3)
-        self._msg1 = self.add(npyscreen.wgtextbox.TextfieldBase, relx=17, rely=7, editable=False)
-        self._msg2 = self.add(npyscreen.wgtextbox.TextfieldBase, relx=16, rely=11, editable=False)
-        self._enter = self.add(npyscreen.ButtonPress, name = "Enter", width=10, relx=5, rely=-4, color='CURSOR_INVERSE', when_pressed_function=self.enter_press)
-        self._leave = self.add(npyscreen.ButtonPress, name = "Leave", relx=25, rely=-4, color='CURSOR_INVERSE', when_pressed_function=self.leave_press)
-
-    def while_waiting(self):
-        self.update()
-
-    def update(self):
-        self._msg2.value = "(%s/%s)"%(self._sensor.occupancy_cur, self._sensor.occupancy_max)
-        if self._sensor.is_full():
-            self._box.color = 'CRITICAL'
-            self._msg1.color = 'CRITICAL'
-            self._msg2.color = 'CRITICAL'
-            self._msg1.value = "WAIT"
-        else:
-            self._box.color = 'VERYGOOD'
-            self._msg1.color = 'VERYGOOD'
-            self._msg2.color = 'VERYGOOD'
-            self._msg1.value = "GO"
-        self.display()
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
 
-    def enter_press(self):
-        self._sensor.on_enter()
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
 
-    def leave_press(self):
-        self._sensor.on_leave()
+    async def misc_loop(self):
+        while self.client.loop_misc() == paho.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
 
 class Protocol(object):
+    """
+    Publishes the sensor's count.  A publish within the coalescing window
+    of the previous one is held back until the window closes, and then
+    only the latest count is sent, so a burst of events costs one message
+    per window.  Each message carries a sequence number, which lets the
+    dashboard discard updates that arrive out of order.
+
+    Updates go through the outbox, which keeps only the latest state per
+    topic.  While disconnected nothing is handed to paho; on (re)connect
+    the outbox is sent once.
+    """
 
-    def __init__(self, sensor, broker, floor, room):
+    RECONNECT_DELAY = 5
+
+    def __init__(self, sensor, broker, floor, room, loop=None, window=0.0, qos=2, outbox=None,
+                 format=codec.JSON):
         self._sensor = sensor
         self._broker = broker
+        self._loop = loop
 
         self._name = "%s/%s"%(floor, room)
         self._topic = "sensors/%s/occupancy"%(self._name)
 
+        self.window = window
+        self.qos = qos
+        self.format = format
+
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.connected = False
+        self.resyncs = 0
+
+        # Seeded from the clock so numbers keep rising across restarts,
+        # and from the outbox in case the clock went backwards.
+        self._seq = int(time.time() * 1000)
+        state = self.last_state()
+        if state is not None:
+            self._seq = max(self._seq, state['seq'])
+        self._last = 0.0
+        self._pending = False
+        self._lock = threading.Lock()
+
+        # Stamp each update with its publish time, for measuring latency.
+        self.timestamps = False
+
         self._client = paho.Client(self._name, False)
         self._client.on_connect = self.on_connect
+        self._client.on_disconnect = self.on_disconnect
         self._client.on_message = self.on_message
 
         self.start()
 
     def start(self):
-        self._client.connect_async(self._broker)
-        self._client.loop_start()
+        if self._loop is None:
+            self._client.connect_async(self._broker)
+            self._client.loop_start()
+        else:
+            # Share the caller's asyncio loop instead of running a network
+            # thread; reconnects are then ours to schedule.
+            AsyncioHelper(self._loop, self._client)
+            self.connect()
+
+    def connect(self):
+        try:
+            self._client.connect(self._broker)
+        except OSError as e:
+            print(e)
+            self._loop.call_later(Protocol.RECONNECT_DELAY, self.connect)
 
     def on_connect(self, client, userdata, flags, rc):
         self._client.subscribe(self._topic + "/max")
 
+        with self._lock:
+            self.connected = True
+            pending = self.outbox.items()
+        for topic, state in pending:
+            self.send(topic, state)
+        self.resyncs += 1
+
+    def on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self.connected = False
+        if self._loop is not None and rc != paho.MQTT_ERR_SUCCESS:
+            self._loop.call_later(Protocol.RECONNECT_DELAY, self.connect)
+
     def on_message(self, client, userdata, msg):
-        payload = json.loads(msg.payload)
-        if payload['value']:
-            self._sensor.occupancy_max = payload['value']
-        else:
-            self._sensor.occupancy_max = 0
+        try:
+            value = codec.decode(msg.payload)['value']
+        except (ValueError, KeyError, TypeError) as e:
+            print(e)
+            return
+        self._sensor.occupancy_max = value or 0
 
     def publish_change(self):
-        payload = {"value" : self._sensor.occupancy_cur}
+        with self._lock:
+            if self._pending:
+                return
+            wait = self._last + self.window - time.monotonic()
+            if wait > 0:
+                self._pending = True
+                self.schedule(wait, self.flush)
+                return
+        self.flush()
+
+    def schedule(self, delay, callback):
+        if self._loop is not None:
+            self._loop.call_later(delay, callback)
+        else:
+            timer = threading.Timer(delay, callback)
+            timer.daemon = True
+            timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._pending = False
+            self._last = time.monotonic()
+            self._seq += 1
+
+            state = {"value" : self._sensor.occupancy_cur, "seq" : self._seq}
+            if self.timestamps:
+                state["ts"] = time.time()
+
+            topic = self._topic + "/cur"
+            self.outbox.put(topic, state)
+            if not self.connected:
+                return
+        self.send(topic, state)
+
+    def send(self, topic, state):
         try:
-            self._client.publish(self._topic + "/cur", json.dumps(payload), qos=2, retain=True)
+            self._client.publish(topic, codec.encode(state, self.format), qos=self.qos, retain=True)
         except Exception as e:
             print(e)
             raise(e)
 
-class OccupancySensor(npyscreen.NPSAppManaged):
+    def last_state(self):
+        """
+        The last count handed to the outbox, e.g. before a restart.
+        """
+        return self.outbox.get(self._topic + "/cur")
+
+class Sensor(object):
+    """
+    Occupancy count of one room.  Listeners are called with the sensor
+    whenever the count or the room's maximum changes.
+    """
 
-    def __init__(self, broker, floor, room):
-        super().__init__()
+    def __init__(self, broker, floor, room, window=0.0, qos=2, outbox=None, format=codec.JSON):
         self.broker = broker
         self.floor = floor
         self.room = room
 
-        self.occupancy_max = 2
+        self.window = window
+        self.qos = qos
+        self.outbox = outbox
+        self.format = format
+
+        self._occupancy_max = 2
         self.occupancy_cur = 0
 
-    def onStart(self):
-        self.ux = self.addForm("MAIN", UX, self)
-        self.protocol = Protocol(self, self.broker,
-                                 self.floor, self.room)
+        self.protocol = None
+        self._listeners = []
 
-        self.protocol.publish_change()
+    @property
+    def occupancy_max(self):
+        return self._occupancy_max
+
+    @occupancy_max.setter
+    def occupancy_max(self, value):
+        if value != self._occupancy_max:
+            self._occupancy_max = value
+            self.changed()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def changed(self):
+        for listener in self._listeners:
+            listener(self)
+
+    def start(self, loop=None):
+        self.protocol = Protocol(self, self.broker,
+                                 self.floor, self.room, loop,
+                                 self.window, self.qos, Outbox(self.outbox), self.format)
+
+        # Pick up where a previous run left off; the resync on connect
+        # sends the restored count.
+        state = self.protocol.last_state()
+        if state is not None:
+            self.occupancy_cur = state['value']
+            self.changed()
+        else:
+            self.publish()
 
     def is_full(self):
         return self.occupancy_cur >= self.occupancy_max
 
+    def publish(self):
+        self.protocol.publish_change()
+
     def on_enter(self):
         self.occupancy_cur += 1
-        self.protocol.publish_change()
+        self.publish()
+        self.changed()
 
     def on_leave(self):
-        if self.occupancy_cur > 0:
-            self.occupancy_cur -= 1
-        self.protocol.publish_change()
+        if self.occupancy_cur == 0:
+            return
+        self.occupancy_cur -= 1
+        self.publish()
+        self.changed()
+
+class Gpio(object):
+    """
+    Rising edges on sysfs GPIO pins, handled on the asyncio loop.
+
+    The pins' value files signal edges with POLLPRI, which the loop's
+    selector does not watch, so they are registered with an epoll of
+    their own whose descriptor the loop watches instead.
+    """
+
+    ROOT = '/sys/class/gpio'
+
+    def __init__(self, loop, pins):
+        self._epoll = select.epoll()
+        self._pins = {}
+
+        for pin, callback in pins.items():
+            path = os.path.join(Gpio.ROOT, 'gpio%d'%(pin,))
+            if not os.path.exists(path):
+                self._write(os.path.join(Gpio.ROOT, 'export'), pin)
+            self._write(os.path.join(path, 'direction'), 'in')
+            self._write(os.path.join(path, 'edge'), 'rising')
+
+            value = open(os.path.join(path, 'value'), 'rb', buffering=0)
+            value.read()
+            self._epoll.register(value.fileno(), select.EPOLLPRI | select.EPOLLERR)
+            self._pins[value.fileno()] = (value, callback)
+
+        loop.add_reader(self._epoll.fileno(), self.on_ready)
+
+    @staticmethod
+    def _write(path, value):
+        with open(path, 'w') as f:
+            f.write(str(value))
+
+    def on_ready(self):
+        for fd, _ in self._epoll.poll(0):
+            value, callback = self._pins[fd]
+            value.seek(0)
+            if value.read(1) == b'1':
+                callback()
+
+class Daemon(object):
+    """
+    Runs a sensor without a terminal.  Enter/leave events come from
+    stdin, a socket and/or GPIO pins, all on the asyncio loop that also
+    drives the MQTT client, so an idle sensor just sleeps in the
+    selector and prints or publishes only when the count changes.
+
+    Commands are one per line: enter (e, +), leave (l, -) or status (s).
+    Socket clients get the status back after every command.
+    """
+
+    ENTER = ('enter', 'e', '+')
+    LEAVE = ('leave', 'l', '-')
+    STATUS = ('status', 's')
+
+    def __init__(self, sensor, quiet=False):
+        self._sensor = sensor
+        self._quiet = quiet
+        self._loop = None
+        self._stdin = None
+        self._server = None
+        self._gpio = None
+
+        self._sensor.add_listener(self.on_change)
+
+    def status(self):
+        return "%s/%s %s"%(self._sensor.occupancy_cur, self._sensor.occupancy_max,
+                           "WAIT" if self._sensor.is_full() else "GO")
+
+    def on_change(self, sensor):
+        if not self._quiet:
+            print(self.status(), flush=True)
+
+    def command(self, line):
+        """
+        Applies one command.  Returns the status for a status request,
+        otherwise None.
+        """
+        word = line.strip().lower()
+        if word in Daemon.ENTER:
+            self._sensor.on_enter()
+        elif word in Daemon.LEAVE:
+            self._sensor.on_leave()
+        elif word in Daemon.STATUS:
+            return self.status()
+        elif word:
+            raise ValueError("unknown command '%s'"%(word,))
+
+    async def read_stdin(self):
+        reader = asyncio.StreamReader()
+        try:
+            await self._loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (ValueError, PermissionError):
+            # stdin is a regular file or /dev/null, which can't be polled.
+            return
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                reply = self.command(line.decode())
+            except ValueError as e:
+                reply = e
+            if reply is not None:
+                print(reply, flush=True)
+
+    async def on_client(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                reply = self.command(line.decode()) or self.status()
+            except ValueError as e:
+                reply = str(e)
+            writer.write((reply + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, address):
+        if address.startswith('unix:'):
+            return await asyncio.start_unix_server(self.on_client, address[len('unix:'):])
+        host, _, port = address.rpartition(':')
+        return await asyncio.start_server(self.on_client, host or None, int(port))
+
+    async def run(self, stdin=True, listen=None, gpio=None):
+        self._loop = asyncio.get_running_loop()
+        self._sensor.start(self._loop)
+
+        # Keep references: the loop only holds weak ones to tasks.
+        if stdin:
+            self._stdin = self._loop.create_task(self.read_stdin())
+        if listen:
+            self._server = await self.serve(listen)
+        if gpio:
+            self._gpio = Gpio(self._loop, gpio)
+
+        await self._loop.create_future()
 
 if __name__ == "__main__":
     import argparse
@@ -171,11 +406,40 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--broker", help="MQTT broker address", required=True)
     parser.add_argument("-f", "--floor", help="Floor where sensor is located", required=True)
     parser.add_argument("-r", "--room", help="Room where sensor is located", required=True)
+    parser.add_argument("--coalesce", help="Milliseconds to coalesce count changes for after a publish", type=float, default=250)
+    parser.add_argument("--qos", help="MQTT QoS level of count updates", type=int, choices=(0, 1, 2), default=2)
+    parser.add_argument("--format", help="Encoding of count updates; the dashboard reads both", choices=codec.FORMATS, default=codec.JSON)
+    parser.add_argument("--outbox", help="File keeping the latest count across restarts and broker outages (default: outbox-<floor>-<room>.log)")
+    parser.add_argument("--headless", help="Run without the terminal UI, reading enter/leave events from stdin, --listen and --gpio-* instead", action="store_true")
+    parser.add_argument("--listen", help="Headless: accept commands on a socket, as [host:]port or unix:path")
+    parser.add_argument("--gpio-enter", help="Headless: sysfs GPIO pin whose rising edge counts an enter", type=int)
+    parser.add_argument("--gpio-leave", help="Headless: sysfs GPIO pin whose rising edge counts a leave", type=int)
+    parser.add_argument("--no-stdin", help="Headless: don't read commands from stdin", action="store_true")
+    parser.add_argument("-q", "--quiet", help="Headless: don't print the status when it changes", action="store_true")
 
     args = parser.parse_args()
+    outbox = args.outbox or "outbox-%s-%s.log"%(args.floor, args.room)
 
-    App = OccupancySensor(args.broker, args.floor, args.room)
-    try:
-        App.run()
-    except KeyboardInterrupt:
-        pass
+    if args.headless:
+        sensor = Sensor(args.broker, args.floor, args.room, args.coalesce / 1000.0, args.qos, outbox, args.format)
+
+        gpio = {}
+        if args.gpio_enter is not None:
+            gpio[args.gpio_enter] = sensor.on_enter
+        if args.gpio_leave is not None:
+            gpio[args.gpio_leave] = sensor.on_leave
+
+        daemon = Daemon(sensor, args.quiet)
+        try:
+            asyncio.run(daemon.run(not args.no_stdin, args.listen, gpio))
+        except KeyboardInterrupt:
+            pass
+    else:
+        # Only load curses when there's a terminal UI to draw.
+        from tui import OccupancySensor
+
+        App = OccupancySensor(args.broker, args.floor, args.room, args.coalesce / 1000.0, args.qos, outbox, args.format)
+        try:
+            App.run()
+        except KeyboardInterrupt:
+            pass
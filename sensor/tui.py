@@ -0,0 +1,121 @@
+"""
+Terminal UI for the occupancy sensor.  Only imported when the sensor
+runs with a terminal, so headless sensors never load curses.
+"""
+
+import npyscreen
+
+import codec
+from sensor import Sensor
+
+class MyTheme(npyscreen.ThemeManager):
+    default_colors = {
+        'DEFAULT'     : 'BLACK_WHITE',
+        'FORMDEFAULT' : 'BLACK_WHITE',
+        'NO_EDIT'     : 'BLUE_BLACK',
+        'STANDOUT'    : 'CYAN_BLACK',
+        'CURSOR'      : 'WHITE_BLACK',
+        'CURSOR_INVERSE': 'BLACK_WHITE',
+        'LABEL'       : 'GREEN_BLACK',
+        'LABELBOLD'   : 'WHITE_BLACK',
+        'CONTROL'     : 'YELLOW_BLACK',
+        'WARNING'     : 'RED_BLACK',
+        'CRITICAL'    : 'BLACK_RED',
+        'GOOD'        : 'GREEN_BLACK',
+        'GOODHL'      : 'GREEN_BLACK',
+        'VERYGOOD'    : 'BLACK_GREEN',
+        'CAUTION'     : 'YELLOW_BLACK',
+        'CAUTIONHL'   : 'BLACK_YELLOW',
+    }
+
+class ColorBox(npyscreen.wgwidget.Widget):
+    """
+    Draws a box on the screen, filled with the specified background
+    color.
+    """
+    def __init__(self, screen, footer=None, *args, **keywords):
+        super(ColorBox, self).__init__(screen, editable=False, *args, **keywords)
+        self.footer = footer
+        if 'color' in keywords:
+            self.color = keywords['color'] or 'LABEL'
+        else:
+            self.color = 'LABEL'
+
+    def update(self, clear=True):
+        if clear: self.clear()
+        if self.hidden:
+            self.clear()
+            return False
+
+        HEIGHT = self.height - 1
+        WIDTH = self.width - 1
+
+        # draw box.
+        for y in range(self.rely, self.rely + HEIGHT):
+            self.parent.curses_pad.hline(y, self.relx, ' ', WIDTH, self.parent.theme_manager.findPair(self, self.color))
+
+    def when_value_edited(self):
+        self.editing = False
+
+class UX(npyscreen.FormBaseNew):
+
+    def __init__(self, sensor, *args, **kwargs):
+        npyscreen.setTheme(MyTheme)
+
+        super().__init__(lines=20, columns=40, *args, **kwargs)
+        self.keypress_timeout = 1
+        self._sensor = sensor
+
+        # Max changes arrive on the MQTT thread; the form only redraws
+        # when the sensor reports a change.
+        self._dirty = True
+        self._sensor.add_listener(self.on_change)
+
+        self.name = "Occupancy Sensor (%s %s)"%(self._sensor.floor, self._sensor.room)
+
+    def create(self):
+        self._box = self.add(ColorBox, width=20, height=10, relx=9, rely=3)
+        self._msg1 = self.add(npyscreen.wgtextbox.TextfieldBase, relx=17, rely=7, editable=False)
+        self._msg2 = self.add(npyscreen.wgtextbox.TextfieldBase, relx=16, rely=11, editable=False)
+        self._enter = self.add(npyscreen.ButtonPress, name = "Enter", width=10, relx=5, rely=-4, color='CURSOR_INVERSE', when_pressed_function=self.enter_press)
+        self._leave = self.add(npyscreen.ButtonPress, name = "Leave", relx=25, rely=-4, color='CURSOR_INVERSE', when_pressed_function=self.leave_press)
+
+    def on_change(self, sensor):
+        self._dirty = True
+
+    def while_waiting(self):
+        if self._dirty:
+            self.update()
+
+    def update(self):
+        self._dirty = False
+        self._msg2.value = "(%s/%s)"%(self._sensor.occupancy_cur, self._sensor.occupancy_max)
+        if self._sensor.is_full():
+            self._box.color = 'CRITICAL'
+            self._msg1.color = 'CRITICAL'
+            self._msg2.color = 'CRITICAL'
+            self._msg1.value = "WAIT"
+        else:
+            self._box.color = 'VERYGOOD'
+            self._msg1.color = 'VERYGOOD'
+            self._msg2.color = 'VERYGOOD'
+            self._msg1.value = "GO"
+        self.display()
+
+    def enter_press(self):
+        self._sensor.on_enter()
+        self.while_waiting()
+
+    def leave_press(self):
+        self._sensor.on_leave()
+        self.while_waiting()
+
+class OccupancySensor(npyscreen.NPSAppManaged):
+
+    def __init__(self, broker, floor, room, window=0.0, qos=2, outbox=None, format=codec.JSON):
+        super().__init__()
+        self.sensor = Sensor(broker, floor, room, window, qos, outbox, format)
+
+    def onStart(self):
+        self.ux = self.addForm("MAIN", UX, self.sensor)
+        self.sensor.start()
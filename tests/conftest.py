@@ -0,0 +1,27 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load(component, name):
+    """
+    Imports a component's module.  The broker, dashboard and sensor are
+    each run from their own directory and share module names (codec,
+    topics), so each is loaded as <component>_<name>, with only its own
+    directory on the path while it imports its siblings.
+    """
+    key = '%s_%s'%(component, name)
+    if key in sys.modules:
+        return sys.modules[key]
+
+    directory = os.path.join(ROOT, component)
+    spec = importlib.util.spec_from_file_location(key, os.path.join(directory, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, directory)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    sys.modules[key] = module
+    return module
@@ -0,0 +1,89 @@
+import json
+import time
+
+from collections import namedtuple
+
+import pytest
+
+from conftest import load
+
+alerts = load('dashboard', 'alerts')
+
+Id = namedtuple('Id', ('floor', 'room'))
+
+@pytest.fixture
+def published():
+    return []
+
+def engine(published, rules, **kwargs):
+    publish = lambda topic, payload: published.append((topic, json.loads(payload)))
+    return alerts.AlertEngine(publish, rules, interval=60, **kwargs)
+
+def states(published):
+    return [(topic, alert['state']) for topic, alert in published]
+
+def test_rules_must_test():
+    with pytest.raises(TypeError):
+        alerts.Rule('incomplete')
+
+def test_over_capacity_raises_and_clears(published):
+    alerter = engine(published, [alerts.OverCapacity()])
+    alerter.update(Id('1', 'a'), 3, 2)
+    alerter.update(Id('1', 'a'), 4, 2)
+    alerter.update(Id('1', 'a'), 1, 2)
+    alerter.stop()
+    assert states(published) == [('alerts/1/a/over-capacity', 'raised'),
+                                 ('alerts/1/a/over-capacity', 'cleared')]
+    assert published[0][1]['value'] == 3
+
+def test_sustained_waits_for_its_duration(published):
+    alerter = engine(published, [alerts.Sustained(0.5, duration=10)])
+    alerter.update(Id('1', 'a'), 6, 10)
+    alerter.update(Id('1', 'b'), 6, 10)
+    alerter.update(Id('1', 'b'), 2, 10)
+    assert published == []
+
+    with alerter._lock:
+        alerter.expire(time.time() + 11)
+    alerter.flush()
+    alerter.stop()
+    # Room b dropped below the fraction before its deadline.
+    assert states(published) == [('alerts/1/a/sustained', 'raised')]
+
+def test_floor_limit_follows_the_total(published):
+    alerter = engine(published, [alerts.FloorLimit({'1' : 5})])
+    alerter.update(Id('1', 'a'), 3, 10)
+    alerter.update(Id('1', 'b'), 3, 10)
+    alerter.update(Id('2', 'a'), 9, 10)
+    alerter.update(Id('1', 'a'), 1, 10)
+    alerter.stop()
+    assert states(published) == [('alerts/1/floor-limit', 'raised'),
+                                 ('alerts/1/floor-limit', 'cleared')]
+    assert published[0][1]['value'] == 6
+
+def test_rate_limit_coalesces_flapping(published):
+    alerter = engine(published, [alerts.OverCapacity()], rate=0.01, burst=1)
+    alerter.update(Id('1', 'a'), 3, 2)
+    alerter.update(Id('1', 'b'), 3, 2)
+    for value in (1, 3, 1, 3):
+        alerter.update(Id('1', 'a'), value, 2)
+    alerter.stop()
+
+    # Only the first alert had a token; b's waits, and a's flapping
+    # collapsed into its pending alert.
+    assert states(published) == [('alerts/1/a/over-capacity', 'raised')]
+    stats = alerter.stats()
+    assert stats['sent'] == 1
+    assert stats['coalesced'] == 3
+    assert stats['pending'] == 2
+
+def test_flapping_back_to_the_published_state_sends_nothing(published):
+    alerter = engine(published, [alerts.OverCapacity()], rate=0.01, burst=1)
+    alerter.update(Id('1', 'a'), 3, 2)
+    alerter.update(Id('1', 'a'), 1, 2)
+    alerter.update(Id('1', 'a'), 3, 2)
+    alerter._tokens = 1
+    alerter.flush()
+    alerter.stop()
+    assert states(published) == [('alerts/1/a/over-capacity', 'raised')]
+    assert alerter.stats()['pending'] == 0
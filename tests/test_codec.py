@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from conftest import ROOT, load
+
+COMPONENTS = ('broker', 'dashboard', 'sensor')
+
+def test_copies_are_identical():
+    copies = {}
+    for component in COMPONENTS:
+        with open(os.path.join(ROOT, component, 'codec.py'), 'rb') as f:
+            copies[component] = f.read()
+    assert copies['broker'] == copies['dashboard'] == copies['sensor']
+
+@pytest.mark.parametrize('payload', [b'\x01', b'\x01' + bytes(20), b'\x02' + bytes(12), b'\x02' + bytes(30)])
+def test_truncated_binary_raises_value_error(payload):
+    codec = load('dashboard', 'codec')
+    with pytest.raises(ValueError):
+        codec.decode(payload)
+
+@pytest.mark.parametrize('format', ['json', 'binary'])
+@pytest.mark.parametrize('state', [
+    {'value' : 17, 'seq' : 1234567890123},
+    {'value' : -3, 'seq' : 1, 'ts' : 1600000000.25},
+    {'value' : 0},
+])
+def test_round_trip(format, state):
+    codec = load('dashboard', 'codec')
+    assert codec.decode(codec.encode(state, format)) == state
+
+def test_decode_accepts_str():
+    codec = load('dashboard', 'codec')
+    assert codec.decode('{"value": 4}') == {'value' : 4}
+
+def test_binary_is_smaller():
+    codec = load('dashboard', 'codec')
+    state = {'value' : 17, 'seq' : 1234567890123, 'ts' : 1600000000.25}
+    assert len(codec.encode(state, codec.BINARY)) < len(codec.encode(state, codec.JSON))
+
+def test_unknown_format():
+    codec = load('dashboard', 'codec')
+    with pytest.raises(ValueError):
+        codec.encode({'value' : 1}, 'xml')
@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import load
+
+history = load('dashboard', 'history')
+
+TIERS = {'10s' : (10, 6)}
+
+def test_rollup_buckets():
+    h = history.History(tiers=TIERS)
+    for t, value in [(100, 2), (105, 6), (109, 4), (112, 8)]:
+        h.add('a', value, t)
+    assert h.query('a', '10s', window=20, until=119) == {
+        't'   : [100, 110],
+        'min' : [2, 8],
+        'max' : [6, 8],
+        'avg' : [4, 8],
+    }
+
+def test_gaps_repeat_the_last_value():
+    h = history.History(tiers=TIERS)
+    h.add('a', 2, 100)
+    h.add('a', 5, 109)
+    h.add('a', 7, 131)
+    columns = h.query('a', '10s', window=40, until=139)
+    assert columns['t'] == [100, 110, 120, 130]
+    assert columns['avg'] == [3.5, 5, 5, 7]
+    assert columns['min'][1:3] == [5, 5]
+
+def test_ring_forgets_old_buckets():
+    h = history.History(tiers=TIERS)
+    h.add('a', 1, 0)
+    h.add('a', 9, 60)
+    # Bucket 6 has overwritten bucket 0's slot, and the window is capped
+    # to the tier's capacity, so nothing is left to repeat into 10-50.
+    columns = h.query('a', '10s', window=1000, until=69)
+    assert columns['t'] == [60]
+    assert columns['avg'] == [9]
+
+def test_raw_samples():
+    h = history.History(raw=3, tiers=TIERS)
+    for t in range(5):
+        h.add('a', t * 10, t)
+    assert h.query('a', 'raw', window=10, until=4) == {'t' : [2, 3, 4], 'value' : [20, 30, 40]}
+    assert h.query('a', 'raw', window=1.5, until=4) == {'t' : [3, 4], 'value' : [30, 40]}
+
+def test_unknown_room_and_tier():
+    h = history.History(tiers=TIERS)
+    assert h.query('missing', '10s') == {'t' : [], 'min' : [], 'max' : [], 'avg' : []}
+    with pytest.raises(ValueError):
+        h.query('missing', '1d')
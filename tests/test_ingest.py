@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import load
+
+ingest = load('dashboard', 'ingest')
+IngestQueue = ingest.IngestQueue
+
+def drain(queue):
+    entries = []
+    while True:
+        entry = queue.get(timeout=0)
+        if entry is None:
+            return entries
+        entries.append(entry)
+
+def test_collapse_replaces_in_place():
+    queue = IngestQueue(10, IngestQueue.COLLAPSE)
+    queue.put('a', 1)
+    queue.put('b', 2)
+    queue.put('a', 3)
+    assert drain(queue) == [('a', 3), ('b', 2)]
+    assert queue.collapsed == 1
+    assert queue.dropped == 0
+    assert queue.received == 3
+
+def test_drop_oldest_keeps_every_item():
+    queue = IngestQueue(10, IngestQueue.DROP_OLDEST)
+    queue.put('a', 1)
+    queue.put('b', 2)
+    queue.put('a', 3)
+    assert drain(queue) == [('a', 1), ('b', 2), ('a', 3)]
+    assert queue.collapsed == 0
+
+@pytest.mark.parametrize('policy', IngestQueue.POLICIES)
+def test_full_queue_drops_oldest(policy):
+    queue = IngestQueue(2, policy)
+    for i, key in enumerate('abc'):
+        queue.put(key, i)
+    assert drain(queue) == [('b', 1), ('c', 2)]
+    assert queue.dropped == 1
+    assert queue.max_depth == 2
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        IngestQueue(10, 'block')
+
+def test_get_times_out():
+    assert IngestQueue().get(timeout=0.01) is None
+
+def test_ingest_counts_add_up():
+    handled = []
+    pipeline = ingest.Ingest(lambda key, item: handled.append(item), workers=3, policy=IngestQueue.DROP_OLDEST)
+    for i in range(300):
+        pipeline.submit('k%d'%(i % 7), i)
+    pipeline.stop()
+    stats = pipeline.stats()
+    assert stats['received'] == 300
+    assert stats['handled'] + stats['dropped'] + stats['depth'] == 300
+    assert stats['handled'] == len(handled)
@@ -0,0 +1,29 @@
+import pytest
+
+from conftest import load
+
+pytest.importorskip('dash_devices')
+Journal = load('dashboard', 'dashboard').Journal
+
+def test_since():
+    journal = Journal(size=4)
+    for room in 'abac':
+        journal.record(room)
+    assert journal.version == 4
+    assert journal.since(1) == {'a', 'b', 'c'}
+    assert journal.since(2) == {'a', 'c'}
+    assert journal.since(4) == set()
+
+def test_since_unknown_versions():
+    journal = Journal(size=4)
+    journal.record('a')
+    assert journal.since(None) is None
+    # From the future, as after a restart.
+    assert journal.since(5) is None
+
+def test_since_past_the_journal():
+    journal = Journal(size=2)
+    for room in 'abcd':
+        journal.record(room)
+    assert journal.since(1) is None
+    assert journal.since(2) == {'c', 'd'}
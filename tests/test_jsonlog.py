@@ -0,0 +1,56 @@
+import os
+
+from conftest import ROOT, load
+
+jsonlog = load('dashboard', 'jsonlog')
+
+def test_copies_are_identical():
+    copies = []
+    for component in ('broker', 'dashboard'):
+        with open(os.path.join(ROOT, component, 'jsonlog.py'), 'rb') as f:
+            copies.append(f.read())
+    assert copies[0] == copies[1]
+
+def test_records_survive_reopening(tmp_path):
+    path = str(tmp_path / 'log')
+    log = jsonlog.JsonLog(path)
+    assert log.load() == []
+    log.append([{'a' : 1}, {'b' : 2}])
+    log.append([{'a' : 3}])
+    log.close()
+
+    log = jsonlog.JsonLog(path)
+    assert log.load() == [{'a' : 1}, {'b' : 2}, {'a' : 3}]
+    assert log.records == 3
+    log.close()
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = str(tmp_path / 'log')
+    with open(path, 'w') as f:
+        f.write('{"a": 1}\nnot json\n{"b": 2}\n{"c": ')
+
+    log = jsonlog.JsonLog(path)
+    assert log.load() == [{'a' : 1}, {'b' : 2}]
+    # The next record starts on a line of its own.
+    log.append([{'d' : 4}])
+    log.close()
+    with open(path) as f:
+        assert f.read() == '{"a": 1}\nnot json\n{"b": 2}\n{"d": 4}\n'
+
+def test_compaction(tmp_path):
+    path = str(tmp_path / 'log')
+    log = jsonlog.JsonLog(path, compact_ratio=2, compact_min=4)
+    log.load()
+    log.append([{'a' : i} for i in range(4)])
+    assert not log.needs_compaction(1)
+    log.append([{'a' : 4}])
+    assert log.needs_compaction(1)
+    assert not log.needs_compaction(3)
+
+    log.compact([{'a' : 4}])
+    assert log.records == 1
+    log.append([{'b' : 5}])
+    log.close()
+    assert not os.path.exists(path + '.tmp')
+    with open(path) as f:
+        assert f.read() == '{"a": 4}\n{"b": 5}\n'
@@ -0,0 +1,103 @@
+import asyncio
+import socket
+
+import pytest
+
+pytest.importorskip('hbmqtt')
+
+from conftest import load
+
+limits = load('broker', 'limits')
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+def test_bucket_allows_burst_then_rate():
+    bucket = limits.TokenBucket(rate=10, burst=3)
+    assert [bucket.reserve(0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve(0) is None
+    assert bucket.reserve(1) == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve(1) == pytest.approx(0.2, abs=0.01)
+
+def test_limits_off_unless_rate_set():
+    assert not limits.ListenerLimits({'publish_burst': 5}).enabled
+    assert limits.ListenerLimits({'connect_rate': 5}).enabled
+    assert run(limits.ListenerLimits({}).admit_publish('client', backlog=10**6))
+
+def test_connections_shed_past_max_delay():
+    listener = limits.ListenerLimits({'connect_rate': 1, 'connect_burst': 1, 'connect_max_delay': 0})
+    assert run(listener.admit_connection())
+    assert not run(listener.admit_connection())
+    assert listener.counters['connections/shed'] == 1
+
+def test_qos0_publishes_dropped_past_backlog():
+    listener = limits.ListenerLimits({'publish_rate': 10, 'publish_max_delay': 1})
+    assert run(listener.admit_publish('client', backlog=10))
+    assert not run(listener.admit_publish('client', backlog=11))
+    assert listener.counters['publish/dropped'] == 1
+
+def test_acknowledged_publishes_wait():
+    listener = limits.ListenerLimits({'publish_rate': 100, 'publish_burst': 1, 'publish_max_delay': 0})
+    admitted = [run(listener.admit_publish('client', backlog=1000, droppable=False)) for _ in range(5)]
+    assert admitted == [True]*5
+    assert listener.counters['publish/dropped'] == 0
+    assert listener.counters['publish/delayed'] == 4
+
+def test_forget_frees_bucket():
+    listener = limits.ListenerLimits({'publish_rate': 1, 'publish_burst': 1, 'publish_max_delay': 0})
+    assert run(listener.admit_publish('client'))
+    assert not run(listener.admit_publish('client'))
+    listener.forget('client')
+    assert run(listener.admit_publish('client'))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_broker_delivers_acknowledged_publishes_over_limit():
+    from hbmqtt.client import MQTTClient
+    from hbmqtt.mqtt.constants import QOS_0, QOS_1
+
+    broker_module = load('broker', 'broker')
+    port = free_port()
+    broker = broker_module.create_broker({
+        'listeners': {
+            'default': {
+                'type': 'tcp',
+                'bind': '127.0.0.1:%d'%(port,),
+                'publish_rate': 50,
+                'publish_burst': 5,
+                'publish_max_delay': 0.1,
+            },
+        },
+        'sys_interval': 0,
+        'topic-check': {'enabled': False, 'acl': {'anonymous': ['#']}},
+    }, totals=False)
+
+    @asyncio.coroutine
+    def exchange():
+        yield from broker.start()
+        subscriber, publisher = MQTTClient(), MQTTClient()
+        try:
+            yield from subscriber.connect('mqtt://127.0.0.1:%d/'%(port,))
+            yield from asyncio.wait_for(subscriber.subscribe([('load/#', QOS_1)]), 5)
+            yield from publisher.connect('mqtt://127.0.0.1:%d/'%(port,))
+            for i in range(30):
+                yield from publisher.publish('load/acked', b'%d'%(i,), qos=QOS_1)
+            yield from publisher.publish('load/retained', b'last', qos=QOS_0, retain=True)
+
+            received = []
+            while len(received) < 31:
+                message = yield from asyncio.wait_for(subscriber.deliver_message(), 5)
+                received.append((message.topic, message.data))
+            return received, set(broker._retained_messages)
+        finally:
+            yield from publisher.disconnect()
+            yield from subscriber.disconnect()
+            yield from broker.shutdown()
+
+    received, retained = run(exchange())
+    assert [data for topic, data in received if topic == 'load/acked'] == [b'%d'%(i,) for i in range(30)]
+    assert ('load/retained', b'last') in received
+    assert 'load/retained' in retained
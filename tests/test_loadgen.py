@@ -0,0 +1,40 @@
+import pytest
+
+from conftest import load
+
+pytest.importorskip('paho')
+loadgen = load('sensor', 'loadgen')
+
+LABELS = ['<=1', '<=5', '<=10', '<=25', '<=50', '>50']
+
+def stats(counts, avg_ms):
+    # Sorted the way JSON encoders with sort_keys leave them.
+    return {'count'   : sum(counts),
+            'avg_ms'  : avg_ms,
+            'buckets' : dict(sorted(zip(LABELS, counts)))}
+
+def test_only_the_run_is_counted():
+    before = stats([5, 0, 0, 0, 0, 0], 0.5)
+    after = stats([5, 10, 0, 0, 0, 0], 2.5)
+    count, avg, _, _ = loadgen.latency_diff(before, after)
+    assert count == 10
+    assert avg == pytest.approx(3.5)
+
+def test_percentiles_are_interpolated_within_buckets():
+    before = stats([0]*6, 0)
+    after = stats([0, 40, 40, 10, 10, 0], 10)
+    _, _, percentiles, slowest = loadgen.latency_diff(before, after)
+    # The 50th sample is a quarter into the 5-10ms bucket's 40.
+    assert percentiles[50] == pytest.approx(6.25)
+    assert percentiles[90] == pytest.approx(25.0)
+    assert percentiles[99] == pytest.approx(47.5)
+    assert slowest == '<=50'
+
+def test_open_ended_bucket():
+    after = stats([0, 0, 0, 0, 0, 2], 80)
+    _, _, percentiles, slowest = loadgen.latency_diff(stats([0]*6, 0), after)
+    assert percentiles[50] == '>50'
+    assert slowest == '>50'
+
+def test_no_samples():
+    assert loadgen.latency_diff(stats([1]*6, 1), stats([1]*6, 1)) is None
@@ -0,0 +1,65 @@
+from conftest import load
+
+outbox = load('sensor', 'outbox')
+
+def lines(path):
+    with open(path) as f:
+        return f.readlines()
+
+def test_in_memory_keeps_latest_per_topic():
+    box = outbox.Outbox()
+    box.put('a/cur', {'value' : 1})
+    box.put('a/cur', {'value' : 2})
+    box.put('b/cur', {'value' : 3})
+    assert box.items() == [('a/cur', {'value' : 2}), ('b/cur', {'value' : 3})]
+    assert box.get('c/cur') is None
+
+def test_states_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'outbox')
+    box = outbox.Outbox(path)
+    box.put('a/cur', {'value' : 1, 'seq' : 1})
+    box.put('a/cur', {'value' : 2, 'seq' : 2})
+    box.close()
+
+    box = outbox.Outbox(path)
+    assert box.items() == [('a/cur', {'value' : 2, 'seq' : 2})]
+    # Compacted on load.
+    assert len(lines(path)) == 1
+    box.close()
+
+def test_torn_tail_is_ignored(tmp_path):
+    path = str(tmp_path / 'outbox')
+    with open(path, 'w') as f:
+        f.write('{"topic": "a/cur", "state": {"value": 1}}\n{"topic": "a/cur", "sta')
+    box = outbox.Outbox(path)
+    assert box.items() == [('a/cur', {'value' : 1})]
+    box.put('b/cur', {'value' : 2})
+    box.close()
+
+    box = outbox.Outbox(path)
+    assert box.items() == [('a/cur', {'value' : 1}), ('b/cur', {'value' : 2})]
+    box.close()
+
+def test_file_is_compacted_past_its_limit(tmp_path):
+    path = str(tmp_path / 'outbox')
+    box = outbox.Outbox(path, limit=5)
+    for i in range(12):
+        box.put('a/cur', {'value' : i})
+        assert len(lines(path)) <= 6
+    box.close()
+
+    box = outbox.Outbox(path)
+    assert box.get('a/cur') == {'value' : 11}
+    box.close()
+
+def test_topics_are_bounded(tmp_path):
+    path = str(tmp_path / 'outbox')
+    box = outbox.Outbox(path, max_topics=2)
+    for topic in ('a', 'b', 'c', 'a'):
+        box.put(topic, {'value' : 1})
+    assert [topic for topic, _ in box.items()] == ['c', 'a']
+    box.close()
+
+    box = outbox.Outbox(path, max_topics=2)
+    assert [topic for topic, _ in box.items()] == ['c', 'a']
+    box.close()
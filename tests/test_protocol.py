@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import load
+
+pytest.importorskip('dash_devices')
+dashboard = load('dashboard', 'dashboard')
+codec = load('dashboard', 'codec')
+store = load('dashboard', 'store')
+
+@pytest.fixture(scope='module')
+def monitor(tmp_path_factory):
+    db = store.open_store('log', str(tmp_path_factory.mktemp('db') / 'rooms.log'), legacy=None)
+    monitor = dashboard.Monitor('test:0', connect=False, db=db)
+    yield monitor
+    db.close()
+
+def update(value, seq):
+    return codec.encode({'value' : value, 'seq' : seq}, codec.JSON)
+
+def test_update_creates_room(monitor):
+    monitor.proto.handle_message('sensors/1/a/occupancy/cur', update(3, 1))
+    room = monitor.get_room(dashboard.Room.Id('1', 'a'))
+    assert room.occupancy_cur == 3
+
+@pytest.mark.parametrize('payload', [b'{"value": 1', b'[1, 2]', b'"full"', b'{"seq": 1}', b'\x01\x02'])
+def test_bad_payload_creates_no_room(monitor, payload):
+    with pytest.raises(ValueError):
+        monitor.proto.handle_message('sensors/2/b/occupancy/cur', payload)
+    assert dashboard.Room.Id('2', 'b') not in {room.id for room in monitor.rooms()}
+    assert monitor.db.get('2-b') is None
+
+def test_stale_update_is_dropped(monitor):
+    monitor.proto.handle_message('sensors/1/c/occupancy/cur', update(5, 10))
+    monitor.proto.handle_message('sensors/1/c/occupancy/cur', update(4, 9))
+    assert monitor.get_room(dashboard.Room.Id('1', 'c')).occupancy_cur == 5
+    assert monitor.proto.stale == 1
+
+def test_only_rooms_with_settings_are_stored(monitor):
+    monitor.proto.handle_message('sensors/3/a/occupancy/cur', update(1, 1))
+    monitor.proto.handle_message('sensors/3/b/occupancy/cur', update(1, 1))
+    monitor.get_room(dashboard.Room.Id('3', 'b')).occupancy_max = 12
+    assert monitor.db.get('3-a') is None
+    assert monitor.db.get('3-b') == 12
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from conftest import load
+
+pytest.importorskip('dash_devices')
+replay = load('dashboard', 'replay')
+
+TOPICS = ['sensors/1/%s/occupancy/cur'%(room,) for room in 'abc']
+
+@pytest.fixture
+def recording(tmp_path):
+    """
+    A recording of 300 messages, one every 0.1s over three topics, indexed
+    every second, and the messages as (time, topic, payload).
+    """
+    path = str(tmp_path / 'test.rec')
+    rec = replay.Recording(path, index_interval=1.0)
+    messages = []
+    for i in range(300):
+        ts = rec.start + i / 10.0
+        topic, payload = TOPICS[i % 3], b'{"value": %d}'%(i,)
+        rec.write(topic, payload, ts)
+        messages.append((ts - rec.start, topic, payload))
+    rec.close()
+    return path, messages
+
+def played(playback, start=0.0):
+    return [(t, topic, bytes(payload)) for t, topic, payload in playback.messages(start)]
+
+def test_round_trip(recording):
+    path, messages = recording
+    playback = replay.Playback(path)
+    try:
+        assert played(playback) == messages
+        assert playback.topics() == TOPICS
+        assert playback.duration() == pytest.approx(29.9)
+    finally:
+        playback.close()
+
+@pytest.mark.parametrize('start', [0.0, 0.05, 1.0, 12.34, 29.9, 40.0])
+def test_seek_through_the_index(recording, start):
+    path, messages = recording
+    playback = replay.Playback(path)
+    try:
+        # 30 index entries, one per second, each after its topics.
+        assert len(playback._offsets) == 30
+        assert played(playback, start) == [m for m in messages if m[0] >= start]
+    finally:
+        playback.close()
+
+def test_seek_without_the_index(recording):
+    path, messages = recording
+    os.remove(path + '.idx')
+    playback = replay.Playback(path)
+    try:
+        assert playback.topics() == TOPICS
+        assert played(playback, 12.0) == [m for m in messages if m[0] >= 12.0]
+    finally:
+        playback.close()
+
+def test_partly_written_tails_are_ignored(recording):
+    path, messages = recording
+    for name in (path, path + '.idx'):
+        with open(name, 'r+b') as f:
+            f.truncate(os.path.getsize(name) - 3)
+
+    playback = replay.Playback(path)
+    try:
+        assert played(playback) == messages[:-1]
+        assert played(playback, 29.0) == [m for m in messages[:-1] if m[0] >= 29.0]
+    finally:
+        playback.close()
+
+def test_not_a_recording(tmp_path):
+    path = str(tmp_path / 'other')
+    with open(path, 'wb') as f:
+        f.write(b'not a recording at all')
+    with pytest.raises(ValueError):
+        replay.Playback(path)
@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import load
+
+retained = load('broker', 'retained')
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'retained.log')
+
+def open_store(path, **kwargs):
+    # Synced by hand: the background thread would only flush after an hour.
+    return retained.RetainedStore(path, sync_interval=3600, **kwargs)
+
+def test_retains_survive_a_restart(path):
+    store = open_store(path)
+    store.put('sensors/1/a/occupancy/cur', b'\x00\x01', 1)
+    store.put('sensors/1/b/occupancy/cur', b'{"value": 2}', 0)
+    store.remove('sensors/1/b/occupancy/cur')
+    store.remove('never/retained')
+    store.close()
+
+    store = open_store(path)
+    assert store.items() == [('sensors/1/a/occupancy/cur', (b'\x00\x01', 1))]
+    store.close()
+
+def test_torn_tail_is_recovered(path):
+    store = open_store(path)
+    store.put('a', b'1', 0)
+    store.close()
+    with open(path, 'a') as f:
+        f.write('{"topic": "b", "data": "M')
+
+    store = open_store(path)
+    assert dict(store.items()) == {'a' : (b'1', 0)}
+    store.put('c', b'3', 2)
+    store.close()
+
+    store = open_store(path)
+    assert dict(store.items()) == {'a' : (b'1', 0), 'c' : (b'3', 2)}
+    store.close()
+
+def test_compaction_keeps_latest(path):
+    store = open_store(path, compact_ratio=2, compact_min=10)
+    for i in range(20):
+        store.put('a', b'%d'%(i,), 0)
+        store.put('b', b'%d'%(i,), 1)
+        store.flush()
+    store.remove('b')
+    store.flush()
+    store.close()
+
+    with open(path) as f:
+        lines = f.readlines()
+    assert len(lines) <= 10
+
+    store = open_store(path)
+    assert store.items() == [('a', (b'19', 0))]
+    store.close()
@@ -0,0 +1,55 @@
+from collections import namedtuple
+
+import pytest
+
+from conftest import load
+
+topics = load('dashboard', 'topics')
+
+Id = namedtuple('Id', ('floor', 'room'))
+
+BUILDINGS = 'sites/{building}/{floor}/{room}/occupancy/cur'
+
+def test_default_route():
+    router = topics.TopicRouter(Id)
+    assert router.route('sensors/1/a/occupancy/cur') == Id('1', 'a')
+    assert router.filters == ['sensors/+/+/occupancy/cur']
+
+@pytest.mark.parametrize('topic', [
+    'sensors/1/a/occupancy/max',
+    'sensors/1/a/occupancy',
+    'sensors/1/a/b/occupancy/cur',
+    'other/1/a/occupancy/cur',
+    'sensors/1/a-b/occupancy/cur',
+])
+def test_unrouted_topics(topic):
+    with pytest.raises(ValueError):
+        topics.TopicRouter(Id).route(topic)
+
+def test_extra_captures_name_the_floor():
+    router = topics.TopicRouter(Id, routes=(BUILDINGS, topics.TopicRouter.ROUTES[0]))
+    assert router.route('sites/hq/2/201/occupancy/cur') == Id('hq_2', '201')
+    assert router.route('sensors/1/a/occupancy/cur') == Id('1', 'a')
+    assert router.filters == ['sites/+/+/+/occupancy/cur', 'sensors/+/+/occupancy/cur']
+
+def test_ids_are_interned():
+    router = topics.TopicRouter(Id, cache_size=1)
+    first = router.route('sensors/1/a/occupancy/cur')
+    router.route('sensors/1/b/occupancy/cur')
+    assert router.route('sensors/1/a/occupancy/cur') is first
+
+def test_sibling_topics_follow_the_route():
+    router = topics.TopicRouter(Id, routes=(BUILDINGS,))
+    id = router.route('sites/hq/2/201/occupancy/cur')
+    assert router.topic(id, 'max') == 'sites/hq/2/201/occupancy/max'
+    # A room that never published gets the default shape.
+    assert router.topic(Id('3', 'c'), 'max') == 'sensors/3/c/occupancy/max'
+
+@pytest.mark.parametrize('pattern', [
+    'sensors/{floor}/occupancy/cur',
+    'sensors/{room}/occupancy/cur',
+    'sensors/{floor}/{room}',
+])
+def test_bad_routes(pattern):
+    with pytest.raises(ValueError):
+        topics.Route(pattern)
@@ -0,0 +1,121 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from conftest import load
+
+shared = load('dashboard', 'shared')
+RoomTable = shared.RoomTable
+
+@pytest.fixture
+def table():
+    table = RoomTable(capacity=8, ring=4)
+    yield table
+    table.close()
+
+def test_write_and_read(table):
+    assert table.write(('1', 'a'), {'value' : 3, 'max' : 10}) == 1
+    assert table.write(('1', 'a'), {'value' : 4}) == 2
+    assert table.write(('2', 'b'), {'max' : 5}) == 3
+
+    assert table.version == 3
+    assert table.count == 2
+    assert table.lookup(('1', 'a')) == (('1', 'a'), 4, 10, 2)
+    assert table.lookup(('2', 'b')) == (('2', 'b'), 0, 5, 3)
+    assert table.lookup(('3', 'c')) is None
+
+def test_follower_attaches_by_name(table):
+    table.write(('1', 'a'), {'value' : 3})
+    follower = RoomTable(table.name)
+    try:
+        assert follower.read(0) == (('1', 'a'), 3, 0, 1)
+        assert follower.since(0) == {('1', 'a')}
+    finally:
+        follower.close()
+
+def test_since(table):
+    for i in range(3):
+        table.write(('1', str(i)), {'value' : i})
+    assert table.since(1) == {('1', '1'), ('1', '2')}
+    assert table.since(3) == set()
+    assert table.since(None) is None
+    # From the future, as after the ingestion process restarted.
+    assert table.since(10) is None
+
+def test_since_past_the_ring(table):
+    for i in range(6):
+        table.write(('1', 'a'), {'value' : i})
+    assert table.since(1) is None
+    assert table.since(2) == {('1', 'a')}
+
+def test_full_table(table):
+    for i in range(8):
+        table.write(('1', str(i)), {})
+    with pytest.raises(ValueError):
+        table.write(('1', 'x'), {})
+
+def test_read_waits_for_odd_sequence(table):
+    table.write(('1', 'a'), {'value' : 1, 'max' : 1})
+    offset = table._records
+    seq = struct.unpack_from('<I', table._shm.buf, offset)[0]
+
+    # Mark the record as being written, and finish the write later.
+    struct.pack_into('<I', table._shm.buf, offset, seq + 1)
+    def finish():
+        time.sleep(0.02)
+        RoomTable.RECORD.pack_into(table._shm.buf, offset, seq + 2, b'1', b'a', 2, 2, 2)
+    threading.Thread(target=finish).start()
+
+    assert table.read(0) == (('1', 'a'), 2, 2, 2)
+
+def test_read_gives_up_on_a_stuck_record(table):
+    table.write(('1', 'a'), {'value' : 1})
+    offset = table._records
+    seq = struct.unpack_from('<I', table._shm.buf, offset)[0]
+    # As left by a writer that died mid-write.
+    struct.pack_into('<I', table._shm.buf, offset, seq + 1)
+
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        table.read(0, timeout=0.05)
+    assert time.monotonic() - start < 1
+
+def test_reserve_checks_ids(table):
+    assert table.reserve(('1', 'a')) == 0
+    assert table.reserve(('1', 'a')) == 0
+    assert table.count == 1
+    assert table.version == 0
+    with pytest.raises(ValueError):
+        table.reserve(('1', 'x'*33))
+    assert table.count == 1
+
+def test_reads_are_never_torn(table):
+    stopped = threading.Event()
+    def write():
+        i = 0
+        while not stopped.is_set():
+            i += 1
+            table.write(('1', 'a'), {'value' : i, 'max' : i})
+    writer = threading.Thread(target=write)
+    table.write(('1', 'a'), {'value' : 0, 'max' : 0})
+    writer.start()
+    try:
+        for _ in range(20000):
+            _, value, max, _ = table.read(0)
+            assert value == max
+    finally:
+        stopped.set()
+        writer.join()
+
+def test_versions_increase_across_writers(table):
+    def write(room):
+        for i in range(2000):
+            table.write(('1', room), {'value' : i})
+    threads = [threading.Thread(target=write, args=(room,)) for room in 'abc']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert table.version == 6000
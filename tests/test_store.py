@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+from conftest import load
+
+store = load('dashboard', 'store')
+
+@pytest.fixture(params=sorted(store.BACKENDS))
+def backend(request):
+    return request.param
+
+def open_store(backend, path, **kwargs):
+    # Synced by hand: the background thread would only flush after an hour.
+    cls, _ = store.BACKENDS[backend]
+    return cls(path, sync_interval=3600, **kwargs)
+
+def test_settings_survive_a_restart(backend, tmp_path):
+    path = str(tmp_path / 'rooms')
+    db = open_store(backend, path)
+    db.set('1-a', 10)
+    db.update({'1-b' : 5, '1-a' : 12})
+    assert db.get('1-a') == 12
+    db.close()
+
+    db = open_store(backend, path)
+    assert dict(db.items()) == {'1-a' : 12, '1-b' : 5}
+    assert sorted(db.keys()) == ['1-a', '1-b']
+    assert db.get('2-a') is None
+    db.close()
+
+def test_compaction(backend, tmp_path):
+    path = str(tmp_path / 'rooms')
+    db = open_store(backend, path, compact_min=10)
+    for i in range(50):
+        db.set('1-a', i)
+        db.flush()
+    if backend == 'log':
+        with open(path) as f:
+            assert len(f.readlines()) <= 10
+    else:
+        # Truncated every 10 commits, so it holds about as many pages,
+        # not the 50 written.
+        assert os.path.getsize(path + '-wal') < 20 * 4096
+    db.close()
+
+    db = open_store(backend, path)
+    assert dict(db.items()) == {'1-a' : 49}
+    db.close()
+
+def test_log_drops_a_torn_tail(tmp_path):
+    path = str(tmp_path / 'rooms.log')
+    with open(path, 'w') as f:
+        f.write('{"key": "1-a", "value": 3}\n{"value": 4}\n{"key": "1-b", "val')
+    db = open_store('log', path)
+    assert dict(db.items()) == {'1-a' : 3}
+    db.close()
+
+def test_legacy_import(backend, tmp_path):
+    legacy = str(tmp_path / 'rooms.db')
+    with open(legacy, 'w') as f:
+        json.dump({'1-a' : 7, '2-b' : 3}, f)
+
+    path = str(tmp_path / 'rooms')
+    db = store.open_store(backend, path, legacy, sync_interval=3600)
+    assert dict(db.items()) == {'1-a' : 7, '2-b' : 3}
+    db.set('1-a', 8)
+    db.close()
+
+    # Only the first time: the store's own settings win afterwards.
+    db = store.open_store(backend, path, legacy, sync_interval=3600)
+    assert db.get('1-a') == 8
+    db.close()
+
+def test_no_legacy_file(backend, tmp_path):
+    db = store.open_store(backend, str(tmp_path / 'rooms'), str(tmp_path / 'missing.db'), sync_interval=3600)
+    assert len(db) == 0
+    db.close()
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from conftest import load
+
+topics = load('broker', 'topics')
+
+def trie_of(*filters):
+    trie = topics.TopicTrie()
+    for a_filter in filters:
+        trie.add(a_filter)
+    return trie
+
+@pytest.mark.parametrize('topic, expected', [
+    ('sensors/1/2/occupancy/cur', {'sensors/+/+/occupancy/cur', 'sensors/1/#', 'sensors/1/2/occupancy/cur', '#'}),
+    ('sensors/1/2/occupancy/max', {'sensors/1/#', '#'}),
+    ('sensors/3/2/occupancy/cur', {'sensors/+/+/occupancy/cur', '#'}),
+    ('sensors/1', {'sensors/1/#', '#'}),
+    ('other', {'#'}),
+])
+def test_match(topic, expected):
+    trie = trie_of('sensors/+/+/occupancy/cur', 'sensors/1/#', 'sensors/1/2/occupancy/cur', '#')
+    assert set(trie.match(topic)) == expected
+
+def test_wildcards_skip_dollar_topics():
+    trie = trie_of('#', '+/broker/uptime', '$SYS/#', '$SYS/+/uptime')
+    assert set(trie.match('$SYS/broker/uptime')) == {'$SYS/#', '$SYS/+/uptime'}
+    assert set(trie.match('sys/broker/uptime')) == {'#', '+/broker/uptime'}
+
+def test_hash_matches_parent_level():
+    trie = trie_of('a/#', 'a/b/#')
+    assert set(trie.match('a')) == {'a/#'}
+    assert set(trie.match('a/b')) == {'a/#', 'a/b/#'}
+    assert trie.match('ab') == []
+
+def test_plus_matches_one_level():
+    trie = trie_of('a/+')
+    assert trie.match('a/b') == ['a/+']
+    assert trie.match('a') == []
+    assert trie.match('a/b/c') == []
+
+def test_add_is_idempotent():
+    trie = trie_of('a/b', 'a/b', 'a/+')
+    assert len(trie) == 2
+
+def test_remove_prunes_unused_branches():
+    trie = trie_of('a/b/c', 'a/b', 'x/#')
+    trie.remove('a/b/c')
+    assert trie.match('a/b/c') == []
+    assert trie.match('a/b') == ['a/b']
+    assert 'c' not in trie._root.children['a'].children['b'].children
+
+    trie.remove('a/b')
+    trie.remove('x/#')
+    assert len(trie) == 0
+    assert trie._root.children == {}
+
+def test_remove_unknown_filter():
+    trie = trie_of('a/b')
+    trie.remove('a')
+    trie.remove('a/b/c')
+    trie.remove('z')
+    assert len(trie) == 1
+    assert trie.match('a/b') == ['a/b']
+
+def test_trie_agrees_with_matches():
+    rng = random.Random(7)
+    levels = ['a', 'b', '$SYS', 'c']
+    filters = set()
+    for _ in range(200):
+        parts = [rng.choice(levels + ['+']) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.3:
+            parts.append('#')
+        filters.add('/'.join(parts))
+    trie = trie_of(*filters)
+
+    for _ in range(500):
+        topic = '/'.join(rng.choice(levels) for _ in range(rng.randint(1, 4)))
+        assert sorted(trie.match(topic)) == sorted(f for f in filters if topics.matches(topic, f)), topic
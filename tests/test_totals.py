@@ -0,0 +1,34 @@
+import asyncio
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('hbmqtt')
+
+from conftest import load
+
+totals = load('broker', 'totals')
+
+def plugin(config):
+    # The loop is never run: the flushes scheduled on it don't publish.
+    return totals.OccupancyTotals(SimpleNamespace(config=config, loop=asyncio.new_event_loop()))
+
+@pytest.mark.parametrize('config, qos', [
+    ({}, 2),
+    ({'max-qos': 1}, 1),
+    ({'occupancy-totals': {'qos': 1}}, 1),
+    ({'occupancy-totals': {'qos': 2}, 'max-qos': 0}, 0),
+])
+def test_qos_from_config(config, qos):
+    assert plugin(config)._qos == qos
+
+def test_totals_follow_updates():
+    occupancy = plugin({})
+    occupancy.observe('sensors/1/a/occupancy/cur', b'{"value": 3}')
+    occupancy.observe('sensors/1/a/occupancy/max', b'{"value": 10}')
+    occupancy.observe('sensors/2/a/occupancy/cur', b'{"value": 4}')
+    occupancy.observe('sensors/1/a/occupancy/cur', b'{"value": 1}')
+    occupancy.observe('sensors/1/b/occupancy/other', b'{"value": 9}')
+    assert occupancy.total('1') == {'value' : 1, 'max' : 10, 'rooms' : 1}
+    assert occupancy.total(None) == {'value' : 5, 'max' : 10, 'rooms' : 2}